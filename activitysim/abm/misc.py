@@ -50,11 +50,41 @@ def chunk_size(settings):
     return int(settings.get('chunk_size', 0))
 
 
+@inject.injectable(cache=True)
+def adaptive_chunking(settings):
+    return bool(settings.get('adaptive_chunking', False))
+
+
+@inject.injectable(cache=True)
+def chunk_history_path(output_dir, settings):
+    return os.path.join(output_dir, settings.get('chunk_history_file', 'chunk_history.csv'))
+
+
+@inject.injectable(cache=True)
+def rss_ceiling(settings):
+    return int(settings.get('rss_ceiling', 0))
+
+
+@inject.injectable(cache=True)
+def interaction_broadcast(settings):
+    return bool(settings.get('interaction_broadcast', False))
+
+
+@inject.injectable(cache=True)
+def num_threads(settings):
+    return int(settings.get('num_threads', 1))
+
+
 @inject.injectable(cache=True)
 def check_for_variability(settings):
     return bool(settings.get('check_for_variability', False))
 
 
+@inject.injectable(cache=True)
+def expression_values_dtype(settings):
+    return settings.get('expression_values_dtype', 'float64')
+
+
 @inject.injectable(cache=True)
 def trace_hh_id(settings):
 
@@ -1,17 +1,25 @@
 # ActivitySim
 # See full license in LICENSE.txt.
 
+import hashlib
+import json
 import logging
 import os
+import threading
+
+from multiprocessing.pool import ThreadPool
 
 import pandas as pd
 import numpy as np
 
 from activitysim.core import assign
+from activitysim.core import chunk
 from activitysim.core import tracing
 from activitysim.core import config
 from activitysim.core import inject
+from activitysim.core import skim as askim
 
+from ..tables.skims import skim_cache_source
 
 logger = logging.getLogger(__name__)
 
@@ -31,35 +39,64 @@ class AccessibilitySkims(object):
         array is correct shape to match (flattened) O-D tiled columns in the od dataframe
     transpose: bool
         whether to transpose the matrix before flattening. (i.e. act as a D-O instead of O-D skim)
+    orig_slice: slice
+        block of origin zone offsets to return rows for (all zones if None)
+    omx_skims: dict
+        skims already loaded from omx on demand, shared with the parent's blocks
     """
 
-    def __init__(self, skim_dict, omx, length, transpose=False):
+    # pytables omx files are not safe to read from multiple threads
+    omx_lock = threading.Lock()
+
+    def __init__(self, skim_dict, omx, length, transpose=False, orig_slice=None,
+                 omx_skims=None):
         self.skim_dict = skim_dict
         self.omx = omx
         self.length = length
         self.transpose = transpose
+        self.orig_slice = orig_slice or slice(0, length)
+        self.omx_skims = {} if omx_skims is None else omx_skims
+
+    def block(self, orig_slice):
+        """
+        return AccessibilitySkims for the origin zone offsets in orig_slice
+        whose flattened skim arrays match a (block x length) tiled OD df
+        """
+        return AccessibilitySkims(self.skim_dict, self.omx, self.length,
+                                  transpose=self.transpose, orig_slice=orig_slice,
+                                  omx_skims=self.omx_skims)
+
+    def omx_skim(self, key):
+        """
+        skim key (not in skim_dict) read from omx once and remembered for all blocks
+        """
+        with self.omx_lock:
+            if key not in self.omx_skims:
+                omx_key = '__'.join(key)
+                logger.info("AccessibilitySkims loading %s from omx as %s" % (key, omx_key,))
+                self.omx_skims[key] = self.omx[omx_key][:self.length, :self.length]
+            return self.omx_skims[key]
 
     def __getitem__(self, key):
         """
         accessor to return flattened skim array with specified key
-        flattened array will have length length*length and will match tiled OD df used by assign
+        flattened array will have length block*length and will match tiled OD df used by assign
 
         this allows the skim array to be accessed from expressions as
         skim['DISTANCE'] or skim[('SOVTOLL_TIME', 'MD')]
         """
         try:
-            data = self.skim_dict.get(key).data
+            skim = self.skim_dict.get(key)
+            data, scale = skim.data, skim.scale
         except KeyError:
-            omx_key = '__'.join(key)
-            logger.info("AccessibilitySkims loading %s from omx as %s" % (key, omx_key,))
-            data = self.omx[omx_key]
-
-        data = data[:self.length, :self.length]
+            data, scale = self.omx_skim(key), None
 
         if self.transpose:
-            return data.transpose().flatten()
+            data = data[:self.length, self.orig_slice].transpose().flatten()
         else:
-            return data.flatten()
+            data = data[self.orig_slice, :self.length].flatten()
+
+        return askim.unpack_skim_values(data, scale)
 
 
 @inject.injectable()
@@ -73,10 +110,145 @@ def accessibility_settings(configs_dir):
     return config.read_model_settings(configs_dir, 'accessibility.yaml')
 
 
+def accessibility_cache_key(accessibility_spec, accessibility_settings, land_use_df,
+                            skim_source):
+    """
+    Hash of the inputs that accessibility results depend on
+
+    These are the accessibility_spec expressions, the constants and land_use_columns from
+    accessibility_settings, the land_use_columns values and skim_source, the description of
+    the omx skims file and skim_dtypes policy returned by skims.skim_cache_source. (Skims are
+    identified by the omx file rather than by their contents, so that skims loaded from the
+    omx file on demand by AccessibilitySkims are covered without reading and hashing them.)
+
+    Returns
+    -------
+    key : str
+        hex digest
+    """
+
+    h = hashlib.md5()
+
+    h.update(repr(zip(accessibility_spec.target, accessibility_spec.expression)))
+
+    constants = config.get_model_constants(accessibility_settings) or {}
+    h.update(repr(sorted(constants.items())))
+
+    land_use_columns = accessibility_settings.get('land_use_columns', [])
+    h.update(repr(land_use_columns))
+    h.update(np.ascontiguousarray(land_use_df.index.values))
+    for c in land_use_columns:
+        h.update(np.ascontiguousarray(land_use_df[c].values))
+
+    h.update(json.dumps(skim_source, sort_keys=True))
+
+    return h.hexdigest()
+
+
+def compute_accessibility_block(accessibility_spec, land_use_df, locals_d, orig_slice, trace_od):
+    """
+    Evaluate accessibility_spec for the od pairs with origins in orig_slice
+
+    Returns
+    -------
+    sums : pandas.DataFrame
+        sum over destinations of each accessibility_spec result column,
+        with one row for each origin zone in the block
+    trace : tuple or None
+        (trace_od_df, trace_results, trace_assigned_locals) if trace_od is in the block
+    """
+
+    zone_count = len(land_use_df.index)
+    zones = np.asanyarray(land_use_df.index)
+    block_count = len(zones[orig_slice])
+
+    # create OD dataframe for block
+    od_df = pd.DataFrame(
+        data={
+            'orig': np.repeat(zones[orig_slice], zone_count),
+            'dest': np.tile(zones, block_count)
+        },
+        index=np.arange(block_count * zone_count) + orig_slice.start * zone_count
+    )
+
+    if trace_od:
+        trace_orig, trace_dest = trace_od
+        trace_od_rows = (od_df.orig == trace_orig) & (od_df.dest == trace_dest)
+    else:
+        trace_od_rows = None
+
+    # add land_use_columns (for dest zone) to od_df
+    dest_offsets = np.tile(np.arange(zone_count), block_count)
+    for c in land_use_df.columns:
+        od_df[c] = np.asanyarray(land_use_df[c]).take(dest_offsets)
+
+    locals_d = locals_d.copy()
+    for skims in ['skim_od', 'skim_do']:
+        locals_d[skims] = locals_d[skims].block(orig_slice)
+
+    results, trace_results, trace_assigned_locals \
+        = assign.assign_variables(accessibility_spec, od_df, locals_d, trace_rows=trace_od_rows)
+
+    sums = pd.DataFrame(index=zones[orig_slice])
+    for column in results.columns:
+        data = np.asanyarray(results[column])
+        data.shape = (block_count, zone_count)
+        sums[column] = np.sum(data, axis=1)
+
+    if trace_od_rows is not None and trace_od_rows.any():
+        trace = (od_df[trace_od_rows], trace_results, trace_assigned_locals)
+    else:
+        trace = None
+
+    return sums, trace
+
+
+def compute_accessibility_sums(accessibility_spec, land_use_df, locals_d,
+                               block_size, num_threads, trace_od):
+    """
+    Evaluate accessibility_spec for all od pairs in blocks of block_size origin zones,
+    running blocks on a pool of num_threads threads if num_threads is greater than one
+
+    Returns
+    -------
+    sums : pandas.DataFrame
+        sum over destinations of each accessibility_spec result column for each origin zone
+    traces : list
+        trace tuples (see compute_accessibility_block) for blocks containing trace_od
+    """
+
+    zone_count = len(land_use_df.index)
+
+    orig_slices = [slice(start, min(start + block_size, zone_count))
+                   for start in range(0, zone_count, block_size)]
+
+    def run_block(orig_slice):
+        return compute_accessibility_block(accessibility_spec, land_use_df, locals_d,
+                                           orig_slice, trace_od)
+
+    logger.info("compute_accessibility %s zones in %s blocks of %s origins on %s threads" %
+                (zone_count, len(orig_slices), block_size, num_threads))
+
+    if num_threads > 1 and len(orig_slices) > 1:
+        pool = ThreadPool(num_threads)
+        try:
+            block_results = pool.map(run_block, orig_slices)
+        finally:
+            pool.close()
+    else:
+        block_results = [run_block(orig_slice) for orig_slice in orig_slices]
+
+    sums = pd.concat([block_sums for block_sums, trace in block_results])
+    traces = [trace for block_sums, trace in block_results if trace is not None]
+
+    return sums, traces
+
+
 @inject.step()
 def compute_accessibility(settings, accessibility_spec,
                           accessibility_settings,
-                          skim_dict, omx_file, land_use, trace_od):
+                          skim_dict, omx_file, land_use, trace_od,
+                          data_dir, cache_skim_key_values):
 
     """
     Compute accessibility for each zone in land use file using expressions from accessibility_spec
@@ -92,6 +264,15 @@ def compute_accessibility(settings, accessibility_spec,
     to each destination zone are next summed over each origin zone, and the logarithm of the
     product mutes large differences.  The decay function on the walk accessibility measure is
     steeper than automobile or transit.  The minimum accessibility is zero.
+
+    If block_size is specified in accessibility_settings, od pairs are processed in blocks of
+    block_size origin zones (so the od df is block_size x zone_count rather than zone_count^2)
+    and, if num_threads (the num_threads setting, or num_threads in accessibility_settings)
+    is greater than one, blocks are run on a thread pool.
+
+    If the cache setting in accessibility_settings is True, results are saved in cache_dir
+    under a hash of their inputs (see accessibility_cache_key) and subsequent runs with the
+    same inputs use the saved results rather than recomputing them.
     """
 
     logger.info("Running compute_accessibility")
@@ -101,25 +282,33 @@ def compute_accessibility(settings, accessibility_spec,
 
     land_use_df = land_use.to_frame()
 
-    zone_count = len(land_use_df.index)
+    cache_file = None
+    if accessibility_settings.get('cache', False):
+        cache_dir = accessibility_settings.get(
+            'cache_dir', os.path.join(inject.get_injectable('output_dir'), 'cache'))
+        skim_source = skim_cache_source(os.path.join(data_dir, settings['skims_file']),
+                                        cache_skim_key_values,
+                                        skim_dtypes=settings.get('skim_dtypes'))
+        cache_key = accessibility_cache_key(accessibility_spec, accessibility_settings,
+                                            land_use_df, skim_source)
+        cache_file = os.path.join(cache_dir, 'accessibility_%s.h5' % cache_key)
+
+        if os.path.isfile(cache_file):
+            logger.info("compute_accessibility reading cached results from %s" % cache_file)
+            accessibility_df = pd.read_hdf(cache_file, 'accessibility')
+            for column in accessibility_df.columns:
+                inject.add_column("accessibility", column, accessibility_df[column])
+            if trace_od:
+                logger.info("compute_accessibility not tracing trace_od for cached results")
+            return
 
-    # create OD dataframe
-    od_df = pd.DataFrame(
-        data={
-            'orig': np.repeat(np.asanyarray(land_use_df.index), zone_count),
-            'dest': np.tile(np.asanyarray(land_use_df.index), zone_count)
-        }
-    )
+    zone_count = len(land_use_df.index)
 
-    if trace_od:
-        trace_orig, trace_dest = trace_od
-        trace_od_rows = (od_df.orig == trace_orig) & (od_df.dest == trace_dest)
-    else:
-        trace_od_rows = None
+    block_size = accessibility_settings.get('block_size', None) or zone_count
+    # the num_threads setting, unless overridden for accessibility in accessibility_settings
+    num_threads = accessibility_settings.get('num_threads', None) or chunk.get_num_threads()
 
-    # merge land_use_columns into od_df
     land_use_df = land_use_df[land_use_columns]
-    od_df = pd.merge(od_df, land_use_df, left_on='dest', right_index=True).sort_index()
 
     locals_d = {
         'log': np.log,
@@ -130,24 +319,35 @@ def compute_accessibility(settings, accessibility_spec,
     if constants is not None:
         locals_d.update(constants)
 
-    results, trace_results, trace_assigned_locals \
-        = assign.assign_variables(accessibility_spec, od_df, locals_d, trace_rows=trace_od_rows)
+    sums, traces = compute_accessibility_sums(accessibility_spec, land_use_df, locals_d,
+                                              block_size, num_threads, trace_od)
+
     accessibility_df = pd.DataFrame(index=land_use.index)
-    for column in results.columns:
-        data = np.asanyarray(results[column])
-        data.shape = (zone_count, zone_count)
-        accessibility_df[column] = np.log(np.sum(data, axis=1) + 1)
+    for column in sums.columns:
+        accessibility_df[column] = np.log(np.asanyarray(sums[column]) + 1)
 
         inject.add_column("accessibility", column, accessibility_df[column])
 
+    if cache_file:
+        logger.info("compute_accessibility writing results to cache %s" % cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write to temp file and rename so concurrent runs never see a partial cache file
+        temp_file = '%s.%s' % (cache_file, os.getpid())
+        accessibility_df.to_hdf(temp_file, 'accessibility', mode='w')
+        os.rename(temp_file, cache_file)
+
     if trace_od:
 
-        if not trace_od_rows.any():
+        if not traces:
+            trace_orig, trace_dest = trace_od
             logger.warn("trace_od not found origin = %s, dest = %s" % (trace_orig, trace_dest))
         else:
 
+            trace_od_df, trace_results, trace_assigned_locals = traces[0]
+
             # add OD columns to trace results
-            df = pd.concat([od_df[trace_od_rows], trace_results], axis=1)
+            df = pd.concat([trace_od_df, trace_results], axis=1)
 
             # dump the trace results table (with _temp variables) to aid debugging
             # note that this is not the same as the orca-injected accessibility table
@@ -15,6 +15,7 @@ from activitysim.core.util import force_garbage_collect
 from activitysim.core.util import assign_in_place
 
 from .util.mode import _mode_choice_spec
+from .util.expressions import skim_time_period_category
 
 logger = logging.getLogger(__name__)
 
@@ -31,13 +32,17 @@ def _mode_choice_simulate(records,
                           constants,
                           nest_spec,
                           chunk_size,
-                          trace_label=None, trace_choice_name=None
+                          trace_label=None, trace_choice_name=None,
+                          segment_key=None
                           ):
     """
     This is a utility to run a mode choice model for each segment (usually
     segments are tour/trip purposes).  Pass in the tours/trip that need a mode,
     the Skim object, the spec to evaluate with, and any additional expressions
     you want to use in the evaluation of variables.
+
+    If segment_key is not None, spec is a segmented spec (see get_segmented_spec)
+    and records from all segments are run together.
     """
 
     locals_d = {
@@ -64,9 +69,13 @@ def _mode_choice_simulate(records,
         locals_d=locals_d,
         chunk_size=chunk_size,
         trace_label=trace_label,
-        trace_choice_name=trace_choice_name)
+        trace_choice_name=trace_choice_name,
+        segment_key=segment_key)
 
     alts = spec.columns
+    if segment_key:
+        # every segment has the same alternatives
+        alts = spec[alts.get_level_values(0)[0]].columns
     choices = choices.map(dict(zip(range(len(alts)), alts)))
 
     return choices
@@ -91,6 +100,26 @@ def get_segment_and_unstack(omnibus_spec, segment):
     return spec
 
 
+def get_segmented_spec(omnibus_spec, segments):
+    """
+    Unstacked specs for all of segments, concatenated into a single spec with two levels
+    of columns (segment and alternative) for simulate.simple_simulate with a segment_key.
+
+    Since the segment specs all come from the same omnibus spec, they have the same expressions
+    and alternatives and only differ in their coefficients, so the expressions can be evaluated
+    once for the choosers of all segments.
+    """
+
+    specs = [get_segment_and_unstack(omnibus_spec, segment) for segment in segments]
+
+    for segment, spec in zip(segments, specs):
+        assert spec.index.equals(specs[0].index)
+        assert spec.columns.equals(specs[0].columns), \
+            "get_segmented_spec segment %s alternatives differ" % segment
+
+    return pd.concat(specs, axis=1, keys=segments)
+
+
 """
 Tour mode choice is run for all tours to determine the transportation mode that
 will be used for the tour
@@ -146,6 +175,10 @@ def atwork_subtour_mode_choice_simulate(tours,
                         persons_merged.to_frame(),
                         left_on='person_id', right_index=True)
 
+    # categorical time periods for faster skim_stack lookups
+    choosers['out_period'] = skim_time_period_category(choosers.out_period)
+    choosers['in_period'] = skim_time_period_category(choosers.in_period)
+
     nest_spec = config.get_logit_model_settings(tour_mode_choice_settings)
     constants = config.get_model_constants(tour_mode_choice_settings)
 
@@ -215,6 +248,10 @@ def tour_mode_choice_simulate(tours_merged,
 
     tours = tours_merged.to_frame()
 
+    # categorical time periods for faster skim_stack lookups
+    tours['out_period'] = skim_time_period_category(tours.out_period)
+    tours['in_period'] = skim_time_period_category(tours.in_period)
+
     tours = tours[tours.tour_category != 'subtour']
 
     nest_spec = config.get_logit_model_settings(tour_mode_choice_settings)
@@ -237,27 +274,19 @@ def tour_mode_choice_simulate(tours_merged,
                                              skim_key="in_period")
     od_skims = skim_dict.wrap('TAZ', 'destination')
 
-    choices_list = []
-
-    for tour_type, segment in tours.groupby('tour_type'):
-
-        # if tour_type != 'work':
-        #     continue
+    if tour_mode_choice_settings.get('SEGMENTED_SIMULATE', False):
 
-        logger.info("tour_mode_choice_simulate tour_type '%s' (%s tours)" %
-                    (tour_type, len(segment.index), ))
+        # evaluate expressions once for the tours of all tour_types
+        tours.index.name = 'tour_id'
 
-        # name index so tracing knows how to slice
-        segment.index.name = 'tour_id'
-
-        spec = get_segment_and_unstack(tour_mode_choice_spec, tour_type)
+        spec = get_segmented_spec(tour_mode_choice_spec, sorted(tours.tour_type.unique()))
 
         if trace_hh_id:
-            tracing.trace_df(spec, tracing.extend_trace_label(trace_label, 'spec.%s' % tour_type),
+            tracing.trace_df(spec, tracing.extend_trace_label(trace_label, 'spec.segmented'),
                              slicer='NONE', transpose=False)
 
         choices = _mode_choice_simulate(
-            segment,
+            tours,
             odt_skim_stack_wrapper=odt_skim_stack_wrapper,
             dot_skim_stack_wrapper=dot_skim_stack_wrapper,
             od_skim_stack_wrapper=od_skims,
@@ -265,18 +294,55 @@ def tour_mode_choice_simulate(tours_merged,
             constants=constants,
             nest_spec=nest_spec,
             chunk_size=chunk_size,
-            trace_label=tracing.extend_trace_label(trace_label, tour_type),
-            trace_choice_name='tour_mode_choice')
+            trace_label=trace_label,
+            trace_choice_name='tour_mode_choice',
+            segment_key='tour_type')
+
+        force_garbage_collect()
 
-        tracing.print_summary('tour_mode_choice_simulate %s choices' % tour_type,
-                              choices, value_counts=True)
+    else:
 
-        choices_list.append(choices)
+        choices_list = []
 
-        # FIXME - force garbage collection
-        force_garbage_collect()
+        for tour_type, segment in tours.groupby('tour_type'):
+
+            # if tour_type != 'work':
+            #     continue
+
+            logger.info("tour_mode_choice_simulate tour_type '%s' (%s tours)" %
+                        (tour_type, len(segment.index), ))
+
+            # name index so tracing knows how to slice
+            segment.index.name = 'tour_id'
 
-    choices = pd.concat(choices_list)
+            spec = get_segment_and_unstack(tour_mode_choice_spec, tour_type)
+
+            if trace_hh_id:
+                tracing.trace_df(spec,
+                                 tracing.extend_trace_label(trace_label, 'spec.%s' % tour_type),
+                                 slicer='NONE', transpose=False)
+
+            choices = _mode_choice_simulate(
+                segment,
+                odt_skim_stack_wrapper=odt_skim_stack_wrapper,
+                dot_skim_stack_wrapper=dot_skim_stack_wrapper,
+                od_skim_stack_wrapper=od_skims,
+                spec=spec,
+                constants=constants,
+                nest_spec=nest_spec,
+                chunk_size=chunk_size,
+                trace_label=tracing.extend_trace_label(trace_label, tour_type),
+                trace_choice_name='tour_mode_choice')
+
+            tracing.print_summary('tour_mode_choice_simulate %s choices' % tour_type,
+                                  choices, value_counts=True)
+
+            choices_list.append(choices)
+
+            # FIXME - force garbage collection
+            force_garbage_collect()
+
+        choices = pd.concat(choices_list)
 
     tracing.print_summary('tour_mode_choice_simulate all tour type choices',
                           choices, value_counts=True)
@@ -342,6 +408,9 @@ def trip_mode_choice_simulate(trips_merged,
 
     trips = trips_merged.to_frame()
 
+    # categorical time periods for faster skim_stack lookups
+    trips['start_period'] = skim_time_period_category(trips.start_period)
+
     nest_spec = config.get_logit_model_settings(trip_mode_choice_settings)
     constants = config.get_model_constants(trip_mode_choice_settings)
 
@@ -352,40 +421,62 @@ def trip_mode_choice_simulate(trips_merged,
 
     od_skims = skim_dict.wrap('OTAZ', 'DTAZ')
 
-    choices_list = []
-
-    # loop by tour_type in order to easily query the expression coefficient file
-    for tour_type, segment in trips.groupby('tour_type'):
-
-        logger.info("running %s tour_type '%s'" % (len(segment.index), tour_type, ))
-
-        # name index so tracing knows how to slice
-        segment.index.name = 'trip_id'
+    if trip_mode_choice_settings.get('SEGMENTED_SIMULATE', False):
 
-        # FIXME - check that destination is not null
+        # evaluate expressions once for the trips of all tour_types
+        trips.index.name = 'trip_id'
 
         choices = _mode_choice_simulate(
-            segment,
+            trips,
             odt_skim_stack_wrapper=odt_skim_stack_wrapper,
             dot_skim_stack_wrapper=None,
             od_skim_stack_wrapper=od_skims,
-            spec=get_segment_and_unstack(trip_mode_choice_spec, tour_type),
+            spec=get_segmented_spec(trip_mode_choice_spec, sorted(trips.tour_type.unique())),
             constants=constants,
             nest_spec=nest_spec,
             chunk_size=chunk_size,
-            trace_label=tracing.extend_trace_label(trace_label, tour_type),
-            trace_choice_name='trip_mode_choice')
+            trace_label=trace_label,
+            trace_choice_name='trip_mode_choice',
+            segment_key='tour_type')
 
-        # FIXME - no point in printing verbose value_counts now that we have tracing?
-        tracing.print_summary('trip_mode_choice_simulate %s choices' % tour_type,
-                              choices, value_counts=True)
+        force_garbage_collect()
 
-        choices_list.append(choices)
+    else:
 
-        # FIXME - force garbage collection
-        force_garbage_collect()
+        choices_list = []
+
+        # loop by tour_type in order to easily query the expression coefficient file
+        for tour_type, segment in trips.groupby('tour_type'):
+
+            logger.info("running %s tour_type '%s'" % (len(segment.index), tour_type, ))
+
+            # name index so tracing knows how to slice
+            segment.index.name = 'trip_id'
+
+            # FIXME - check that destination is not null
+
+            choices = _mode_choice_simulate(
+                segment,
+                odt_skim_stack_wrapper=odt_skim_stack_wrapper,
+                dot_skim_stack_wrapper=None,
+                od_skim_stack_wrapper=od_skims,
+                spec=get_segment_and_unstack(trip_mode_choice_spec, tour_type),
+                constants=constants,
+                nest_spec=nest_spec,
+                chunk_size=chunk_size,
+                trace_label=tracing.extend_trace_label(trace_label, tour_type),
+                trace_choice_name='trip_mode_choice')
+
+            # FIXME - no point in printing verbose value_counts now that we have tracing?
+            tracing.print_summary('trip_mode_choice_simulate %s choices' % tour_type,
+                                  choices, value_counts=True)
+
+            choices_list.append(choices)
+
+            # FIXME - force garbage collection
+            force_garbage_collect()
 
-    choices = pd.concat(choices_list)
+        choices = pd.concat(choices_list)
 
     tracing.print_summary('trip_mode_choice_simulate all tour type choices',
                           choices, value_counts=True)
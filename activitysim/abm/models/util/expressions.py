@@ -6,6 +6,7 @@ import logging
 
 import numpy as np
 import pandas as pd
+from pandas.api.types import is_numeric_dtype
 
 from activitysim.core import tracing
 from activitysim.core import config
@@ -31,7 +32,8 @@ def local_utilities():
         'np': np,
         'reindex': util.reindex,
         'setting': config.setting,
-        'skim_time_period_label': skim_time_period_label
+        'skim_time_period_label': skim_time_period_label,
+        'skim_time_period_category': skim_time_period_category
     }
 
     return utility_dict
@@ -155,3 +157,32 @@ def skim_time_period_label(time):
         return skim_time_periods['labels'][bin]
 
     return pd.cut(time, skim_time_periods['hours'], labels=skim_time_periods['labels']).astype(str)
+
+
+def skim_time_period_category(periods):
+    """
+    convert time period times or skim time period labels to categorical skim time period labels
+
+    SkimStackWrapper uses the (small int) category codes of categorical time periods
+    to index the stacked time period skims, instead of looking up the label of every row.
+    Categoricals can't be stored in the pipeline, so convert period columns once per table
+    before using them in skim lookups.
+
+    Parameters
+    ----------
+    periods : pandas Series
+        time period times (e.g. 9) or skim time period labels (e.g. 'AM')
+
+    Returns
+    -------
+    pandas Series
+        categorical time period labels with skim_time_periods labels as categories
+    """
+
+    skim_time_periods = config.setting('skim_time_periods')
+
+    if is_numeric_dtype(periods):
+        return pd.cut(periods, skim_time_periods['hours'], labels=skim_time_periods['labels'])
+
+    return pd.Series(pd.Categorical(periods, categories=skim_time_periods['labels']),
+                     index=periods.index)
@@ -2,6 +2,8 @@
 # See full license in LICENSE.txt.
 
 import os
+import re
+import csv
 import logging
 
 import openmatrix as omx
@@ -18,6 +20,17 @@ logger = logging.getLogger(__name__)
 Read in the omx files and create the skim objects
 """
 
+# skims used directly by abm python code rather than by expressions in the model specs
+CODE_SKIM_NAMES = ['DIST', 'SOV_TIME']
+
+# skim references in spec expressions, e.g. skims['DIST'], odt_skims["SOV_TIME"]
+# or skim_od[('SOVTOLL_TIME', 'AM')] (for which all time periods of SOVTOLL_TIME are loaded)
+SKIM_REFERENCE = re.compile(r"""\w*skim\w*\[\s*\(?\s*['"](\w+)['"]""")
+
+# skim references that aren't string literals (e.g. skims[key])
+# and so can't be found by spec_skim_names
+SKIM_VARIABLE_REFERENCE = re.compile(r"""\w*skim\w*\[\s*[^\s'"(]""")
+
 
 # cache this so we don't open it again and again - skim code is not closing it....
 @inject.injectable(cache=True)
@@ -32,27 +45,229 @@ def omx_file(data_dir, settings):
     return file
 
 
-@inject.injectable(cache=True)
-def skim_dict(omx_file, cache_skim_key_values):
+def omx_skims(omx_file, cache_skim_key_values, skim_names=None):
+    """
+    dict of (not yet read) omx matrices for the 2D skims and the 3D skims for time periods
+    in cache_skim_key_values, keyed by skim key
 
-    logger.info("skims injectable loading skims")
+    If skim_names is not None, only the skims whose (first) key is in skim_names are included,
+    and the omx matrices that are skipped are logged.
+    """
 
-    skim_dict = askim.SkimDict()
-    skim_dict.offset_mapper.set_offset_int(-1)
+    skims = {}
+    skipped = []
 
     skims_in_omx = omx_file.listMatrices()
     for skim_name in skims_in_omx:
         key, sep, key2 = skim_name.partition('__')
+        if skim_names is not None and key not in skim_names:
+            skipped.append(skim_name)
+            continue
         skim_data = omx_file[skim_name]
         if not sep:
             # no separator - this is a simple 2d skim - we load them all
-            skim_dict.set(key, skim_data)
+            skims[key] = skim_data
         else:
             # there may be more time periods in the skim than are used by the model
             # cache_skim_key_values is a list of time periods (frem settings) that are used
             # FIXME - assumes that the only types of key2 are skim_time_periods
             if key2 in cache_skim_key_values:
-                skim_dict.set((key, key2), skim_data)
+                skims[(key, key2)] = skim_data
+
+    if skim_names is not None:
+        logger.info("omx_skims skipping %s of %s omx matrices not referenced by model specs"
+                    % (len(skipped), len(skims_in_omx)))
+        logger.debug("omx_skims skipped matrices: %s" % sorted(skipped))
+
+        missing = set(skim_names) - set(k[0] if isinstance(k, tuple) else k for k in skims)
+        if missing:
+            logger.warning("omx_skims skims referenced by model specs not found in omx file: %s"
+                           % sorted(missing))
+
+    return skims
+
+
+def load_skims_from_omx(omx_file, cache_skim_key_values, skim_names=None, skim_dtypes=None):
+    """
+    load the 2D skims and the 3D skims for time periods in cache_skim_key_values into a SkimDict
+    (only those in skim_names unless it is None), stored according to the skim_dtypes policy
+
+    The time period skims for each key are read into a single 3D array (see askim.SkimDict.stacks)
+    so that skim_stack doesn't need to copy them.
+    """
+
+    skims = omx_skims(omx_file, cache_skim_key_values, skim_names)
+
+    buffer, layout = askim.load_skim_buffer(skims, askim.OffsetMapper(offset_int=-1),
+                                            skim_dtypes=skim_dtypes)
+
+    return askim.attach_skim_buffer(buffer, layout)
+
+
+def skim_cache_source(omx_file_path, cache_skim_key_values, skim_names=None, skim_dtypes=None):
+    """
+    description of the skims loaded from omx_file_path, used to detect a stale skim cache
+    """
+
+    stat = os.stat(omx_file_path)
+
+    source = {
+        'omx_file': os.path.abspath(omx_file_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'cache_skim_key_values': list(cache_skim_key_values)
+    }
+
+    if skim_names is not None:
+        source['skim_names'] = sorted(skim_names)
+
+    if skim_dtypes:
+        source['skim_dtypes'] = skim_dtypes
+
+    return source
+
+
+def spec_skim_names(configs_dir):
+    """
+    names of the skims referenced by the expressions in the spec csv files in configs_dir
+
+    Every csv file in configs_dir is scanned (coefficients and alternatives files just don't
+    contain any skim references), and only the first item of tuple skim keys is returned,
+    e.g. 'SOVTOLL_TIME' for skim_od[('SOVTOLL_TIME', 'AM')].
+    """
+
+    skim_names = set()
+
+    for file_name in sorted(os.listdir(configs_dir)):
+
+        if not file_name.endswith('.csv'):
+            continue
+
+        # parse csv so quoted expressions are unescaped
+        with open(os.path.join(configs_dir, file_name)) as f:
+            spec = '\n'.join(cell for row in csv.reader(f) for cell in row)
+
+        skim_names.update(SKIM_REFERENCE.findall(spec))
+
+        if SKIM_VARIABLE_REFERENCE.search(spec):
+            logger.warning("spec_skim_names %s has skim references that are not string literals"
+                           " - add the skims they use to the prune_skims_keep setting" % file_name)
+
+    return skim_names
+
+
+@inject.injectable(cache=True)
+def pruned_skim_names(settings):
+    """
+    names of skims to load if the prune_skims setting is True, otherwise None (load all skims)
+
+    These are the skims referenced in the model spec files in configs_dir, plus those used
+    directly by python code (CODE_SKIM_NAMES) and those listed in the prune_skims_keep setting.
+    """
+
+    if not settings.get('prune_skims', False):
+        return None
+
+    skim_names = spec_skim_names(inject.get_injectable('configs_dir'))
+    skim_names.update(CODE_SKIM_NAMES)
+    skim_names.update(settings.get('prune_skims_keep', []))
+
+    logger.info("pruned_skim_names %s skims referenced by model specs" % len(skim_names))
+
+    return sorted(skim_names)
+
+
+@inject.injectable(cache=True)
+def skim_cache_dir(output_dir, settings):
+    return settings.get('skim_cache_dir', os.path.join(output_dir, 'cache'))
+
+
+def load_skim_dict(data_dir, settings, cache_skim_key_values, skim_names=None):
+    """
+    SkimDict of the skims in the omx skims_file
+
+    If the skim_cache setting is True, the skims are written to skim_cache_dir as raw binary
+    files the first time they are loaded, and on subsequent runs they are opened as
+    memory-mapped arrays instead of being read and decompressed from the omx file.
+
+    Skims are stored in reduced precision according to the skim_dtypes setting, if any
+    (see askim.skim_storage).
+    """
+
+    omx_file_path = os.path.join(data_dir, settings["skims_file"])
+    skim_dtypes = settings.get('skim_dtypes')
+
+    use_skim_cache = settings.get('skim_cache', False)
+
+    if use_skim_cache:
+        cache_dir = inject.get_injectable('skim_cache_dir')
+        source = skim_cache_source(omx_file_path, cache_skim_key_values, skim_names, skim_dtypes)
+
+        skim_dict = askim.read_skim_cache(cache_dir, source)
+        if skim_dict is not None:
+            return skim_dict
+
+    skim_dict = load_skims_from_omx(inject.get_injectable('omx_file'), cache_skim_key_values,
+                                    skim_names, skim_dtypes)
+
+    if use_skim_cache:
+        askim.write_skim_cache(skim_dict, cache_dir, source)
+
+        # reopen as memmapped arrays so we don't hold on to the loaded copies
+        skim_dict = askim.read_skim_cache(cache_dir, source)
+
+    return skim_dict
+
+
+@inject.injectable(cache=True)
+def shared_skim_buffer(data_dir, settings, cache_skim_key_values, pruned_skim_names):
+    """
+    (buffer, layout) tuple of the skims loaded into a shared memory buffer (see load_skim_buffer)
+
+    Worker processes forked after this is loaded inherit it. Spawned worker processes should be
+    passed it as an argument and register it with inject.add_injectable before skims are used,
+    so their skim_dict attaches to the parent's buffer instead of loading the skims again.
+    """
+
+    logger.info("shared_skim_buffer loading skims")
+
+    if settings.get('skim_cache', False):
+        # memmapped skims are only paged in as they are copied into the buffer
+        # (cached skims are already packed according to the skim_dtypes policy)
+        skim_dict = load_skim_dict(data_dir, settings, cache_skim_key_values, pruned_skim_names)
+        skims, offset_mapper, packed = skim_dict.skims, skim_dict.offset_mapper, True
+    else:
+        skims = omx_skims(inject.get_injectable('omx_file'), cache_skim_key_values,
+                          pruned_skim_names)
+        offset_mapper, packed = askim.OffsetMapper(offset_int=-1), False
+
+    return askim.load_skim_buffer(skims, offset_mapper, shared=True,
+                                  skim_dtypes=settings.get('skim_dtypes'), packed=packed)
+
+
+@inject.injectable(cache=True)
+def skim_dict(data_dir, settings, cache_skim_key_values, pruned_skim_names):
+    """
+    SkimDict of the skims in the omx skims_file
+
+    If the prune_skims setting is True, only the skims referenced by the model specs are loaded
+    (see pruned_skim_names).
+
+    If the shared_skims setting is True, the SkimDict is attached to the shared_skim_buffer,
+    so that multiple processes can use the same skims without each holding their own copy.
+    """
+
+    logger.info("skims injectable loading skims")
+
+    if settings.get('shared_skims', False):
+        buffer, layout = inject.get_injectable('shared_skim_buffer')
+        skim_dict = askim.attach_skim_buffer(buffer, layout)
+    else:
+        skim_dict = load_skim_dict(data_dir, settings, cache_skim_key_values, pruned_skim_names)
+
+    # cap on memory used by skim wrappers to memoize lookups (see askim.SkimLookupMemo)
+    skim_dict.memo_max_bytes = \
+        settings.get('skim_memo_max_bytes', askim.DEFAULT_SKIM_MEMO_MAX_BYTES)
 
     return skim_dict
 
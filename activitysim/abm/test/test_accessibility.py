@@ -0,0 +1,176 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import os
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandas.util.testing as pdt
+import orca
+
+from .. import __init__
+
+from activitysim.core import assign
+from activitysim.core import inject
+from activitysim.core import pipeline
+from activitysim.core import skim
+from activitysim.abm.models import accessibility
+from activitysim.abm.tables import skims
+
+
+def teardown_function(func):
+    pipeline.close_open_files()
+    orca.clear_cache()
+    inject.reinject_decorated_tables()
+
+
+def test_accessibility_blocks():
+
+    pipeline.close_open_files()
+    orca.clear_cache()
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    orca.add_injectable("data_dir", data_dir)
+    orca.add_injectable("settings", {
+        'skims_file': 'skims.omx',
+        'skim_time_periods': {'hours': [0, 11, 16, 24], 'labels': ['AM', 'MD', 'PM']}
+    })
+
+    configs_dir = os.path.join(os.path.dirname(__file__), 'configs')
+    spec = assign.read_assignment_spec(os.path.join(configs_dir, 'accessibility.csv'))
+
+    skim_dict = inject.get_injectable('skim_dict')
+    omx_file = inject.get_injectable('omx_file')
+
+    zone_count = 25
+    land_use_df = pd.DataFrame({'RETEMPN': np.arange(zone_count) % 7,
+                                'TOTEMP': np.arange(zone_count) * 10},
+                               index=np.arange(1, zone_count + 1))
+
+    locals_d = {
+        'log': np.log,
+        'exp': np.exp,
+        'skim_od': accessibility.AccessibilitySkims(skim_dict, omx_file, zone_count),
+        'skim_do': accessibility.AccessibilitySkims(skim_dict, omx_file, zone_count,
+                                                    transpose=True),
+        'dispersion_parameter_automobile': -0.05,
+        'dispersion_parameter_transit': -0.05,
+        'dispersion_parameter_walk': -1.00,
+        'maximum_walk_distance': 3.0,
+        'out_of_vehicle_time_weight': 2.0,
+    }
+
+    trace_od = (12, 3)
+
+    sums, traces = accessibility.compute_accessibility_sums(
+        spec, land_use_df, locals_d, block_size=zone_count, num_threads=1, trace_od=trace_od)
+
+    assert sums.shape[0] == zone_count
+    assert len(traces) == 1
+
+    # blocks of origins (including a short last block) on a thread pool
+    block_sums, block_traces = accessibility.compute_accessibility_sums(
+        spec, land_use_df, locals_d, block_size=7, num_threads=3, trace_od=trace_od)
+
+    pdt.assert_frame_equal(block_sums, sums)
+
+    assert len(block_traces) == 1
+    pdt.assert_frame_equal(block_traces[0][0], traces[0][0])
+    pdt.assert_frame_equal(block_traces[0][1], traces[0][1])
+
+
+def test_accessibility_skims_omx():
+
+    pipeline.close_open_files()
+    orca.clear_cache()
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    orca.add_injectable("data_dir", data_dir)
+    orca.add_injectable("settings", {
+        'skims_file': 'skims.omx',
+        'skim_time_periods': {'hours': [0, 11, 16, 24], 'labels': ['AM', 'MD', 'PM']}
+    })
+
+    skim_dict = inject.get_injectable('skim_dict')
+    omx_file = inject.get_injectable('omx_file')
+
+    zone_count = 25
+    key = ('SOVTOLL_TIME', 'MD')
+    expected = skim_dict.get(key).data[:zone_count, :zone_count]
+
+    # skims not in skim_dict are read from omx once and shared by all blocks
+    skims = accessibility.AccessibilitySkims(skim.SkimDict(), omx_file, zone_count)
+    blocks = [skims.block(slice(0, 10)), skims.block(slice(10, zone_count))]
+
+    data = np.concatenate([block[key] for block in blocks])
+    npt.assert_almost_equal(data, expected.flatten())
+
+    assert list(skims.omx_skims.keys()) == [key]
+    assert blocks[1].omx_skims is skims.omx_skims
+
+    skims_do = accessibility.AccessibilitySkims(skim.SkimDict(), omx_file, zone_count,
+                                                transpose=True)
+    npt.assert_almost_equal(skims_do.block(slice(3, 5))[key],
+                            expected[:, 3:5].transpose().flatten())
+
+
+def test_accessibility_cache_key():
+
+    pipeline.close_open_files()
+    orca.clear_cache()
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    orca.add_injectable("data_dir", data_dir)
+    orca.add_injectable("settings", {
+        'skims_file': 'skims.omx',
+        'skim_time_periods': {'hours': [0, 11, 16, 24], 'labels': ['AM', 'MD', 'PM']}
+    })
+
+    configs_dir = os.path.join(os.path.dirname(__file__), 'configs')
+    spec = assign.read_assignment_spec(os.path.join(configs_dir, 'accessibility.csv'))
+
+    skim_source = skims.skim_cache_source(os.path.join(data_dir, 'skims.omx'),
+                                          inject.get_injectable('cache_skim_key_values'))
+
+    settings = {'land_use_columns': ['RETEMPN', 'TOTEMP'],
+                'CONSTANTS': {'dispersion_parameter_walk': -1.00}}
+
+    land_use_df = pd.DataFrame({'RETEMPN': np.arange(25) % 7,
+                                'TOTEMP': np.arange(25) * 10,
+                                'OTHER': np.arange(25)},
+                               index=np.arange(1, 26))
+
+    key = accessibility.accessibility_cache_key(spec, settings, land_use_df, skim_source)
+
+    # same inputs - same key
+    assert key == accessibility.accessibility_cache_key(spec, dict(settings),
+                                                        land_use_df.copy(), skim_source)
+
+    # land_use columns not used by accessibility don't matter
+    land_use_df2 = land_use_df.copy()
+    land_use_df2.OTHER += 1
+    assert key == accessibility.accessibility_cache_key(spec, settings, land_use_df2, skim_source)
+
+    # but land_use_columns do
+    land_use_df2.TOTEMP += 1
+    assert key != accessibility.accessibility_cache_key(spec, settings, land_use_df2, skim_source)
+
+    # as do constants
+    settings2 = {'land_use_columns': ['RETEMPN', 'TOTEMP'],
+                 'CONSTANTS': {'dispersion_parameter_walk': -2.00}}
+    assert key != accessibility.accessibility_cache_key(spec, settings2, land_use_df, skim_source)
+
+    # spec expressions
+    assert key != accessibility.accessibility_cache_key(spec[:-1], settings, land_use_df,
+                                                        skim_source)
+
+    # and the skims file
+    skim_source2 = dict(skim_source, mtime=skim_source['mtime'] + 1)
+    assert key != accessibility.accessibility_cache_key(spec, settings, land_use_df,
+                                                        skim_source2)
+
+    # and skim_dtypes policy
+    skim_source2 = dict(skim_source, skim_dtypes=[{'skims': ['SOV_TIME'], 'dtype': 'float32'}])
+    assert key != accessibility.accessibility_cache_key(spec, settings, land_use_df,
+                                                        skim_source2)
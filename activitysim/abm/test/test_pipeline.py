@@ -19,6 +19,7 @@ from . import extensions
 
 from activitysim.core import tracing
 from activitysim.core import pipeline
+from activitysim.core import mp_tasks
 from activitysim.core import inject
 
 # set the max households for all tests (this is to limit memory use on travis)
@@ -258,7 +259,8 @@ def test_mini_pipeline_run2():
 
 def full_run(resume_after=None, chunk_size=0,
              households_sample_size=HOUSEHOLDS_SAMPLE_SIZE,
-             trace_hh_id=None, trace_od=None, check_for_variability=None):
+             trace_hh_id=None, trace_od=None, check_for_variability=None,
+             num_processes=1):
 
     configs_dir = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'example', 'configs')
     orca.add_injectable("configs_dir", configs_dir)
@@ -283,7 +285,8 @@ def full_run(resume_after=None, chunk_size=0,
 
     MODELS = settings['models']
 
-    pipeline.run(models=MODELS, resume_after=resume_after)
+    mp_tasks.run_multiprocess(models=MODELS, resume_after=resume_after,
+                              num_processes=num_processes)
 
     tours = pipeline.get_table('tours')
     tour_count = len(tours.index)
@@ -387,6 +390,27 @@ def test_full_run_with_chunks():
     assert (mode_df['mode'].values == EXPECT_MODES).all()
 
 
+def test_full_run_multiprocess():
+
+    # should get the same result running household models on household shards
+
+    if SKIP_FULL_RUN:
+        return
+
+    tour_count = full_run(trace_hh_id=HH_ID,
+                          households_sample_size=HOUSEHOLDS_SAMPLE_SIZE,
+                          num_processes=2)
+
+    assert(tour_count == EXPECT_TOUR_COUNT)
+
+    mode_df = get_trace_csv('tour_mode_choice.mode.csv')
+    mode_df.sort_values(by=['person_id', 'tour_type', 'tour_num'], inplace=True)
+
+    assert (mode_df.person_id.values == EXPECT_PERSON_IDS).all()
+    assert (mode_df.tour_type.values == EXPECT_TOUR_TYPES).all()
+    assert (mode_df['mode'].values == EXPECT_MODES).all()
+
+
 def test_full_run_stability():
 
     # hh should get the same result with different sample size
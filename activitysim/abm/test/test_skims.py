@@ -0,0 +1,183 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import os
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandas.util.testing as pdt
+import orca
+from pandas.api.types import is_categorical_dtype
+
+from .. import __init__
+
+from activitysim.core import inject
+from activitysim.core import pipeline
+from activitysim.abm.models.util.expressions import skim_time_period_category
+from activitysim.abm.tables import skims
+
+
+def teardown_function(func):
+    pipeline.close_open_files()
+    orca.clear_cache()
+    inject.reinject_decorated_tables()
+
+
+def setup_skims(settings):
+
+    pipeline.close_open_files()
+    orca.clear_cache()
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    orca.add_injectable("data_dir", data_dir)
+
+    output_dir = os.path.join(os.path.dirname(__file__), 'output')
+    orca.add_injectable("output_dir", output_dir)
+
+    settings.update({
+        'skims_file': 'skims.omx',
+        'skim_time_periods': {'hours': [0, 11, 16, 24], 'labels': ['AM', 'MD', 'PM']}
+    })
+    orca.add_injectable("settings", settings)
+
+
+def test_skim_cache(tmpdir):
+
+    setup_skims({})
+    skim_dict = inject.get_injectable('skim_dict')
+    pipeline.close_open_files()
+
+    # time period skims are views into a single period-major array
+    stacked_data, key2_list = skim_dict.stacks['SOV_TIME']
+    assert key2_list == ['AM', 'MD', 'PM']
+    assert stacked_data.shape == (3, 25, 25)
+    assert np.may_share_memory(skim_dict.skims[('SOV_TIME', 'MD')], stacked_data)
+
+    cache_dir = str(tmpdir.join('cache'))
+
+    # first run builds cache
+    setup_skims({'skim_cache': True, 'skim_cache_dir': cache_dir})
+    cached_skim_dict = inject.get_injectable('skim_dict')
+    pipeline.close_open_files()
+
+    assert os.path.exists(os.path.join(cache_dir, 'skim_cache.yaml'))
+
+    # second run reads cache without opening omx_file
+    setup_skims({'skim_cache': True, 'skim_cache_dir': cache_dir})
+    cached_skim_dict2 = inject.get_injectable('skim_dict')
+    assert not orca.orca._INJECTABLE_CACHE.get('omx_file')
+
+    for d in [cached_skim_dict, cached_skim_dict2]:
+        assert sorted(d.skims.keys()) == sorted(skim_dict.skims.keys())
+        for key in skim_dict.skims:
+            assert isinstance(d.skims[key], np.memmap)
+            npt.assert_array_equal(d.skims[key], skim_dict.skims[key])
+
+    orig = np.array([1, 5, 25])
+    dest = np.array([25, 5, 1])
+    npt.assert_array_equal(cached_skim_dict2.get(('SOV_TIME', 'MD')).get(orig, dest),
+                           skim_dict.get(('SOV_TIME', 'MD')).get(orig, dest))
+
+
+def test_shared_skims():
+
+    setup_skims({})
+    skim_dict = inject.get_injectable('skim_dict')
+    skim_stack = inject.get_injectable('skim_stack')
+    pipeline.close_open_files()
+
+    setup_skims({'shared_skims': True})
+    shared_skim_dict = inject.get_injectable('skim_dict')
+    shared_skim_stack = inject.get_injectable('skim_stack')
+
+    buffer, layout = inject.get_injectable('shared_skim_buffer')
+
+    assert sorted(shared_skim_dict.skims.keys()) == sorted(skim_dict.skims.keys())
+    for key in skim_dict.skims:
+        npt.assert_array_equal(shared_skim_dict.skims[key], skim_dict.skims[key])
+
+    # skim_stack uses the shared stacked skims without copying them
+    stacked_data, key2_list = shared_skim_stack.get('SOV_TIME')
+    assert stacked_data is shared_skim_dict.stacks['SOV_TIME'][0]
+    assert np.may_share_memory(stacked_data, np.frombuffer(buffer, dtype=np.int8))
+
+    orig = np.array([1, 5, 25])
+    dest = np.array([25, 5, 1])
+    period = np.array(['AM', 'PM', 'MD'])
+    npt.assert_array_equal(shared_skim_stack.lookup(orig, dest, period, 'SOV_TIME'),
+                           skim_stack.lookup(orig, dest, period, 'SOV_TIME'))
+
+
+def test_skim_time_period_category():
+
+    setup_skims({})
+    skim_stack = inject.get_injectable('skim_stack')
+
+    times = pd.Series([5, 12, 20, 9], index=[10, 11, 12, 13])
+    labels = pd.Series(['AM', 'MD', 'PM', 'AM'], index=times.index)
+
+    for periods in [times, labels]:
+        category = skim_time_period_category(periods)
+        assert is_categorical_dtype(category)
+        assert list(category.cat.categories) == ['AM', 'MD', 'PM']
+        pdt.assert_index_equal(category.index, times.index)
+        npt.assert_array_equal(category.astype(str), labels)
+
+    orig = np.array([1, 5, 25, 3])
+    dest = np.array([25, 5, 1, 7])
+    npt.assert_array_equal(skim_stack.lookup(orig, dest, category, 'SOV_TIME'),
+                           skim_stack.lookup(orig, dest, labels, 'SOV_TIME'))
+
+
+def test_prune_skims(tmpdir):
+
+    configs_dir = tmpdir.mkdir('configs')
+    configs_dir.join('spec.csv').write(
+        "Description,Expression,alt\n"
+        "walk,skims['DISTWALK'],1\n"
+        "hov,\"odt_skims[\"\"HOV2_TIME\"\"] + skim_od[('HOV3_TIME', 'AM')]\",1\n")
+    configs_dir.join('notes.txt').write("skims['DISTBIKE']\n")
+
+    assert skims.spec_skim_names(str(configs_dir)) == set(['DISTWALK', 'HOV2_TIME', 'HOV3_TIME'])
+
+    setup_skims({'prune_skims': True, 'prune_skims_keep': ['DISTBIKE']})
+    orca.add_injectable("configs_dir", str(configs_dir))
+
+    skim_dict = inject.get_injectable('skim_dict')
+
+    periods = ['AM', 'MD', 'PM']
+    expected_keys = ['DIST', 'DISTWALK', 'DISTBIKE'] + \
+        [(key1, period) for key1 in ['SOV_TIME', 'HOV2_TIME', 'HOV3_TIME'] for period in periods]
+
+    assert sorted(skim_dict.skims.keys()) == sorted(expected_keys)
+
+
+def test_skim_dtypes(tmpdir):
+
+    setup_skims({})
+    skim_dict = inject.get_injectable('skim_dict')
+    pipeline.close_open_files()
+
+    skim_dtypes = [{'skims': ['DIST*'], 'dtype': 'int32', 'scale': 0.001},
+                   {'skims': ['SOV_TIME'], 'dtype': 'float32'}]
+    cache_dir = str(tmpdir.join('cache'))
+
+    for i in range(2):
+        # second run reads cache
+        setup_skims({'skim_dtypes': skim_dtypes, 'skim_cache': True, 'skim_cache_dir': cache_dir})
+        packed_skim_dict = inject.get_injectable('skim_dict')
+        packed_skim_stack = inject.get_injectable('skim_stack')
+        pipeline.close_open_files()
+
+        assert packed_skim_dict.skims['DISTWALK'].dtype == np.int32
+        assert packed_skim_dict.stacks['SOV_TIME'][0].dtype == np.float32
+
+        orig = np.array([1, 5, 25])
+        dest = np.array([25, 5, 1])
+        npt.assert_allclose(packed_skim_dict.get('DISTWALK').get(orig, dest),
+                            skim_dict.get('DISTWALK').get(orig, dest), atol=0.0005)
+        npt.assert_allclose(
+            packed_skim_stack.lookup(orig, dest, np.array(['AM', 'MD', 'PM']), 'SOV_TIME'),
+            [skim_dict.get(('SOV_TIME', p)).get([o], [d])[0]
+             for o, d, p in zip(orig, dest, ['AM', 'MD', 'PM'])], rtol=1e-6)
@@ -0,0 +1,128 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+"""
+Broadcast evaluation of interaction specs, without materializing the cross join of choosers
+and alternatives built by logit.interaction_dataset.
+
+Expressions are evaluated against a BroadcastFrame, whose chooser columns are (n, 1) arrays
+and whose alternative columns are (1, m) arrays, so that numpy broadcasting combines them into
+(n, m) values with one row per chooser and one column per alternative. Skim lookups against a
+BroadcastFrame (see skim.SkimDictWrapper.lookup) gather (n, m) skim values by chooser origin.
+
+Memory scales with the (n, m) values of a single expression rather than with the n * m rows
+of every chooser and alternative column of the interaction dataset.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+# (n, m) arrays alive at once in broadcast evaluation, for chunk sizing
+# (utilities, probs, and the values and partial utilities of an expression)
+BROADCAST_ARRAYS = 4
+
+
+class BroadcastError(Exception):
+    """
+    An expression can't be evaluated against a BroadcastFrame (e.g. it uses a pandas method
+    that BroadcastArray doesn't implement), so the interaction dataset must be used instead
+    """
+    pass
+
+
+class BroadcastArray(np.ndarray):
+    """
+    ndarray with the few pandas Series methods used in interaction spec expressions
+    (e.g. skims['DIST'].clip(0, 1) or df['work, low'].apply(np.log1p))
+    """
+
+    @property
+    def values(self):
+        return self.view(np.ndarray)
+
+    def apply(self, func):
+        return func(self)
+
+    def clip(self, lower=None, upper=None, *args, **kwargs):
+        # pandas argument semantics (clip(1) is clip(lower=1)) rather than ndarray.clip
+        result = self
+        if lower is not None:
+            result = np.maximum(result, lower)
+        if upper is not None:
+            result = np.minimum(result, upper)
+        return result
+
+    def fillna(self, value):
+        return np.where(pd.isnull(self), value, self).view(BroadcastArray)
+
+    def isin(self, values):
+        return np.in1d(self, list(values)).reshape(self.shape).view(BroadcastArray)
+
+
+def broadcast_column(values, axis):
+    """
+    values (1D) as a BroadcastArray of shape (n, 1) if axis is 0 or (1, m) if axis is 1
+    """
+    values = np.asanyarray(values)
+    shape = (len(values), 1) if axis == 0 else (1, len(values))
+    return values.reshape(shape).view(BroadcastArray)
+
+
+class BroadcastFrame(object):
+    """
+    Lazy stand-in for the interaction dataset of choosers and alternatives (with every
+    chooser interacted with every alternative) for broadcast evaluation of interaction specs.
+
+    Columns are named as in logit.interaction_dataset (chooser columns that are also
+    alternative columns have an '_r' suffix), chooser columns are (n, 1) BroadcastArrays and
+    alternative columns are (1, m) BroadcastArrays.
+
+    Parameters
+    ----------
+    choosers : pandas.DataFrame
+    alternatives : pandas.DataFrame
+    """
+
+    def __init__(self, choosers, alternatives):
+        self.choosers = choosers
+        self.alternatives = alternatives
+
+        # chooser column of each (renamed) chooser column name
+        self.chooser_columns = {}
+        for c in choosers.columns:
+            c_alts = ('%s_r' % c) if c in alternatives.columns else c
+            self.chooser_columns[c_alts] = c
+
+        self.columns = list(alternatives.columns) + \
+            [c for c in self.chooser_columns if c not in alternatives.columns]
+
+    @property
+    def shape(self):
+        return len(self.choosers.index), len(self.alternatives.index)
+
+    def __getitem__(self, name):
+
+        if name in self.chooser_columns:
+            return broadcast_column(self.choosers[self.chooser_columns[name]].values, axis=0)
+
+        if name in self.alternatives.columns:
+            return broadcast_column(self.alternatives[name].values, axis=1)
+
+        raise KeyError(name)
+
+    def __getattr__(self, name):
+        if name in ('choosers', 'alternatives', 'chooser_columns', 'columns'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def eval(self, expr):
+        raise RuntimeError("BroadcastFrame can't evaluate expression '%s' with DataFrame.eval"
+                           % expr)
@@ -1,9 +1,12 @@
 # ActivitySim
 # See full license in LICENSE.txt.
 
+from collections import deque
 from math import ceil
 import os
 import logging
+import threading
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
@@ -12,10 +15,112 @@ from .skim import SkimDictWrapper, SkimStackWrapper
 from . import logit
 from . import tracing
 from . import pipeline
+from . import inject
 from . import util
 
 logger = logging.getLogger(__name__)
 
+# chunk_size and row_size are in doubles
+BYTES_PER_ELEMENT = 8
+
+
+class ChunkHistory(object):
+    """
+    Peak bytes per chooser row measured for each chunked call site (keyed by trace_label)
+
+    Measurements are persisted to the chunk_history_path file, so that later runs can size
+    their chunks from the first chunk.
+    """
+    def __init__(self, path=None):
+
+        self.path = path
+        self.bytes_per_row = {}
+
+        # trace_labels measured in this run (replacing any measurement by a previous run)
+        self.measured = set()
+
+        if path and os.path.isfile(path):
+            df = pd.read_csv(path, index_col='trace_label')
+            self.bytes_per_row = df.bytes_per_row.to_dict()
+            logger.info("loaded chunk history for %s call sites from %s" % (len(df.index), path))
+
+    def row_size(self, trace_label):
+        """
+        measured row_size (in doubles) for trace_label or None if not measured
+        """
+        bytes_per_row = self.bytes_per_row.get(trace_label, None)
+        return bytes_per_row / float(BYTES_PER_ELEMENT) if bytes_per_row else None
+
+    def update(self, trace_label, bytes_per_row):
+
+        if trace_label in self.measured:
+            bytes_per_row = max(bytes_per_row, self.bytes_per_row[trace_label])
+
+        self.measured.add(trace_label)
+        self.bytes_per_row[trace_label] = bytes_per_row
+
+    def save(self):
+
+        if not self.path:
+            return
+
+        df = pd.DataFrame({'bytes_per_row': pd.Series(self.bytes_per_row)})
+        df.index.name = 'trace_label'
+
+        # write and rename so concurrent runs (e.g. household shards) never read a partial file
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        df.to_csv(tmp_path)
+        if os.name == 'nt' and os.path.isfile(self.path):
+            os.unlink(self.path)
+        os.rename(tmp_path, self.path)
+
+
+_HISTORY = ChunkHistory()
+
+
+class ChunkMeasurement(object):
+    """
+    Peak bytes used by a chunk, sampled by log_chunk_size while the chunk is running
+    """
+    def __init__(self):
+        self.rss = util.rss()
+        self.peak = 0
+        self.logged = False
+
+    def sample(self, bytes):
+        self.peak = max(self.peak, bytes, util.rss() - self.rss)
+        self.logged = True
+
+
+# measurements of the chunks currently running on each thread (innermost last)
+_MEASUREMENTS = threading.local()
+
+
+def current_measurements():
+    if not hasattr(_MEASUREMENTS, 'stack'):
+        _MEASUREMENTS.stack = []
+    return _MEASUREMENTS.stack
+
+
+def adaptive_chunking():
+    """
+    size chunks from measured bytes per row (adaptive_chunking setting)
+    """
+    return bool(inject.get_injectable('adaptive_chunking', False))
+
+
+def chunk_history():
+    """
+    ChunkHistory for the current chunk_history_path (loaded on first use)
+    """
+    global _HISTORY
+
+    path = inject.get_injectable('chunk_history_path', None)
+    if path != _HISTORY.path:
+        _HISTORY = ChunkHistory(path)
+
+    return _HISTORY
+
 
 def log_df_size(trace_label, table_name, df, cum_size):
 
@@ -46,9 +151,20 @@ def log_chunk_size(trace_label, cum):
     logger.debug("%s #chunk CUM %s %s" % (trace_label, elements, util.GB(bytes)))
     logger.debug("%s %s" % (trace_label, util.memory_info()))
 
+    for measurement in current_measurements():
+        measurement.sample(bytes)
+
 
 def rows_per_chunk(chunk_size, row_size, num_choosers, trace_label):
 
+    # if adaptive, use row_size measured by this (or a previous) run if available
+    if adaptive_chunking():
+        measured_row_size = chunk_history().row_size(trace_label)
+        if measured_row_size:
+            logger.debug("%s #chunk_calc estimated row_size %s measured row_size %s" %
+                         (trace_label, row_size, measured_row_size))
+            row_size = measured_row_size
+
     # closest number of chooser rows to achieve chunk_size
     rpc = int(round(chunk_size / float(row_size)))
     rpc = max(rpc, 1)
@@ -68,19 +184,282 @@ def rows_per_chunk(chunk_size, row_size, num_choosers, trace_label):
     return rpc
 
 
-def chunked_choosers(choosers, rows_per_chunk):
-    # generator to iterate over choosers in chunk_size chunks
-    num_choosers = len(choosers.index)
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
+def measured_rows_per_chunk(chunk_size, num_choosers, trace_label):
+    """
+    rows_per_chunk based on the row_size measured for trace_label
+    """
+    return rows_per_chunk(chunk_size, chunk_history().row_size(trace_label), num_choosers,
+                          trace_label)
+
+
+def get_num_threads():
+    """
+    number of threads on which to run chunks concurrently (num_threads setting)
+    """
+    return max(int(inject.get_injectable('num_threads', 1) or 1), 1)
+
+
+def thread_chunk_size(chunk_size, num_threads):
+    """
+    chunk_size budget for each of num_threads concurrently running chunks
+    """
+    return max(chunk_size // num_threads, 1) if chunk_size else 0
+
+
+def thread_rows_per_chunk(rows_per_chunk, num_choosers, num_threads):
+    """
+    rows_per_chunk reduced (if necessary) so there is a chunk for each of num_threads threads
+    """
+    return max(min(rows_per_chunk, int(ceil(num_choosers / float(num_threads)))), 1)
+
+
+def map_chunks(func, chunks, num_threads):
+    """
+    Call func with each of chunks, concurrently on a pool of num_threads threads if num_threads > 1
+
+    Since each chunk draws random numbers from the random channels of its own rows,
+    results are the same whether chunks are run in order or concurrently.
+
+    Chunks are taken from chunks only as threads are free to run them, so (as with chunked
+    choosers run in order) at most num_threads chunk slices of the choosers are alive at once.
+
+    Parameters
+    ----------
+    func : callable
+        called with the items of each chunk tuple as arguments
+    chunks : iterable of tuples
+        e.g. chunked_choosers generator
+    num_threads : int
+
+    Returns
+    -------
+    results : list
+        result of func for each chunk, in chunk order
+    """
+
+    if num_threads <= 1:
+        return [func(*c) for c in chunks]
+
+    chunks = iter(chunks)
+    results = []
+    running = deque()
+
+    pool = ThreadPool(num_threads)
+    try:
+        while True:
+            # wait for the oldest chunk before taking another if all threads are busy
+            if len(running) >= num_threads:
+                results.append(running.popleft().get())
+            c = next(chunks, None)
+            if c is None:
+                break
+            running.append(pool.apply_async(func, c))
+
+        results.extend(r.get() for r in running)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def thread_skims(skims, locals_d):
+    """
+    Copies of skim wrappers for a chunk run concurrently with other chunks
+
+    Skim wrappers hold the df set by set_df (and memoized lookups for it), so concurrently
+    running chunks each need their own copy. Returns copies of skims and of locals_d with any
+    skim wrappers in skims replaced by their copies.
+    """
+
+    if not skims:
+        return skims, locals_d
+
+    skim_list = skims if isinstance(skims, list) else [skims]
+    copies = {id(skim): skim.copy() for skim in skim_list}
+
+    if locals_d is not None:
+        locals_d = {k: copies.get(id(v), v) for k, v in locals_d.iteritems()}
+
+    if isinstance(skims, list):
+        return [copies[id(skim)] for skim in skims], locals_d
+
+    return copies[id(skims)], locals_d
+
+
+def rss_ceiling():
+    """
+    process RSS in bytes above which the chunk governor splits chunks (rss_ceiling setting)
+    """
+    return int(inject.get_injectable('rss_ceiling', 0) or 0)
+
+
+# chunks split by the governor
+_GOVERNOR_EVENTS = []
+
+
+def governor_events():
+    """
+    list of dicts describing each chunk split by the chunk governor (see governed_rows)
+    """
+    return _GOVERNOR_EVENTS
+
+
+def governed_rows(rows, row_bytes, ceiling, trace_label):
+    """
+    Bisect a chunk until its predicted memory use will not push process RSS over ceiling
+
+    Parameters
+    ----------
+    rows : int
+        number of choosers in chunk
+    row_bytes : callable
+        predicted peak bytes for the first n choosers in chunk, row_bytes(n)
+    ceiling : int
+        process RSS ceiling in bytes
+    trace_label : str
+
+    Returns
+    -------
+    rows : int
+        number of choosers to run in chunk (the rest are left for subsequent chunks)
+    """
+
+    rss = util.rss()
+
+    governed = rows
+    while governed > 1 and rss + row_bytes(governed) > ceiling:
+        governed = (governed + 1) // 2
+
+    if governed < rows:
+        event = {'trace_label': trace_label, 'rows': rows, 'governed_rows': governed,
+                 'rss': rss, 'predicted_bytes': row_bytes(rows)}
+        _GOVERNOR_EVENTS.append(event)
+        logger.warn("%s chunk governor split chunk of %s rows to %s rows "
+                    "(rss %s predicted %s ceiling %s)" %
+                    (trace_label, rows, governed,
+                     util.GB(rss), util.GB(row_bytes(rows)), util.GB(ceiling)))
+
+    return governed
+
+
+def chunk_ranges(num_choosers, rows_per_chunk, chunk_size=0, trace_label=None, row_counts=None):
+    """
+    generator to iterate over ranges of num_choosers in chunks of rows_per_chunk
+
+    If adaptive_chunking and chunk_size > 0, the peak bytes used by each chunk are measured
+    while it runs (if it is run before the next range is requested) and rows_per_chunk for
+    the remaining chunks is recalculated from the measured bytes per row, which are saved
+    to the chunk history for trace_label.
+
+    If rss_ceiling is set, the chunk governor bisects any chunk whose predicted peak bytes
+    (from the bytes per row measured for previous chunks, or estimated from chunk_size and
+    rows_per_chunk before any are measured) would push process RSS over the ceiling, and the
+    rest of the chunk is left for subsequent chunks. Since random numbers are drawn per row,
+    splitting chunks does not change results.
+
+    Parameters
+    ----------
+    num_choosers : int
+    rows_per_chunk : int
+    chunk_size : int
+    trace_label : str
+    row_counts : numpy array or None
+        number of table rows for each chooser (e.g. persons per chunk_id) used by the chunk
+        governor to predict chunk size (or None if one row per chooser)
+
+    Yields
+    -------
+    i : int
+        one-based index of current chunk
+    num_chunks : int
+        total number of chunks (as currently estimated)
+    offset : int
+        first chooser in chunk
+    rows : int
+        number of choosers in chunk
+    """
+
+    adaptive = chunk_size > 0 and trace_label and adaptive_chunking()
+    measured = False
+
+    ceiling = rss_ceiling()
+
+    # cumulative table rows, so rows from offset to offset+n are cum_rows[offset+n]-cum_rows[offset]
+    cum_rows = np.append([0], np.cumsum(row_counts)) if row_counts is not None \
+        else np.arange(num_choosers + 1)
+
+    # bytes per table row, estimated until chunks have been measured
+    bytes_per_row = None
+    if chunk_size > 0 and rows_per_chunk < num_choosers:
+        bytes_per_row = chunk_size * BYTES_PER_ELEMENT / \
+            float(max(cum_rows[rows_per_chunk] - cum_rows[0], 1))
+    elif ceiling and trace_label and row_counts is None:
+        # not chunking, but a previous run may have measured bytes per chooser
+        bytes_per_row = chunk_history().bytes_per_row.get(trace_label, None)
 
     i = offset = 0
     while offset < num_choosers:
-        yield i+1, num_chunks, choosers.iloc[offset: offset+rows_per_chunk]
-        offset += rows_per_chunk
+
+        rows = min(rows_per_chunk, num_choosers - offset)
+
+        if ceiling and bytes_per_row:
+            rows = governed_rows(
+                rows, lambda n: (cum_rows[offset + n] - cum_rows[offset]) * bytes_per_row,
+                ceiling, trace_label)
+
+        num_chunks = i + int(ceil((num_choosers - offset) / float(rows)))
+
+        if adaptive or ceiling:
+            measurement = ChunkMeasurement()
+            current_measurements().append(measurement)
+            try:
+                yield i+1, num_chunks, offset, rows
+            finally:
+                current_measurements().remove(measurement)
+
+            # chunks run concurrently are never measured as they are not run in this thread
+            if measurement.logged and measurement.peak > 0:
+
+                table_rows = cum_rows[offset + rows] - cum_rows[offset]
+                bytes_per_row = measurement.peak / float(max(table_rows, 1))
+
+                if ceiling and measurement.rss + measurement.peak > ceiling:
+                    logger.warn("%s chunk of %s rows exceeded rss ceiling (rss %s peak %s)" %
+                                (trace_label, rows,
+                                 util.GB(measurement.rss), util.GB(measurement.peak)))
+
+            if adaptive and measurement.logged and measurement.peak > 0:
+                chunk_history().update(trace_label, measurement.peak / float(rows))
+                measured = True
+
+                if offset + rows < num_choosers:
+                    rows_per_chunk = \
+                        measured_rows_per_chunk(chunk_size, num_choosers - offset - rows,
+                                                trace_label)
+        else:
+            yield i+1, num_chunks, offset, rows
+
+        offset += rows
         i += 1
 
+    if measured:
+        chunk_history().save()
+
+
+def chunked_choosers(choosers, rows_per_chunk, chunk_size=0, trace_label=None):
+    # generator to iterate over choosers in chunk_size chunks
+    # (see chunk_ranges for adaptive rows_per_chunk)
+
+    num_choosers = len(choosers.index)
+
+    for i, num_chunks, offset, rows \
+            in chunk_ranges(num_choosers, rows_per_chunk, chunk_size, trace_label):
+        yield i, num_chunks, choosers.iloc[offset: offset + rows]
+
 
-def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
+def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk,
+                              chunk_size=0, trace_label=None):
     """
     generator to iterate over choosers and alternatives in chunk_size chunks
 
@@ -93,7 +472,8 @@ def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
 
     When we chunk the choosers, we need to take care chunking the alternatives as there are
     varying numbers of them for each chooser. Since alternatives appear in the same order
-    as choosers, we can use cumulative pick_counts to identify boundaries of sets of alternatives
+    as choosers, we can use the positions at which the alternatives index changes to identify
+    boundaries of sets of alternatives
 
     Parameters
     ----------
@@ -101,6 +481,9 @@ def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
     alternatives : pandas DataFrame
         sample alternatives including pick_count column in same order as choosers
     rows_per_chunk : int
+    chunk_size : int
+        chunk_size for adaptive rows_per_chunk (see chunk_ranges)
+    trace_label : str
 
     Yields
     -------
@@ -117,16 +500,14 @@ def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
     assert 'pick_count' in alternatives.columns or choosers.index.name == alternatives.index.name
 
     num_choosers = len(choosers.index)
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
 
     if choosers.index.name == alternatives.index.name:
         assert choosers.index.name == alternatives.index.name
 
         # alt chunks boundaries are where index changes
         alt_ids = alternatives.index.values
-        alt_chunk_end = np.where(alt_ids[:-1] != alt_ids[1:])[0] + 1
-        alt_chunk_end = np.append([0], alt_chunk_end)  # including the first...
-        alt_chunk_end = alt_chunk_end[rows_per_chunk::rows_per_chunk]
+        alt_chooser_start = np.where(alt_ids[:-1] != alt_ids[1:])[0] + 1
+        alt_chooser_start = np.append([0], alt_chooser_start)  # including the first...
 
     else:
         # used to do it this way for school and workplace (which are sampled based on prob)
@@ -150,26 +531,25 @@ def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
         # alt_chunk_end = np.where(alternatives['cum_pick_count'] % alt_chunk_size == 0)[0] + 1
 
     # add index to end of array to capture any final partial chunk
-    alt_chunk_end = np.append(alt_chunk_end, [len(alternatives.index)])
+    alt_chooser_start = np.append(alt_chooser_start, [len(alternatives.index)])
 
-    i = offset = alt_offset = 0
-    while offset < num_choosers:
+    # number of alternatives for each chooser
+    alt_counts = np.diff(alt_chooser_start)
 
-        alt_end = alt_chunk_end[i]
+    for i, num_chunks, offset, rows \
+            in chunk_ranges(num_choosers, rows_per_chunk, chunk_size, trace_label,
+                            row_counts=alt_counts):
 
-        chooser_chunk = choosers[offset: offset + rows_per_chunk]
-        alternative_chunk = alternatives[alt_offset: alt_end]
+        chooser_chunk = choosers[offset: offset + rows]
+        alternative_chunk = \
+            alternatives[alt_chooser_start[offset]: alt_chooser_start[offset + rows]]
 
         assert len(chooser_chunk.index) == len(np.unique(alternative_chunk.index.values))
 
-        yield i+1, num_chunks, chooser_chunk, alternative_chunk
-
-        i += 1
-        offset += rows_per_chunk
-        alt_offset = alt_end
+        yield i, num_chunks, chooser_chunk, alternative_chunk
 
 
-def hh_chunked_choosers(choosers, rows_per_chunk):
+def hh_chunked_choosers(choosers, rows_per_chunk, chunk_size=0, trace_label=None):
     # generator to iterate over choosers in chunk_size chunks
     # like chunked_choosers but based on chunk_id field rather than dataframe length
     # (the presumption is that choosers has multiple rows with the same chunk_id that
@@ -177,11 +557,12 @@ def hh_chunked_choosers(choosers, rows_per_chunk):
     # FIXME - we pathologically know name of chunk_id col in households table
 
     num_choosers = choosers['chunk_id'].max() + 1
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
 
-    i = offset = 0
-    while offset < num_choosers:
-        chooser_chunk = choosers[choosers['chunk_id'].between(offset, offset + rows_per_chunk - 1)]
-        yield i+1, num_chunks, chooser_chunk
-        offset += rows_per_chunk
-        i += 1
+    # number of choosers with each chunk_id
+    chunk_id_counts = np.bincount(choosers['chunk_id'].values, minlength=num_choosers)
+
+    for i, num_chunks, offset, rows \
+            in chunk_ranges(num_choosers, rows_per_chunk, chunk_size, trace_label,
+                            row_counts=chunk_id_counts):
+        chooser_chunk = choosers[choosers['chunk_id'].between(offset, offset + rows - 1)]
+        yield i, num_chunks, chooser_chunk
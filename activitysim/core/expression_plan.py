@@ -0,0 +1,204 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+"""
+Spec expressions are parsed once into an ExpressionPlan that is cached by expression list,
+and reused for every chunk (and segment) evaluated with the same spec.
+
+Python expressions (beginning with @) are compiled to code objects.
+
+Simple (DataFrame.eval) expressions that only combine df columns and literals with
+arithmetic, comparison and boolean operators are rewritten with the same semantics as the
+pandas expression parser (& and | have the precedence of 'and' and 'or', 'and', 'or' and 'not'
+are elementwise, and chained comparisons are and-ed) and compiled to code objects that are
+evaluated against the df columns they reference. Arithmetic on the columns is still done by
+pandas (which uses numexpr for large arrays). Other simple expressions fall back to df.eval.
+"""
+
+import __future__
+import ast
+import logging
+import tokenize
+
+from StringIO import StringIO
+
+logger = logging.getLogger(__name__)
+
+
+PYTHON = 'python'
+COLUMNS = 'columns'
+DF_EVAL = 'df_eval'
+
+# node types allowed in simple expressions compiled for evaluation against df columns
+SIMPLE_EXPRESSION_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare,
+    ast.Name, ast.Num, ast.Str, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.BitAnd, ast.BitOr, ast.BitXor,
+    ast.UAdd, ast.USub, ast.Invert, ast.Not, ast.And, ast.Or,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+# names that are not df columns
+SIMPLE_EXPRESSION_CONSTANTS = ['True', 'False']
+
+_EXPRESSION_PLANS = {}
+
+
+def replace_booleans(expr):
+    """
+    replace & and | operators with 'and' and 'or' as the pandas expression parser does
+    (so that they have the precedence of 'and' and 'or' rather than of bitwise operators)
+    """
+
+    tokens = []
+    for toknum, tokval, _, _, _ in tokenize.generate_tokens(StringIO(expr).readline):
+        if toknum == tokenize.OP and tokval == '&':
+            toknum, tokval = tokenize.NAME, 'and'
+        elif toknum == tokenize.OP and tokval == '|':
+            toknum, tokval = tokenize.NAME, 'or'
+        tokens.append((toknum, tokval))
+
+    return tokenize.untokenize(tokens)
+
+
+class ElementwiseBooleans(ast.NodeTransformer):
+    """
+    rewrite 'and', 'or', 'not' and chained comparisons as elementwise (bitwise) operators
+    """
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        return reduce(lambda left, right: ast.copy_location(ast.BinOp(left, op, right), node),
+                      node.values)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            node.op = ast.Invert()
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        lefts = [node.left] + node.comparators[:-1]
+        compares = [ast.copy_location(ast.Compare(left, [op], [right]), node)
+                    for left, op, right in zip(lefts, node.ops, node.comparators)]
+        return reduce(lambda left, right: ast.copy_location(ast.BinOp(left, ast.BitAnd(), right),
+                                                            node),
+                      compares)
+
+
+def compile_simple_expression(expr):
+    """
+    Compile simple (DataFrame.eval) expression for evaluation against df columns
+
+    Returns
+    -------
+    code : code object or None
+        None if expr can't be compiled (and so should be evaluated with df.eval)
+    names : list of str
+        names of df columns referenced by expr
+    """
+
+    try:
+        tree = ast.parse(replace_booleans(expr).strip(), mode='eval')
+    except (SyntaxError, tokenize.TokenError):
+        return None, None
+
+    nodes = list(ast.walk(tree))
+    if not all(isinstance(node, SIMPLE_EXPRESSION_NODES) for node in nodes):
+        return None, None
+
+    names = sorted(set(node.id for node in nodes if isinstance(node, ast.Name))
+                   - set(SIMPLE_EXPRESSION_CONSTANTS))
+
+    tree = ast.fix_missing_locations(ElementwiseBooleans().visit(tree))
+
+    # DataFrame.eval always uses true division
+    code = compile(tree, '<expression %s>' % expr, 'eval',
+                   __future__.division.compiler_flag, True)
+
+    return code, names
+
+
+class ExpressionPlan(object):
+    """
+    Expressions from a spec, each parsed and compiled once
+
+    Parameters
+    ----------
+    exprs : sequence of str
+    """
+
+    def __init__(self, exprs):
+
+        self.exprs = list(exprs)
+        self.kinds = []
+        self.codes = []
+        self.names = []
+
+        for expr in self.exprs:
+            if expr.startswith('@'):
+                # compiled without inheriting this module's __future__ flags, as eval would
+                try:
+                    code = compile(expr[1:], '<expression %s>' % expr, 'eval', 0, True)
+                except Exception:
+                    logger.exception("Variable evaluation failed for: %s" % str(expr))
+                    raise
+                kind, names = PYTHON, None
+            else:
+                code, names = compile_simple_expression(expr)
+                kind = COLUMNS if code is not None else DF_EVAL
+
+            self.kinds.append(kind)
+            self.codes.append(code)
+            self.names.append(names)
+
+        logger.debug("ExpressionPlan compiled %s of %s simple expressions" %
+                     (self.kinds.count(COLUMNS), len(self.exprs) - self.kinds.count(PYTHON)))
+
+    def __len__(self):
+        return len(self.exprs)
+
+    def evaluate(self, i, df, globals_d, locals_d):
+        """
+        Evaluate the i'th expression in the context of df
+
+        Python expressions are evaluated with globals_d and locals_d, and simple expressions
+        against the columns of df.
+
+        Returns
+        -------
+        values : pandas.Series, numpy array or scalar
+        """
+
+        kind, code, names = self.kinds[i], self.codes[i], self.names[i]
+
+        if kind == PYTHON:
+            return eval(code, globals_d, locals_d)
+
+        if kind == COLUMNS and all(name in df.columns for name in names):
+            return eval(code, {}, {name: df[name] for name in names})
+
+        # names that aren't columns (e.g. index names) are resolved by df.eval
+        return df.eval(self.exprs[i])
+
+
+def expression_plan(exprs):
+    """
+    Get the (cached) ExpressionPlan for the list of spec expressions exprs
+
+    Plans are cached by the expressions themselves (rather than the identity of the spec
+    they come from) so a plan is reused by every chunk and segment evaluated with a spec.
+    """
+
+    key = tuple(exprs)
+
+    plan = _EXPRESSION_PLANS.get(key)
+    if plan is None:
+        plan = _EXPRESSION_PLANS[key] = ExpressionPlan(key)
+
+    return plan
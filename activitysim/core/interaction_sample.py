@@ -16,6 +16,9 @@ from .simulate import add_skims
 
 
 from .interaction_simulate import eval_interaction_utilities
+from .interaction_simulate import broadcast_utilities
+from .interaction_simulate import interaction_broadcast, can_broadcast
+from .broadcast import BROADCAST_ARRAYS
 import pipeline
 
 logger = logging.getLogger(__name__)
@@ -23,19 +26,116 @@ logger = logging.getLogger(__name__)
 DUMP = False
 
 
+def pick_counts(keys):
+    """
+    First occurrence and number of occurrences of each distinct value of keys
+
+    A sort-based reduction (stable argsort of keys and run lengths of the sorted keys)
+    rather than a pandas groupby.
+
+    Parameters
+    ----------
+    keys : 1-D numpy.ndarray of int
+
+    Returns
+    -------
+    first : 1-D numpy.ndarray of int
+        position in keys of the first occurrence of each distinct key, in order of occurrence
+    counts : 1-D numpy.ndarray of int
+        number of occurrences of the key at each position in first
+    """
+
+    # stable, so the first of each run of equal sorted keys is its first occurrence
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+
+    first = order[starts]
+
+    # back in order of occurrence
+    in_order = np.argsort(first)
+
+    return first[in_order], counts[in_order]
+
+
+def sample_positions(cum_probs_arr, rands):
+    """
+    Position of the alternative chosen by each rand, with a row-wise searchsorted of all the
+    rands in one pass (rather than one pass over cum_probs_arr per sample)
+
+    Each chooser's cum_probs are clipped to end at exactly 1.0 from its last alternative with
+    a nonzero probability, so rands (in [0, 1)) never pick a trailing zero probability
+    alternative, even if the chooser's probabilities sum to slightly more or less than 1.
+
+    Offsetting each chooser's cum_probs (and rands) by twice the chooser's row number then makes
+    the flattened cum_probs ascending, so a single searchsorted finds the first alternative with
+    a cum_prob greater than each rand. Adding the offsets rounds values by up to row * eps, so
+    the few positions that rounding moves are then corrected against the exact cum_probs.
+
+    Parameters
+    ----------
+    cum_probs_arr : 2-D numpy.ndarray
+        cumulative probabilities with one row per chooser and one column per alternative
+        (clipped in place)
+    rands : 2-D numpy.ndarray
+        rands with one row per chooser and one column per sample
+
+    Returns
+    -------
+    positions : 2-D numpy.ndarray of int
+        same shape as rands, column index in cum_probs_arr of the chosen alternative
+    """
+
+    chooser_count, alternative_count = cum_probs_arr.shape
+
+    # last alternative with a nonzero probability in each row
+    steps = np.empty(cum_probs_arr.shape, dtype=bool)
+    steps[:, 0] = cum_probs_arr[:, 0] > 0
+    np.greater(cum_probs_arr[:, 1:], cum_probs_arr[:, :-1], out=steps[:, 1:])
+    last = alternative_count - 1 - np.argmax(steps[:, ::-1], axis=1)
+    del steps
+
+    np.minimum(cum_probs_arr, 1.0, out=cum_probs_arr)
+    cum_probs_arr[np.arange(alternative_count) >= last[:, np.newaxis]] = 1.0
+
+    row_offsets = np.arange(chooser_count)[:, np.newaxis]
+    positions = np.searchsorted((cum_probs_arr + 2 * row_offsets).ravel(),
+                                (rands + 2 * row_offsets).ravel(),
+                                side='right').reshape(rands.shape)
+    positions -= row_offsets * alternative_count
+    np.minimum(positions, last[:, np.newaxis], out=positions)
+
+    # correct positions moved by rounding so that cum_probs[p - 1] <= rand < cum_probs[p]
+    flat_cum_probs = cum_probs_arr.ravel()
+    row_starts = row_offsets * alternative_count
+    while True:
+        left = positions > 0
+        left[left] = rands[left] < flat_cum_probs[(row_starts + positions - 1)[left]]
+        right = rands >= flat_cum_probs[row_starts + positions]
+        if not (left.any() or right.any()):
+            break
+        positions[left] -= 1
+        positions[right] += 1
+
+    return positions
+
+
 def make_sample_choices(
-        choosers, probs, interaction_utilities,
+        choosers, probs, alternatives,
         sample_size, alternative_count, alt_col_name,
         trace_label):
     """
+    Sample sample_size alternatives (with replacement) for each chooser
 
     Parameters
     ----------
     choosers
     probs : pandas DataFrame
         one row per chooser and one column per alternative
-    interaction_utilities
-        dataframe  with len(interaction_df) rows and one utility column
+    alternatives : pandas.DataFrame
+        alternatives, in the order of the probs columns
     sample_size : int
         number of samples/choices to make
     alternative_count
@@ -44,14 +144,16 @@ def make_sample_choices(
 
     Returns
     -------
-
+    choices_df : pandas.DataFrame
+        one row per distinct chooser and sampled alternative (in order of first pick)
+        with columns alt_col_name, prob, rand, choosers.index.name and pick_count
+        (the number of times the chooser picked the alternative)
     """
 
     assert isinstance(probs, pd.DataFrame)
     assert probs.shape == (len(choosers), alternative_count)
 
-    assert isinstance(interaction_utilities, pd.DataFrame)
-    assert interaction_utilities.shape == (len(choosers)*alternative_count, 1)
+    assert len(alternatives.index) == alternative_count
 
     t0 = tracing.print_elapsed_time()
 
@@ -70,64 +172,38 @@ def make_sample_choices(
 
     t0 = tracing.print_elapsed_time("make_choices bad_probs", t0, debug=True)
 
-    cum_probs_arr = probs.as_matrix().cumsum(axis=1)
+    probs_arr = probs.as_matrix()
+    cum_probs_arr = probs_arr.cumsum(axis=1)
     t0 = tracing.print_elapsed_time("make_choices cum_probs_arr", t0, debug=True)
 
-    # alt probs in convenient layout to return prob of chose alternative
-    # (same layout as cum_probs_arr and interaction_utilities)
-    alt_probs_array = probs.as_matrix().flatten()
-
-    # get sample_size rands for each chooser
-    # transform as we iterate over alternatives
-    # reshape so rands[i] is in broadcastable (2-D) shape for cum_probs_arr
-    # i.e rands[i] is a 2-D array of one alt choice rand for each chooser
+    # get sample_size rands for each chooser (one row of rands per chooser)
     rands = pipeline.get_rn_generator().random_for_df(probs, n=sample_size)
-    rands = rands.T.reshape(sample_size, -1, 1)
     t0 = tracing.print_elapsed_time("make_choices random_for_df", t0, debug=True)
 
-    # the alternative value chosen
-    choices_array = np.empty([sample_size, len(choosers)]).astype(int)
-
-    # the probability of the chosen alternative
-    choice_probs_array = np.empty([sample_size, len(choosers)])
-
-    # FIXME - do this all at once rather than iterate?
-    for i in range(sample_size):
-
-        # FIXME - do this in numpy, not pandas?
-
-        # rands for this alt in broadcastable shape
-        r = rands[i]
-
-        # position of first occurrence of positive value
-        positions = np.argmax(cum_probs_arr > r, axis=1)
-
-        # FIXME - leave positions as numpy array, not pandas series?
-
-        # positions is series with the chosen alternative represented as a column index in probs
-        # which is an integer between zero and num alternatives in the alternative sample
-        positions = pd.Series(positions, index=probs.index)
-
-        # need to get from an integer offset into the alternative sample to the alternative index
-        # that is, we want the index value of the row that is offset by <position> rows into the
-        # tranche of this choosers alternatives created by cross join of alternatives and choosers
+    # position of the chosen alternative for each rand (a column index in probs)
+    positions = sample_positions(cum_probs_arr, rands)
 
-        # offsets is the offset into model_design df of first row of chooser alternatives
-        offsets = np.arange(len(positions)) * alternative_count
+    t0 = tracing.print_elapsed_time("make_choices searchsorted", t0, debug=True)
 
-        # resulting pandas Int64Index has one element per chooser and is in same order as choosers
-        choices_array[i] = interaction_utilities.index.take(positions + offsets)
+    # pick_count is number of duplicate picks, and all but the first of duplicates are dropped
+    row_offsets = np.arange(len(choosers))[:, np.newaxis]
+    first, pick_count = pick_counts((positions + row_offsets * alternative_count).ravel())
 
-        choice_probs_array[i] = np.take(alt_probs_array, positions + offsets)
+    positions = positions.ravel()[first]
+    chooser_rows = first // sample_size
 
     # explode to one row per chooser.index, alt_TAZ
     choices_df = pd.DataFrame(
-        {alt_col_name: choices_array.flatten(order='F'),
-         'rand': rands.flatten(order='F'),
-         'prob': choice_probs_array.flatten(order='F'),
-         choosers.index.name: np.repeat(np.asanyarray(choosers.index), sample_size)
+        {alt_col_name: alternatives.index.values.take(positions),
+         'rand': rands.ravel()[first],
+         'prob': probs_arr[chooser_rows, positions],
+         choosers.index.name: choosers.index.values.take(chooser_rows)
          })
 
+    choices_df['pick_count'] = pick_count
+
+    t0 = tracing.print_elapsed_time("make_choices pick_counts", t0, debug=True)
+
     return choices_df
 
 
@@ -205,65 +281,78 @@ def _interaction_sample(
     if len(spec.columns) > 1:
         raise RuntimeError('spec must have only one column')
 
-    # if using skims, copy index into the dataframe, so it will be
-    # available as the "destination" for the skims dereference below
-    if skims:
-        alternatives[alternatives.index.name] = alternatives.index
-
-    # cross join choosers and alternatives (cartesian product)
-    # for every chooser, there will be a row for each alternative
-    # index values (non-unique) are from alternatives df
     alternative_count = alternatives.shape[0]
-    interaction_df = \
-        logit.interaction_dataset(choosers, alternatives, sample_size=alternative_count)
 
-    cum_size = chunk.log_df_size(trace_label, 'interaction_df', interaction_df, cum_size=None)
+    # evaluate the spec against a BroadcastFrame rather than the cross join
+    # (the interaction dataset is needed to trace interaction rows)
+    broadcast = interaction_broadcast() and not have_trace_targets and \
+        can_broadcast(spec, choosers, alternatives, skims)
 
-    assert alternative_count == len(interaction_df.index) / len(choosers.index)
+    if broadcast:
+        utilities = \
+            broadcast_utilities(spec, choosers, alternatives, skims, locals_d, trace_label)
+        broadcast = utilities is not None
 
-    if skims:
-        add_skims(interaction_df, skims)
+    if broadcast:
 
-    # evaluate expressions from the spec multiply by coefficients and sum
-    # spec is df with one row per spec expression and one col with utility coefficient
-    # column names of interaction_df match spec index values
-    # utilities has utility value for element in the cross product of choosers and alternatives
-    # interaction_utilities is a df with one utility column and one row per row in interaction_df
-    if have_trace_targets:
-        trace_rows, trace_ids \
-            = tracing.interaction_trace_rows(interaction_df, choosers, alternative_count)
+        cum_size = chunk.log_df_size(trace_label, 'utilities', utilities, cum_size=None)
 
-        tracing.trace_df(interaction_df[trace_rows],
-                         tracing.extend_trace_label(trace_label, 'interaction_df'),
-                         slicer='NONE', transpose=False)
     else:
-        trace_rows = trace_ids = None
 
-    interaction_utilities, trace_eval_results \
-        = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows)
+        # cross join choosers and alternatives (cartesian product)
+        # for every chooser, there will be a row for each alternative
+        # index values (non-unique) are from alternatives df
+        interaction_df = \
+            logit.interaction_dataset(choosers, alternatives, sample_size=alternative_count)
 
-    # interaction_utilities is a df with one utility column and one row per interaction_df row
+        cum_size = chunk.log_df_size(trace_label, 'interaction_df', interaction_df, cum_size=None)
 
-    cum_size = chunk.log_df_size(trace_label, 'interaction_utils', interaction_utilities, cum_size)
+        assert alternative_count == len(interaction_df.index) / len(choosers.index)
 
-    if have_trace_targets:
-        tracing.trace_interaction_eval_results(trace_eval_results, trace_ids,
-                                               tracing.extend_trace_label(trace_label, 'eval'))
+        if skims:
+            add_skims(interaction_df, skims)
 
-        tracing.trace_df(interaction_utilities[trace_rows],
-                         tracing.extend_trace_label(trace_label, 'interaction_utilities'),
-                         slicer='NONE', transpose=False)
+        # evaluate expressions from the spec multiply by coefficients and sum
+        # spec is df with one row per spec expression and one col with utility coefficient
+        # column names of interaction_df match spec index values
+        # utilities has utility value for element in the cross product of choosers and alternatives
+        # interaction_utilities is a df with one utility column and one row per interaction_df row
+        if have_trace_targets:
+            trace_rows, trace_ids \
+                = tracing.interaction_trace_rows(interaction_df, choosers, alternative_count)
 
-    tracing.dump_df(DUMP, interaction_utilities, trace_label, 'interaction_utilities')
+            tracing.trace_df(interaction_df[trace_rows],
+                             tracing.extend_trace_label(trace_label, 'interaction_df'),
+                             slicer='NONE', transpose=False)
+        else:
+            trace_rows = trace_ids = None
 
-    # FIXME - do this in numpy, not pandas?
-    # reshape utilities (one utility column and one row per row in interaction_utilities)
-    # to a dataframe with one row per chooser and one column per alternative
-    utilities = pd.DataFrame(
-        interaction_utilities.as_matrix().reshape(len(choosers), alternative_count),
-        index=choosers.index)
+        interaction_utilities, trace_eval_results \
+            = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows)
+
+        # interaction_utilities is a df with one utility column and one row per interaction_df row
+
+        cum_size = chunk.log_df_size(trace_label, 'interaction_utils', interaction_utilities,
+                                     cum_size)
+
+        if have_trace_targets:
+            tracing.trace_interaction_eval_results(trace_eval_results, trace_ids,
+                                                   tracing.extend_trace_label(trace_label, 'eval'))
 
-    cum_size = chunk.log_df_size(trace_label, 'utilities', utilities, cum_size)
+            tracing.trace_df(interaction_utilities[trace_rows],
+                             tracing.extend_trace_label(trace_label, 'interaction_utilities'),
+                             slicer='NONE', transpose=False)
+
+        tracing.dump_df(DUMP, interaction_utilities, trace_label, 'interaction_utilities')
+
+        # FIXME - do this in numpy, not pandas?
+        # reshape utilities (one utility column and one row per row in interaction_utilities)
+        # to a dataframe with one row per chooser and one column per alternative
+        utilities = pd.DataFrame(
+            interaction_utilities.as_matrix().reshape(len(choosers), alternative_count),
+            index=choosers.index)
+
+        cum_size = chunk.log_df_size(trace_label, 'utilities', utilities, cum_size)
 
     if have_trace_targets:
         tracing.trace_df(utilities, tracing.extend_trace_label(trace_label, 'utilities'),
@@ -283,29 +372,13 @@ def _interaction_sample(
                          column_labels=['alternative', 'probability'])
 
     choices_df = make_sample_choices(
-        choosers, probs, interaction_utilities,
+        choosers, probs, alternatives,
         sample_size, alternative_count, alt_col_name, trace_label)
 
     # make_sample_choices should return choosers index as choices_df column
     assert choosers.index.name in choices_df.columns
 
-    # pick_count and pick_dup
-    # pick_count is number of duplicate picks
-    # pick_dup flag is True for all but first of duplicates
-    pick_group = choices_df.groupby([choosers.index.name, alt_col_name])
-
-    # number each item in each group from 0 to the length of that group - 1.
-    choices_df['pick_count'] = pick_group.cumcount(ascending=True)
-    # flag duplicate rows after first
-    choices_df['pick_dup'] = choices_df['pick_count'] > 0
-    # add reverse cumcount to get total pick_count (conveniently faster than groupby.count + merge)
-    choices_df['pick_count'] += pick_group.cumcount(ascending=False) + 1
-
-    # drop the duplicates
-    choices_df = choices_df[~choices_df['pick_dup']]
-    del choices_df['pick_dup']
-
-    # set index after groupby so we can trace on it
+    # set index after dropping duplicate picks so we can trace on it
     choices_df.set_index(choosers.index.name, inplace=True)
 
     tracing.dump_df(DUMP, choices_df, trace_label, 'choices_df')
@@ -329,7 +402,7 @@ def _interaction_sample(
     return choices_df
 
 
-def calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label):
+def calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label, broadcast=False):
 
     num_choosers = choosers.shape[0]
 
@@ -340,6 +413,12 @@ def calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label):
     # all columns from choosers
     chooser_row_size = choosers.shape[1]
 
+    if broadcast:
+        # no interaction dataset, just (n, m) arrays with one column per alternative
+        row_size = chooser_row_size + BROADCAST_ARRAYS * alternatives.shape[0]
+        logger.debug("%s #chunk_calc broadcast row_size %s" % (trace_label, row_size))
+        return chunk.rows_per_chunk(chunk_size, row_size, num_choosers, trace_label)
+
     # interaction_df has one column per alternative plus a skim column and a join column
     alt_row_size = alternatives.shape[1] + 2
 
@@ -372,6 +451,9 @@ def interaction_sample(
 
     optionally (if chunk_size > 0) iterates over choosers in chunk_size chunks
 
+    if the interaction_broadcast setting is True, the spec is evaluated against a
+    BroadcastFrame of choosers and alternatives rather than their cross join (see can_broadcast)
+
     Parameters
     ----------
     choosers : pandas.DataFrame
@@ -419,32 +501,57 @@ def interaction_sample(
     assert sample_size > 0
     sample_size = min(sample_size, len(alternatives.index))
 
+    num_threads = chunk.get_num_threads()
+
+    # chunks are sized for broadcast evaluation only if _interaction_sample will broadcast
+    # every chunk (it evaluates the cross join of chunks with trace targets)
+    broadcast = interaction_broadcast() and not tracing.has_trace_targets(choosers) and \
+        can_broadcast(spec, choosers, alternatives, skims)
+
     rows_per_chunk = \
-        calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label)
-    logger.info("interaction_sample chunk_size %s num_choosers %s rows_per_chunk %s" %
-                (chunk_size, choosers.shape[0], rows_per_chunk))
+        calc_rows_per_chunk(chunk.thread_chunk_size(chunk_size, num_threads),
+                            choosers, alternatives, trace_label, broadcast=broadcast)
+    rows_per_chunk = chunk.thread_rows_per_chunk(rows_per_chunk, len(choosers.index), num_threads)
+
+    logger.info("interaction_sample chunk_size %s num_choosers %s rows_per_chunk %s "
+                "num_threads %s broadcast %s" %
+                (chunk_size, choosers.shape[0], rows_per_chunk, num_threads, broadcast))
+
+    # if using skims, copy index into the dataframe, so it will be
+    # available as the "destination" for the skims dereference
+    # (once, rather than in each of the chunks, which may run concurrently)
+    if skims:
+        alternatives[alternatives.index.name] = alternatives.index
 
-    result_list = []
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    def run_chunk(i, num_chunks, chooser_chunk):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
         chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i) \
             if num_chunks > 1 else trace_label
 
+        chunk_skims, chunk_locals_d = \
+            chunk.thread_skims(skims, locals_d) if num_threads > 1 else (skims, locals_d)
+
         choices = _interaction_sample(chooser_chunk, alternatives, spec, sample_size, alt_col_name,
-                                      skims, locals_d,
+                                      chunk_skims, chunk_locals_d,
                                       chunk_trace_label)
 
-        result_list.append(choices)
-
         force_garbage_collect()
 
+        return choices
+
+    result_list = chunk.map_chunks(run_chunk,
+                                   chunk.chunked_choosers(
+                                       choosers, rows_per_chunk,
+                                       chunk.thread_chunk_size(chunk_size, num_threads),
+                                       trace_label),
+                                   num_threads)
+
     # FIXME: this will require 2X RAM
     # if necessary, could append to hdf5 store on disk:
     # http://pandas.pydata.org/pandas-docs/stable/io.html#id2
-    if len(result_list) > 1:
-        choices = pd.concat(result_list)
+    choices = pd.concat(result_list) if len(result_list) > 1 else result_list[0]
 
     assert len(choosers.index) == len(np.unique(choices.index.values))
 
@@ -8,8 +8,12 @@ import pandas as pd
 
 from . import logit
 from . import tracing
+from . import inject
 from .simulate import add_skims
+from .skim import SkimDictWrapper
 from . import chunk
+from .expression_plan import expression_plan, COLUMNS, PYTHON
+from .broadcast import BroadcastFrame, BroadcastError, BROADCAST_ARRAYS
 
 from activitysim.core.util import force_garbage_collect
 
@@ -85,13 +89,12 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows):
     utilities = pd.DataFrame({'utility': 0.0}, index=df.index)
     no_variability = has_missing_vals = 0
 
-    for expr, coefficient in zip(spec.index, spec.iloc[:, 0]):
+    plan = expression_plan(spec.index)
+
+    for i, (expr, coefficient) in enumerate(zip(plan.exprs, spec.iloc[:, 0])):
         try:
 
-            if expr.startswith('@'):
-                v = to_series(eval(expr[1:], globals(), locals_d))
-            else:
-                v = df.eval(expr)
+            v = to_series(plan.evaluate(i, df, globals(), locals_d))
 
             if check_for_variability and v.std() == 0:
                 logger.info("%s: no variability (%s) in: %s" % (trace_label, v.iloc[0], expr))
@@ -134,6 +137,136 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows):
     return utilities, trace_eval_results
 
 
+def interaction_broadcast():
+    """
+    evaluate interaction specs without materializing the cross join of choosers and
+    alternatives where possible (interaction_broadcast setting)
+    """
+    return bool(inject.get_injectable('interaction_broadcast', False))
+
+
+# spec expressions (as tuples) that broadcast_utilities failed to evaluate
+_UNBROADCASTABLE_SPECS = set()
+
+
+def can_broadcast(spec, choosers, alternatives, skims):
+    """
+    True if spec can be evaluated against a BroadcastFrame of choosers and alternatives
+
+    All skims must be SkimDictWrappers (SkimStackWrappers need a time period column),
+    and all simple expressions must be compiled expressions of the BroadcastFrame columns
+    (others would have to be evaluated with DataFrame.eval). Python (@) expressions can only
+    be checked by evaluating them, so specs that broadcast_utilities failed to evaluate are
+    remembered and can't be broadcast.
+    """
+
+    if tuple(spec.index) in _UNBROADCASTABLE_SPECS:
+        return False
+
+    skims = skims if isinstance(skims, list) else [skims] if skims else []
+    if not all(isinstance(skim, SkimDictWrapper) for skim in skims):
+        return False
+
+    columns = BroadcastFrame(choosers, alternatives).columns
+
+    plan = expression_plan(spec.index)
+    for kind, names in zip(plan.kinds, plan.names):
+        if kind == PYTHON:
+            continue
+        if kind != COLUMNS or not all(name in columns for name in names):
+            return False
+
+    return True
+
+
+def eval_broadcast_utilities(spec, df, locals_d, trace_label):
+    """
+    Compute the utilities for a single-alternative spec evaluated in the context of
+    BroadcastFrame df, with one row per chooser and one column per alternative
+
+    Like eval_interaction_utilities, but the expressions see chooser columns as (n, 1) arrays
+    and alternative columns (and skims) as (1, m) (and (n, m)) arrays, so the partial
+    utilities are broadcast to (n, m) without materializing the interaction dataset.
+
+    Returns
+    -------
+    utilities : numpy.ndarray
+        of shape (len(choosers), len(alternatives))
+    """
+    assert(len(spec.columns) == 1)
+
+    # avoid altering caller's passed-in locals_d parameter (they may be looping)
+    locals_d = locals_d.copy() if locals_d is not None else {}
+    locals_d.update(locals())
+
+    check_for_variability = tracing.check_for_variability()
+
+    utilities = np.zeros(df.shape)
+    no_variability = has_missing_vals = 0
+
+    plan = expression_plan(spec.index)
+
+    for i, (expr, coefficient) in enumerate(zip(plan.exprs, spec.iloc[:, 0])):
+        try:
+
+            v = plan.evaluate(i, df, globals(), locals_d)
+
+            if check_for_variability and np.std(v) == 0:
+                logger.info("%s: no variability (%s) in: %s" % (trace_label, np.ravel(v)[0], expr))
+                no_variability += 1
+
+            if check_for_variability and np.count_nonzero(pd.isnull(v)) > 0:
+                logger.info("%s: missing values in: %s" % (trace_label, expr))
+                has_missing_vals += 1
+
+            utilities += v * coefficient
+
+        except (AttributeError, TypeError) as err:
+            # e.g. a pandas method that BroadcastArray doesn't implement
+            raise BroadcastError("%s: %s" % (expr, err))
+        except Exception as err:
+            logger.exception("Variable evaluation failed for: %s" % str(expr))
+            raise err
+
+    if no_variability > 0:
+        logger.warn("%s: %s columns have no variability" % (trace_label, no_variability))
+
+    if has_missing_vals > 0:
+        logger.warn("%s: %s columns have missing values" % (trace_label, has_missing_vals))
+
+    return utilities
+
+
+def broadcast_utilities(spec, choosers, alternatives, skims, locals_d, trace_label):
+    """
+    Utilities of spec evaluated against a BroadcastFrame of choosers and alternatives
+    (see eval_broadcast_utilities), or None if an expression can't be broadcast
+
+    Python (@) expressions that raise an AttributeError or TypeError against the BroadcastFrame
+    (e.g. that use a pandas method that BroadcastArray doesn't implement) make the spec
+    unbroadcastable (see can_broadcast), and the caller falls back to the interaction dataset.
+
+    Returns
+    -------
+    utilities : pandas.DataFrame or None
+        one row per chooser and one column per alternative
+    """
+
+    df = BroadcastFrame(choosers, alternatives)
+
+    if skims:
+        add_skims(df, skims)
+
+    try:
+        utilities = eval_broadcast_utilities(spec, df, locals_d, trace_label)
+    except BroadcastError as err:
+        logger.warn("%s can't broadcast spec, using interaction dataset (%s)" % (trace_label, err))
+        _UNBROADCASTABLE_SPECS.add(tuple(spec.index))
+        return None
+
+    return pd.DataFrame(utilities, index=choosers.index)
+
+
 def _interaction_simulate(
         choosers, alternatives, spec,
         skims=None, locals_d=None, sample_size=None,
@@ -204,52 +337,63 @@ def _interaction_simulate(
                      (sample_size, len(alternatives)))
         sample_size = min(sample_size, len(alternatives))
 
-    # if using skims, copy index into the dataframe, so it will be
-    # available as the "destination" for the skims dereference below
-    if skims:
-        alternatives[alternatives.index.name] = alternatives.index
+    # evaluate the spec against a BroadcastFrame rather than the cross join if we aren't
+    # sampling alternatives (the interaction dataset is needed to trace interaction rows)
+    broadcast = interaction_broadcast() and sample_size == len(alternatives) \
+        and not have_trace_targets and can_broadcast(spec, choosers, alternatives, skims)
 
-    # cross join choosers and alternatives (cartesian product)
-    # for every chooser, there will be a row for each alternative
-    # index values (non-unique) are from alternatives df
-    interaction_df = logit.interaction_dataset(choosers, alternatives, sample_size)
+    if broadcast:
+        utilities = \
+            broadcast_utilities(spec, choosers, alternatives, skims, locals_d, trace_label)
+        broadcast = utilities is not None
 
-    if skims:
-        add_skims(interaction_df, skims)
+    if broadcast:
 
-    cum_size = chunk.log_df_size(trace_label, 'interaction_df', interaction_df, cum_size=None)
+        cum_size = chunk.log_df_size(trace_label, 'utilities', utilities, cum_size=None)
 
-    # evaluate expressions from the spec multiply by coefficients and sum
-    # spec is df with one row per spec expression and one col with utility coefficient
-    # column names of model_design match spec index values
-    # utilities has utility value for element in the cross product of choosers and alternatives
-    # interaction_utilities is a df with one utility column and one row per row in model_design
-    if have_trace_targets:
-        trace_rows, trace_ids \
-            = tracing.interaction_trace_rows(interaction_df, choosers, sample_size)
-
-        tracing.trace_df(interaction_df[trace_rows],
-                         tracing.extend_trace_label(trace_label, 'interaction_df'),
-                         slicer='NONE', transpose=False)
     else:
-        trace_rows = trace_ids = None
 
-    interaction_utilities, trace_eval_results \
-        = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows)
+        # cross join choosers and alternatives (cartesian product)
+        # for every chooser, there will be a row for each alternative
+        # index values (non-unique) are from alternatives df
+        interaction_df = logit.interaction_dataset(choosers, alternatives, sample_size)
 
-    if have_trace_targets:
-        tracing.trace_interaction_eval_results(trace_eval_results, trace_ids,
-                                               tracing.extend_trace_label(trace_label, 'eval'))
+        if skims:
+            add_skims(interaction_df, skims)
 
-        tracing.trace_df(interaction_utilities[trace_rows],
-                         tracing.extend_trace_label(trace_label, 'interaction_utilities'),
-                         slicer='NONE', transpose=False)
+        cum_size = chunk.log_df_size(trace_label, 'interaction_df', interaction_df, cum_size=None)
+
+        # evaluate expressions from the spec multiply by coefficients and sum
+        # spec is df with one row per spec expression and one col with utility coefficient
+        # column names of model_design match spec index values
+        # utilities has utility value for element in the cross product of choosers and alternatives
+        # interaction_utilities is a df with one utility column and one row per row in model_design
+        if have_trace_targets:
+            trace_rows, trace_ids \
+                = tracing.interaction_trace_rows(interaction_df, choosers, sample_size)
 
-    # reshape utilities (one utility column and one row per row in model_design)
-    # to a dataframe with one row per chooser and one column per alternative
-    utilities = pd.DataFrame(
-        interaction_utilities.as_matrix().reshape(len(choosers), sample_size),
-        index=choosers.index)
+            tracing.trace_df(interaction_df[trace_rows],
+                             tracing.extend_trace_label(trace_label, 'interaction_df'),
+                             slicer='NONE', transpose=False)
+        else:
+            trace_rows = trace_ids = None
+
+        interaction_utilities, trace_eval_results \
+            = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows)
+
+        if have_trace_targets:
+            tracing.trace_interaction_eval_results(trace_eval_results, trace_ids,
+                                                   tracing.extend_trace_label(trace_label, 'eval'))
+
+            tracing.trace_df(interaction_utilities[trace_rows],
+                             tracing.extend_trace_label(trace_label, 'interaction_utilities'),
+                             slicer='NONE', transpose=False)
+
+        # reshape utilities (one utility column and one row per row in model_design)
+        # to a dataframe with one row per chooser and one column per alternative
+        utilities = pd.DataFrame(
+            interaction_utilities.as_matrix().reshape(len(choosers), sample_size),
+            index=choosers.index)
 
     if have_trace_targets:
         tracing.trace_df(utilities, tracing.extend_trace_label(trace_label, 'utilities'),
@@ -274,10 +418,14 @@ def _interaction_simulate(
     # that is, we want the index value of the row that is offset by <position> rows into the
     # tranche of this choosers alternatives created by cross join of alternatives and choosers
 
-    # offsets is the offset into model_design df of first row of chooser alternatives
-    offsets = np.arange(len(positions)) * sample_size
-    # resulting pandas Int64Index has one element per chooser row and is in same order as choosers
-    choices = interaction_utilities.index.take(positions + offsets)
+    if broadcast:
+        # every chooser has every alternative, in the order of alternatives
+        choices = alternatives.index.take(positions)
+    else:
+        # offsets is the offset into model_design df of first row of chooser alternatives
+        offsets = np.arange(len(positions)) * sample_size
+        # resulting pandas Int64Index has one element per chooser row in same order as choosers
+        choices = interaction_utilities.index.take(positions + offsets)
 
     # create a series with index from choosers and the index of the chosen alternative
     choices = pd.Series(choices, index=choosers.index)
@@ -293,7 +441,8 @@ def _interaction_simulate(
     return choices
 
 
-def calc_rows_per_chunk(chunk_size, choosers, alternatives, sample_size, skims, trace_label=None):
+def calc_rows_per_chunk(chunk_size, choosers, alternatives, sample_size, skims, trace_label=None,
+                        broadcast=False):
 
     num_choosers = len(choosers.index)
 
@@ -303,6 +452,12 @@ def calc_rows_per_chunk(chunk_size, choosers, alternatives, sample_size, skims,
 
     chooser_row_size = len(choosers.columns)
 
+    if broadcast:
+        # no interaction dataset, just (n, m) arrays with one column per alternative
+        row_size = chooser_row_size + BROADCAST_ARRAYS * alternatives.shape[0]
+        logger.debug("%s #chunk_calc broadcast row_size %s" % (trace_label, row_size))
+        return chunk.rows_per_chunk(chunk_size, row_size, num_choosers, trace_label)
+
     # alternative columns plus join column
     alt_row_size = alternatives.shape[1] + 1
 
@@ -333,6 +488,10 @@ def interaction_simulate(
 
     optionally (if chunk_size > 0) iterates over choosers in chunk_size chunks
 
+    if the interaction_broadcast setting is True (and alternatives are not sampled), the spec is
+    evaluated against a BroadcastFrame of choosers and alternatives rather than their cross join
+    (see can_broadcast)
+
     Parameters
     ----------
     choosers : pandas.DataFrame
@@ -379,36 +538,61 @@ def interaction_simulate(
 
     assert len(choosers) > 0
 
+    num_threads = chunk.get_num_threads()
+
+    # chunks are sized for broadcast evaluation only if _interaction_simulate will broadcast
+    # every chunk (it evaluates the cross join of chunks with trace targets)
+    broadcast = interaction_broadcast() and \
+        (not sample_size or sample_size >= len(alternatives.index)) and \
+        not tracing.has_trace_targets(choosers) and \
+        can_broadcast(spec, choosers, alternatives, skims)
+
     rows_per_chunk = \
-        calc_rows_per_chunk(chunk_size, choosers, alternatives=alternatives,
+        calc_rows_per_chunk(chunk.thread_chunk_size(chunk_size, num_threads),
+                            choosers, alternatives=alternatives,
                             sample_size=sample_size, skims=skims,
-                            trace_label=trace_label)
+                            trace_label=trace_label, broadcast=broadcast)
+    rows_per_chunk = chunk.thread_rows_per_chunk(rows_per_chunk, len(choosers.index), num_threads)
 
-    logger.info("interaction_simulate chunk_size %s num_choosers %s" %
-                (chunk_size, len(choosers.index)))
+    logger.info("interaction_simulate chunk_size %s num_choosers %s num_threads %s broadcast %s" %
+                (chunk_size, len(choosers.index), num_threads, broadcast))
 
-    result_list = []
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    # if using skims, copy index into the dataframe, so it will be
+    # available as the "destination" for the skims dereference
+    # (once, rather than in each of the chunks, which may run concurrently)
+    if skims:
+        alternatives[alternatives.index.name] = alternatives.index
+
+    def run_chunk(i, num_chunks, chooser_chunk):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
         chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i) \
             if num_chunks > 1 else trace_label
 
+        chunk_skims, chunk_locals_d = \
+            chunk.thread_skims(skims, locals_d) if num_threads > 1 else (skims, locals_d)
+
         choices = _interaction_simulate(chooser_chunk, alternatives, spec,
-                                        skims, locals_d, sample_size,
+                                        chunk_skims, chunk_locals_d, sample_size,
                                         chunk_trace_label,
                                         trace_choice_name)
 
-        result_list.append(choices)
-
         force_garbage_collect()
 
+        return choices
+
+    result_list = chunk.map_chunks(run_chunk,
+                                   chunk.chunked_choosers(
+                                       choosers, rows_per_chunk,
+                                       chunk.thread_chunk_size(chunk_size, num_threads),
+                                       trace_label),
+                                   num_threads)
+
     # FIXME: this will require 2X RAM
     # if necessary, could append to hdf5 store on disk:
     # http://pandas.pydata.org/pandas-docs/stable/io.html#id2
-    if len(result_list) > 1:
-        choices = pd.concat(result_list)
+    choices = pd.concat(result_list) if len(result_list) > 1 else result_list[0]
 
     assert len(choices.index == len(choosers.index))
 
@@ -13,6 +13,14 @@ import pipeline
 
 logger = logging.getLogger(__name__)
 
+EXP_UTIL_MIN = 1e-300
+EXP_UTIL_MAX = np.inf
+
+PROB_MIN = 0.0
+PROB_MAX = 1.0
+
+_COMPILED_NEST_SPECS = {}
+
 
 def report_bad_choices(bad_row_map, df, trace_label, msg, trace_choosers=None):
     """
@@ -97,8 +105,6 @@ def utils_to_probs(utils, trace_label=None, exponentiated=False, allow_zero_prob
     if not exponentiated:
         utils_arr = np.exp(utils_arr)
 
-    EXP_UTIL_MIN = 1e-300
-    EXP_UTIL_MAX = np.inf
     np.clip(utils_arr, EXP_UTIL_MIN, EXP_UTIL_MAX, out=utils_arr)
 
     # FIXME
@@ -125,9 +131,6 @@ def utils_to_probs(utils, trace_label=None, exponentiated=False, allow_zero_prob
     with np.errstate(invalid='ignore' if allow_zero_probs else 'warn'):
         np.divide(utils_arr, arr_sum.reshape(len(utils_arr), 1), out=utils_arr)
 
-    PROB_MIN = 0.0
-    PROB_MAX = 1.0
-
     # if allow_zero_probs, this will cause EXP_UTIL_MIN util rows to have all zero probabilities
     utils_arr[np.isnan(utils_arr)] = PROB_MIN
 
@@ -408,3 +411,165 @@ def count_nests(nest_spec, type=None):
             if type is None or nest.type == type:
                 count += 1
     return count
+
+
+def logsums(utils_arr, starts=None):
+    """
+    Log of the sum of the exponentiated utilities of each row of utils_arr
+    (or of each segment of columns of utils_arr if starts is not None)
+
+    Utilities are shifted by their max before being exponentiated so that very large
+    (or very negative) utilities don't overflow (or underflow) - the logsum of a row
+    whose utilities are all -inf is -inf.
+
+    Parameters
+    ----------
+    utils_arr : 2D float ndarray
+        utilities - which are overwritten
+    starts : 1D int array or None
+        start column of each segment of columns (as for numpy.ufunc.reduceat)
+
+    Returns
+    -------
+    logsums : ndarray
+        1D array with a logsum per row if starts is None,
+        else 2D array with a logsum per row for each segment
+    """
+
+    segmented = starts is not None
+
+    if segmented:
+        counts = np.diff(np.append(starts, utils_arr.shape[1]))
+    else:
+        starts = [0]
+        counts = [utils_arr.shape[1]]
+
+    max_utils = np.maximum.reduceat(utils_arr, starts, axis=1)
+    max_utils[~np.isfinite(max_utils)] = 0.0
+
+    utils_arr -= np.repeat(max_utils, counts, axis=1)
+    np.exp(utils_arr, out=utils_arr)
+
+    with np.errstate(divide='ignore'):
+        logsums = np.log(np.add.reduceat(utils_arr, starts, axis=1))
+    logsums += max_utils
+
+    return logsums if segmented else logsums[:, 0]
+
+
+class CompiledNestSpec(object):
+    """
+    Nest tree compiled into index arrays, so that nested logit utilities and probabilities
+    can be computed for all nests with a few array operations rather than by walking the tree
+    with each_nest and computing a dataframe column per nest.
+
+    Parameters
+    ----------
+    nest_spec : dict
+        Nest tree dict from the model spec yaml file
+    """
+
+    def __init__(self, nest_spec):
+
+        nests = list(each_nest(nest_spec, post_order=True))
+
+        # nested exp utility columns (leaves and nodes in post-order)
+        self.names = [nest.name for nest in nests]
+        column = {name: i for i, name in enumerate(self.names)}
+
+        # leaves are in the same order in post-order and pre-order
+        leaves = [nest for nest in nests if nest.is_leaf]
+        self.leaf_names = [nest.name for nest in leaves]
+        self.leaf_columns = np.array([column[nest.name] for nest in leaves], dtype=int)
+        self.leaf_products = np.array([nest.product_of_coefficients for nest in leaves],
+                                      dtype=np.float64)
+
+        # nodes grouped by level (deepest first, so that alternatives are computed before
+        # their nests) as (node columns, coefficients, alternative columns, alternative starts)
+        nodes = [nest for nest in nests if not nest.is_leaf]
+        self.node_levels = []
+        for level in sorted(set(nest.level for nest in nodes), reverse=True):
+            level_nodes = [nest for nest in nodes if nest.level == level]
+            counts = np.array([len(nest.alternatives) for nest in level_nodes], dtype=int)
+            self.node_levels.append((
+                np.array([column[nest.name] for nest in level_nodes], dtype=int),
+                np.array([nest.coefficient for nest in level_nodes], dtype=np.float64),
+                np.array([column[a] for nest in level_nodes for a in nest.alternatives],
+                         dtype=int),
+                np.cumsum(counts) - counts))
+
+        # nested probability columns - the alternatives of each node (in pre-order)
+        pre_order_nodes = list(each_nest(nest_spec, type='node', post_order=False))
+        self.prob_names = [a for nest in pre_order_nodes for a in nest.alternatives]
+        self.prob_counts = np.array([len(nest.alternatives) for nest in pre_order_nodes],
+                                    dtype=int)
+        self.prob_starts = np.cumsum(self.prob_counts) - self.prob_counts
+
+        # for each leaf, the nested probability columns of its ancestors (skipping root)
+        # padded with the index of an extra column of ones
+        prob_column = {name: i for i, name in enumerate(self.prob_names)}
+        ancestors = [nest.ancestors[1:] for nest in leaves]
+        depth = max(len(a) for a in ancestors)
+        self.ancestor_columns = np.full((len(leaves), depth), len(self.prob_names), dtype=int)
+        for i, leaf_ancestors in enumerate(ancestors):
+            self.ancestor_columns[i, :len(leaf_ancestors)] = \
+                [prob_column[name] for name in leaf_ancestors]
+
+
+def compile_nest_spec(nest_spec):
+    """
+    Get the (cached) CompiledNestSpec for nest_spec
+
+    Compiled nest specs are cached by the content of the nest spec (rather than its identity)
+    since model settings (and so their nest specs) may be re-read for every chunk.
+    """
+
+    key = repr(_nest_spec_key(nest_spec))
+
+    compiled = _COMPILED_NEST_SPECS.get(key)
+    if compiled is None:
+        compiled = _COMPILED_NEST_SPECS[key] = CompiledNestSpec(nest_spec)
+
+    return compiled
+
+
+def _nest_spec_key(spec):
+    if isinstance(spec, dict):
+        return tuple(sorted((k, _nest_spec_key(v)) for k, v in spec.items()))
+    if isinstance(spec, list):
+        return tuple(_nest_spec_key(v) for v in spec)
+    return spec
+
+
+def nested_logsums(leaf_utils_arr, nest_spec):
+    """
+    Root logsums of a nested logit model
+
+    Nest logsums are computed level by level in log space with the max-shifted logsums kernel
+    without computing exponentiated nest utilities or any probabilities.
+
+    Parameters
+    ----------
+    leaf_utils_arr : 2D float ndarray
+        raw utilities of the leaves with columns in CompiledNestSpec.leaf_names order
+    nest_spec : dict
+        Nest tree dict from the model spec yaml file
+
+    Returns
+    -------
+    logsums : 1D ndarray
+        root logsum of each row
+    """
+
+    nests = compile_nest_spec(nest_spec)
+
+    # log of nested exp utilities of leaves and nodes
+    nested_utils = np.empty((leaf_utils_arr.shape[0], len(nests.names)), dtype=np.float64)
+    nested_utils[:, nests.leaf_columns] = leaf_utils_arr / nests.leaf_products
+
+    for node_columns, coefficients, alternative_columns, starts in nests.node_levels:
+        nested_utils[:, node_columns] = \
+            coefficients * logsums(nested_utils[:, alternative_columns], starts)
+
+    # root is the last nest in post-order
+    return nested_utils[:, -1]
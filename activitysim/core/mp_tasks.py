@@ -0,0 +1,382 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import os
+import logging
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from . import pipeline
+from . import inject
+from . import config
+from .tracing import print_elapsed_time
+
+logger = logging.getLogger(__name__)
+
+# models run once in the parent process rather than on household shards
+DEFAULT_PARENT_MODELS = ['initialize', 'compute_accessibility',
+                         'write_data_dictionary', 'write_tables']
+
+
+def model_step_name(model_name):
+    """
+    step name of model_name (without any no_checkpoint prefix or step args)
+    """
+    step_name = model_name.split('.', 1)[0]
+    return step_name[1:] if step_name[0] == '_' else step_name
+
+
+def split_models(models, parent_models):
+    """
+    Split models into the models run in the parent before sharding, the household models run
+    on each shard, and the models run in the parent after the shards are coalesced.
+
+    Parameters
+    ----------
+    models : [str]
+        list of model_names
+    parent_models : [str]
+        step names of models that are run in the parent process
+
+    Returns
+    -------
+    setup_models : [str]
+        leading parent models (e.g. initialize, compute_accessibility)
+    shard_models : [str]
+        household models
+    final_models : [str]
+        trailing parent models (e.g. write_tables)
+    """
+
+    is_parent = [model_step_name(m) in parent_models for m in models]
+
+    first = is_parent.index(False) if False in is_parent else len(models)
+    last = len(models) - is_parent[::-1].index(False) if False in is_parent else len(models)
+
+    if any(is_parent[first:last]):
+        bad_models = [m for m, p in zip(models[first:last], is_parent[first:last]) if p]
+        raise RuntimeError("parent models %s must precede or follow all household models"
+                           % bad_models)
+
+    return models[:first], models[first:last], models[last:]
+
+
+def shard_pipeline_path(pipeline_path, shard):
+    """
+    path of the pipeline file for shard (alongside pipeline_path)
+    """
+    root, ext = os.path.splitext(pipeline_path)
+    return "%s-%s%s" % (root, shard, ext)
+
+
+def shard_df(df, hh_ids, person_ids, hh_index_name, persons_index_name):
+    """
+    Rows of df belonging to the households in hh_ids (and their persons in person_ids)
+
+    Returns None if df is not keyed on households or persons (e.g. land_use, accessibility)
+    and so is not sharded.
+    """
+
+    if df.index.name == hh_index_name:
+        return df[df.index.isin(hh_ids)]
+    if 'household_id' in df.columns:
+        return df[df.household_id.isin(hh_ids)]
+    if df.index.name == persons_index_name:
+        return df[df.index.isin(person_ids)]
+    if 'person_id' in df.columns:
+        return df[df.person_id.isin(person_ids)]
+
+    return None
+
+
+def renumber_chunk_ids(households):
+    """
+    Number chunk_ids of households consecutively (so hh_chunked_choosers can chunk them)
+    """
+    if 'chunk_id' in households.columns:
+        households['chunk_id'] = np.arange(len(households.index))
+    return households
+
+
+def write_shard_pipelines(num_shards):
+    """
+    Partition the households (and the rows of tables keyed on them) in the open pipeline into
+    num_shards ranges of household ids, and write each shard's slice of the current checkpoint
+    to its own pipeline file, from which a worker process can resume the pipeline.
+
+    Parameters
+    ----------
+    num_shards : int
+
+    Returns
+    -------
+    shard_paths : [str]
+        pipeline file path of each shard
+    sharded_tables : dict of {str: pandas.Index}
+        index (in single process row order) of each sharded table
+    """
+
+    checkpoints = pipeline.read_df(pipeline.CHECKPOINT_TABLE_NAME)
+    last_checkpoint = checkpoints.iloc[-1]
+
+    households = pipeline.get_table('households')
+    hh_index_name = households.index.name
+
+    persons = pipeline.get_table('persons') if 'persons' in pipeline.checkpointed_tables() \
+        else None
+    persons_index_name = persons.index.name if persons is not None else None
+
+    tables = {table_name: pipeline.get_table(table_name)
+              for table_name in pipeline.checkpointed_tables()}
+
+    # no empty shards
+    num_shards = min(num_shards, len(households.index))
+
+    sharded_tables = {}
+    shard_paths = []
+    for shard, hh_ids in enumerate(np.array_split(households.index.values, num_shards)):
+
+        person_ids = persons.index[persons.household_id.isin(hh_ids)] \
+            if persons is not None else []
+
+        shard_path = shard_pipeline_path(inject.get_injectable('pipeline_path'), shard)
+        if os.path.isfile(shard_path):
+            os.unlink(shard_path)
+
+        store = pd.HDFStore(shard_path, mode='w')
+        store[pipeline.CHECKPOINT_TABLE_NAME] = checkpoints
+        for table_name, df in tables.iteritems():
+
+            df_shard = shard_df(df, hh_ids, person_ids, hh_index_name, persons_index_name)
+
+            if df_shard is None:
+                df_shard = df
+            else:
+                sharded_tables[table_name] = df.index
+
+            if table_name == 'households':
+                df_shard = renumber_chunk_ids(df_shard.copy())
+
+            store["%s/%s" % (table_name, last_checkpoint[table_name])] = df_shard
+        store.close()
+
+        logger.info("shard %s: %s households" % (shard, len(hh_ids)))
+
+        shard_paths.append(shard_path)
+
+    return shard_paths, sharded_tables
+
+
+def run_shard(shard_path, models, resume_after, base_seed):
+    """
+    Worker process entry point: resume the shard pipeline in shard_path and run models on it
+    """
+
+    inject.add_injectable('pipeline_path', shard_path)
+
+    pipeline.set_rn_generator_base_seed(base_seed)
+
+    try:
+        pipeline.run(models=models, resume_after=resume_after)
+        pipeline.close_pipeline()
+    except Exception:
+        logger.exception("shard %s failed" % shard_path)
+        raise
+
+
+def restore_shard_order(df, index, table_name):
+    """
+    Rows of df (concatenated from the shards) in their single process order index
+
+    Rows whose ids are not in index (e.g. rows added by the shard models) follow in shard order,
+    and a warning is logged if df and index don't have the same ids.
+    """
+
+    order = index[index.isin(df.index)]
+
+    if len(order) != len(df.index) or len(order) != len(index):
+        logger.warn("coalesce_shards %s has %s rows, %s of %s rows before sharding" %
+                    (table_name, len(df.index), len(order), len(index)))
+        order = order.append(df.index[~df.index.isin(index)])
+
+    return df.loc[order]
+
+
+def coalesce_checkpoints(stores, start_checkpoint_name, sharded_tables):
+    """
+    Generate the checkpoints the workers added to the shard pipeline stores after
+    start_checkpoint_name, with their checkpointed tables coalesced.
+
+    Tables written by the shard models are concatenated across the shards, and sharded tables
+    are restored to their single process row order. Only tables that were neither sharded nor
+    created by the shard models (e.g. land_use) are the same in every shard, so they are taken
+    from the first shard.
+
+    Parameters
+    ----------
+    stores : [pandas.HDFStore]
+        open shard pipeline stores
+    start_checkpoint_name : str
+        name of the checkpoint from which the workers resumed the shard pipelines
+    sharded_tables : dict of {str: pandas.Index}
+        index (in single process row order) of each sharded table
+
+    Returns
+    -------
+    generator of (checkpoint_name, tables, prng_channels) tuples
+        (see pipeline.add_coalesced_checkpoint)
+    """
+
+    checkpoints = stores[0][pipeline.CHECKPOINT_TABLE_NAME]
+
+    table_names = [c for c in checkpoints.columns if c not in pipeline.NON_TABLE_COLUMNS]
+
+    start = checkpoints.index[checkpoints[pipeline.CHECKPOINT_NAME] == start_checkpoint_name][0]
+    prev_checkpoint = checkpoints.loc[start]
+
+    # tables that existed when the pipeline was sharded but weren't sharded
+    parent_tables = [t for t in table_names
+                     if t not in sharded_tables and t in prev_checkpoint and prev_checkpoint[t]]
+
+    for _, checkpoint in checkpoints.loc[start:].iloc[1:].iterrows():
+
+        checkpoint_name = checkpoint[pipeline.CHECKPOINT_NAME]
+
+        tables = {}
+        for table_name in table_names:
+
+            if checkpoint[table_name] == checkpoint_name:
+
+                key = "%s/%s" % (table_name, checkpoint_name)
+
+                if table_name in parent_tables:
+                    df = stores[0][key]
+                else:
+                    df = pd.concat([store[key] for store in stores])
+
+                if table_name in sharded_tables:
+                    df = restore_shard_order(df, sharded_tables[table_name], table_name)
+
+                if table_name == 'households':
+                    df = renumber_chunk_ids(df)
+
+                tables[table_name] = df
+
+            elif not checkpoint[table_name] and prev_checkpoint.get(table_name, None):
+                tables[table_name] = None
+
+        yield checkpoint_name, tables, checkpoint[pipeline.PRNG_CHANNELS]
+
+        prev_checkpoint = checkpoint
+
+
+def coalesce_shards(shard_paths, sharded_tables):
+    """
+    Add a checkpoint to the open pipeline for each checkpoint the workers added to the
+    shard pipelines after the current checkpoint, with their checkpointed tables coalesced
+    (see coalesce_checkpoints).
+    """
+
+    stores = [pd.HDFStore(shard_path, mode='r') for shard_path in shard_paths]
+
+    try:
+        for checkpoint_name, tables, prng_channels in \
+                coalesce_checkpoints(stores, pipeline.last_checkpoint_name(), sharded_tables):
+
+            logger.info("coalesce_shards checkpoint '%s' tables %s" %
+                        (checkpoint_name, tables.keys()))
+
+            pipeline.add_coalesced_checkpoint(checkpoint_name, tables, prng_channels)
+    finally:
+        for store in stores:
+            store.close()
+
+
+def run_multiprocess(models, resume_after=None, num_processes=None):
+    """
+    run the specified list of models, like pipeline.run, but with the household models run on
+    num_processes household shards in parallel worker processes.
+
+    The models in the parent_models setting (by default initialize, compute_accessibility,
+    write_data_dictionary and write_tables) must precede or follow all the household models.
+    The leading ones are run once in the parent process, the households (and the rows of all
+    tables keyed on households or persons) are partitioned by household id range into shards,
+    and each worker resumes the pipeline from its own shard pipeline file and runs the household
+    models on it. The workers' checkpoints are then coalesced into the parent pipeline and the
+    trailing parent models are run in the parent process.
+
+    Since random number channels are seeded per row, results are the same as for a single
+    process run. Workers are forked, so they share the parent's skims. (Use the shared_skims
+    setting to load skims into a shared memory buffer that is never copied on write.)
+
+    Parameters
+    ----------
+    models : [str]
+        list of model_names
+    resume_after : str or None
+        model_name of checkpoint to load checkpoint and AFTER WHICH to resume model run
+    num_processes : int or None
+        number of household shards and worker processes (num_processes setting if None)
+    """
+
+    if num_processes is None:
+        num_processes = int(config.setting('num_processes', 1))
+
+    if resume_after and resume_after in models:
+        models = models[models.index(resume_after) + 1:]
+
+    parent_models = config.setting('parent_models', DEFAULT_PARENT_MODELS)
+    setup_models, shard_models, final_models = split_models(models, parent_models)
+
+    if num_processes <= 1 or not shard_models:
+        pipeline.run(models=models, resume_after=resume_after)
+        return
+
+    if not setup_models and not resume_after:
+        raise RuntimeError("run_multiprocess needs a parent model (e.g. initialize) "
+                           "to load households before they are sharded")
+
+    t0 = print_elapsed_time()
+
+    pipeline.run(models=setup_models, resume_after=resume_after)
+
+    if config.setting('shared_skims', False):
+        # load skims into shared memory before forking workers
+        inject.get_injectable('shared_skim_buffer')
+
+    checkpoint_name = pipeline.last_checkpoint_name()
+    base_seed = pipeline.get_rn_generator().base_seed
+
+    shard_paths, sharded_tables = write_shard_pipelines(num_processes)
+    pipeline.close_pipeline()
+    t0 = print_elapsed_time("write %s shard pipelines" % num_processes, t0)
+
+    processes = [multiprocessing.Process(target=run_shard,
+                                         name='shard-%s' % shard,
+                                         args=(shard_path, shard_models, checkpoint_name,
+                                               base_seed))
+                 for shard, shard_path in enumerate(shard_paths)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    failed = [p.name for p in processes if p.exitcode != 0]
+    if failed:
+        raise RuntimeError("run_multiprocess %s failed" % failed)
+
+    t0 = print_elapsed_time("run (%s models) on %s shards" % (len(shard_models), num_processes), t0)
+
+    pipeline.set_rn_generator_base_seed(base_seed)
+    pipeline.open_pipeline(resume_after=checkpoint_name)
+    coalesce_shards(shard_paths, sharded_tables)
+    t0 = print_elapsed_time("coalesce_shards", t0)
+
+    for model in final_models:
+        t1 = print_elapsed_time()
+        pipeline.run_model(model)
+        t1 = print_elapsed_time("run_model %s)" % model, t1)
+
+    # don't close the pipeline, as the user may want to read intermediate results from the store
@@ -335,6 +335,13 @@ def orca_dataframe_tables():
     return [name for name in orca.list_tables() if orca.table_type(name) == 'dataframe']
 
 
+def last_checkpoint_name():
+    """
+    Return the name of the most recent checkpoint (or None if the pipeline is not open)
+    """
+    return _PIPELINE.last_checkpoint.get(CHECKPOINT_NAME, None)
+
+
 def checkpointed_tables():
     """
     Return a list of the names of all checkpointed tables
@@ -414,6 +421,35 @@ def load_checkpoint(checkpoint_name):
     _PIPELINE.prng.load_channels(cPickle.loads(_PIPELINE.last_checkpoint[PRNG_CHANNELS]))
 
 
+def add_coalesced_checkpoint(checkpoint_name, tables, prng_channels):
+    """
+    Add a checkpoint for a model that was run (e.g. on household shards) in other processes
+    whose checkpointed tables have been coalesced into tables.
+
+    Parameters
+    ----------
+    checkpoint_name : str
+    tables : dict of {str: pandas.DataFrame or None}
+        tables written (or dropped, if None) at checkpoint_name by the other processes
+    prng_channels : str
+        pickled random channel state saved with the checkpoint by the other processes
+    """
+
+    for table_name, df in tables.iteritems():
+        if df is None:
+            drop_table(table_name)
+        else:
+            replace_table(table_name, df)
+
+    # restore channel state (including any channels added by the model) for the coalesced tables
+    prng = random.Random()
+    prng.set_base_seed(_PIPELINE.prng.base_seed)
+    prng.load_channels(cPickle.loads(prng_channels))
+    _PIPELINE.prng = prng
+
+    add_checkpoint(checkpoint_name)
+
+
 def split_arg(s, sep, default=''):
     """
     split str s in two at first sep, returning empty string as second result if no sep
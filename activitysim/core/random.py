@@ -1,4 +1,5 @@
 import collections
+import threading
 
 import numpy as np
 import pandas as pd
@@ -373,6 +374,10 @@ class Random(object):
         self.base_seed = 0
         self.global_rng = np.random.RandomState()
 
+        # channel row_states are updated by every random_for_df and choice_for_df call
+        # so calls from chunks run concurrently must be serialized
+        self.lock = threading.Lock()
+
     def get_channel_info(self, channel_name, property_name):
 
         info = self.channel_info.get(channel_name, None)
@@ -707,8 +712,9 @@ class Random(object):
             rands = np.asanyarray([rng.rand(n) for _ in range(len(df))])
             return rands
 
-        channel = self.get_channel_for_df(df)
-        rands = channel.random_for_df(df, self.step_name, n)
+        with self.lock:
+            channel = self.get_channel_for_df(df)
+            rands = channel.random_for_df(df, self.step_name, n)
         return rands
 
     def choice_for_df(self, df, a, size, replace):
@@ -760,7 +766,8 @@ class Random(object):
             return choices
 
         t0 = print_elapsed_time()
-        channel = self.get_channel_for_df(df)
-        choices = channel.choice_for_df(df, self.step_name, a, size, replace)
+        with self.lock:
+            channel = self.get_channel_for_df(df)
+            choices = channel.choice_for_df(df, self.step_name, a, size, replace)
         t0 = print_elapsed_time("choice_for_df for %s rows" % len(df.index), t0, debug=True)
         return choices
@@ -18,9 +18,14 @@ from . import pipeline
 from . import util
 
 from . import chunk
+from . import inject
+from .expression_plan import expression_plan
 
 logger = logging.getLogger(__name__)
 
+# specs with no more than this fraction of nonzero coefficients are multiplied sparsely
+SPARSE_SPEC_MAX_DENSITY = 0.1
+
 
 def random_rows(df, n):
 
@@ -94,6 +99,13 @@ def eval_variables(exprs, df, locals_d=None, target_type=np.float64):
     Users should take care that these expressions must result in
     a Pandas Series.
 
+    Expressions are parsed and compiled once per spec (see expression_plan) rather than
+    on every call.
+
+    If target_type is not None, results are written directly into the columns of a
+    preallocated array (see eval_variables_array) which the returned DataFrame wraps
+    without copying.
+
     Parameters
     ----------
     exprs : sequence of str
@@ -110,6 +122,13 @@ def eval_variables(exprs, df, locals_d=None, target_type=np.float64):
         Will have the index of `df` and columns of eval results of `exprs`.
     """
 
+    if target_type is not None:
+        # FIXME - for performance, it is essential that spec and expression_values
+        # FIXME - not contain booleans when dotted with spec values
+        # FIXME - or the arrays will be converted to dtype=object within dot()
+        values = eval_variables_array(exprs, df, locals_d, dtype=target_type)
+        return pd.DataFrame(values, index=df.index, columns=list(exprs))
+
     # avoid altering caller's passed-in locals_d parameter (they may be looping)
     locals_d = locals_d.copy() if locals_d is not None else {}
     locals_d.update(locals())
@@ -119,17 +138,16 @@ def eval_variables(exprs, df, locals_d=None, target_type=np.float64):
             return pd.Series([x] * len(df), index=df.index)
         return x
 
+    plan = expression_plan(exprs)
+
     value_list = []
     print('eval_variables', end='')
-    for expr in exprs:
+    for i, expr in enumerate(plan.exprs):
         print('.', end='')
         # logger.debug("eval_variables: %s" % expr)
         # logger.debug("eval_variables %s" % util.memory_info())
         try:
-            if expr.startswith('@'):
-                expr_values = to_series(eval(expr[1:], globals(), locals_d))
-            else:
-                expr_values = df.eval(expr)
+            expr_values = to_series(plan.evaluate(i, df, globals(), locals_d))
             value_list.append((expr, expr_values))
         except Exception as err:
             print()
@@ -139,33 +157,226 @@ def eval_variables(exprs, df, locals_d=None, target_type=np.float64):
 
     values = pd.DataFrame.from_items(value_list)
 
-    # FIXME - for performance, it is essential that spec and expression_values
-    # FIXME - not contain booleans when dotted with spec values
-    # FIXME - or the arrays will be converted to dtype=object within dot()
-    if target_type is not None:
-        values = values.astype(target_type)
+    return values
+
+
+def eval_variables_array(exprs, df, locals_d=None, dtype=np.float64):
+    """
+    Evaluate spec expressions (as eval_variables does) into a preallocated array
+
+    Each expression's result is written straight into a column of a preallocated
+    (len(df), len(exprs)) array of dtype, rather than being collected as a Series
+    and copied into a DataFrame. The array is column-major (Fortran order) so that each
+    expression's values are contiguous, which is also the layout of a pandas float block.
+
+    Parameters
+    ----------
+    exprs : sequence of str
+    df : pandas.DataFrame
+    locals_d : Dict
+        This is a dictionary of local variables that will be the environment
+        for an evaluation of an expression that begins with @
+    dtype : numpy dtype
+        dtype of returned array (e.g. np.float32 or np.float64)
+
+    Returns
+    -------
+    values : 2D numpy.ndarray
+        one row per row of df and one column per expression
+    """
+
+    # avoid altering caller's passed-in locals_d parameter (they may be looping)
+    locals_d = locals_d.copy() if locals_d is not None else {}
+    locals_d.update(locals())
+
+    plan = expression_plan(exprs)
+
+    values = np.empty((len(df.index), len(plan)), dtype=dtype, order='F')
+
+    for i, expr in enumerate(plan.exprs):
+        try:
+            expr_values = plan.evaluate(i, df, globals(), locals_d)
+
+            # align series results with df (as building a DataFrame from them would)
+            if isinstance(expr_values, pd.Series) and not expr_values.index.equals(df.index):
+                expr_values = expr_values.reindex(df.index)
+
+            values[:, i] = expr_values
+        except Exception as err:
+            logger.exception("Variable evaluation failed for: %s" % str(expr))
+            raise err
 
     return values
 
 
-def compute_utilities(expression_values, spec):
+def compute_utilities(expression_values, spec, segments=None):
+    """
+    Matrix product of expression_values with the utility coefficients of the spec alternatives
 
-    # matrix product of spec expression_values with utility coefficients of alternatives
-    # sums the partial utilities (represented by each spec row) of the alternatives
-    # resulting in a dataframe with one row per chooser and one column per alternative
-    # pandas.dot depends on column names of expression_values matching spec index values
+    Sums the partial utilities (represented by each spec row) of the alternatives
+    resulting in a dataframe with one row per chooser and one column per alternative
+
+    If the expression_values columns match the spec index (as they do for eval_variables
+    results) the product is taken of the underlying arrays without pandas alignment,
+    in the precision of expression_values. Sparse specs (e.g. wide mode choice specs where
+    most expressions only apply to one or two alternatives) are multiplied by sparse_dot.
+
+    If segments is not None, spec is a segmented spec (see compute_segmented_utilities)
+    """
 
     # FIXME - for performance, it is essential that spec and expression_values
     # FIXME - not contain booleans when dotted with spec values
     # FIXME - or the arrays will be converted to dtype=object within dot()
 
-    spec = spec.astype(np.float64)
+    if segments is not None:
+        return compute_segmented_utilities(expression_values, spec, segments)
+
+    if not expression_values.columns.equals(spec.index):
+        # pandas.dot depends on column names of expression_values matching spec index values
+        return expression_values.dot(spec.astype(np.float64))
+
+    values = float_values(expression_values)
+
+    utilities = dot_coefficients(values, spec.values.astype(values.dtype))
+
+    return pd.DataFrame(utilities.astype(np.float64, copy=False),
+                        index=expression_values.index, columns=spec.columns)
+
+
+def compute_segmented_utilities(expression_values, spec, segments):
+    """
+    Utilities of choosers in different segments using each segment's utility coefficients
+
+    This allows choosers from all segments (e.g. tour purposes) whose specs only differ in their
+    coefficients to have their expression_values evaluated together, in one pass.
+
+    Parameters
+    ----------
+    expression_values : pandas.DataFrame
+        eval_variables results with columns matching spec index
+    spec : pandas.DataFrame
+        segmented spec with two levels of columns - segment and alternative
+        (e.g. as built by pd.concat of the segment specs with keys) and the same
+        alternatives for every segment
+    segments : pandas.Series or 1D array
+        segment of each row of expression_values
+
+    Returns
+    -------
+    utilities : pandas.DataFrame
+        one row per chooser and one column per alternative
+    """
+
+    assert spec.columns.nlevels == 2
+    assert expression_values.columns.equals(spec.index)
+
+    segment_names = list(spec.columns.get_level_values(0).unique())
+    alternatives = spec[segment_names[0]].columns
+
+    codes = pd.Categorical(np.asanyarray(segments), categories=segment_names).codes
+    assert (codes >= 0).all(), \
+        "compute_segmented_utilities segments not in spec: %s" % \
+        np.unique(np.asanyarray(segments)[codes < 0])
+
+    values = float_values(expression_values)
+
+    # gather rows by segment (unless they already are) so each segment is a slice of values
+    order = None
+    if (np.diff(codes) < 0).any():
+        order = np.argsort(codes, kind='mergesort')
+        values = np.asfortranarray(values[order])
+        codes = codes[order]
+
+    bounds = np.searchsorted(codes, np.arange(len(segment_names) + 1))
+
+    utilities = np.empty((len(codes), len(alternatives)), dtype=np.float64)
+    for i, segment_name in enumerate(segment_names):
+        start, stop = bounds[i], bounds[i + 1]
+        if stop > start:
+            coefficients = spec[segment_name][alternatives].values.astype(values.dtype)
+            utilities[start:stop] = dot_coefficients(values[start:stop], coefficients)
+
+    if order is not None:
+        utilities[order] = utilities.copy()
+
+    return pd.DataFrame(utilities, index=expression_values.index, columns=alternatives)
+
+
+def float_values(expression_values):
+    """
+    expression_values as a float32 or float64 array
+    """
+    values = expression_values.values
+    if values.dtype not in [np.float32, np.float64]:
+        values = values.astype(np.float64)
+    return values
+
 
-    utilities = expression_values.dot(spec)
+def dot_coefficients(values, coefficients):
+    """
+    Matrix product of values with coefficients, using sparse_dot if coefficients are sparse
+    and each expression's values are contiguous
+    """
+
+    if values.strides[0] == values.itemsize and \
+            np.count_nonzero(coefficients) <= SPARSE_SPEC_MAX_DENSITY * coefficients.size:
+        return sparse_dot(values, coefficients)
+
+    return np.dot(values, coefficients)
+
+
+def sparse_dot(values, coefficients):
+    """
+    Matrix product of values and a sparse coefficients matrix
+
+    Each nonzero coefficient's expression values column is scaled and added to its
+    alternative's utilities, so the cost is proportional to the number of nonzero
+    coefficients rather than to expressions x alternatives.
+
+    As with a dense product, nan or inf values of an expression make the utilities of the
+    alternatives for which it has a zero coefficient nan (0 * nan and 0 * inf are nan), so that
+    utilities don't depend on whether dot_coefficients chose the sparse or dense product.
+
+    Parameters
+    ----------
+    values : 2D numpy.ndarray
+        one row per chooser and one column per expression (column-major for efficiency)
+    coefficients : 2D numpy.ndarray
+        one row per expression and one column per alternative
+
+    Returns
+    -------
+    utilities : 2D numpy.ndarray
+        one row per chooser and one column per alternative
+    """
+
+    # column-major so each alternative's utilities are contiguous
+    utilities = np.zeros((values.shape[0], coefficients.shape[1]), dtype=values.dtype, order='F')
+    partial_utilities = np.empty(values.shape[0], dtype=values.dtype)
+
+    for i, j in zip(*np.nonzero(coefficients)):
+        np.multiply(values[:, i], coefficients[i, j], out=partial_utilities)
+        utilities[:, j] += partial_utilities
+
+    # skipped zero coefficients of non-finite values propagate nan, as in np.dot
+    if not np.isfinite(values).all():
+        for i in np.flatnonzero((coefficients == 0).any(axis=1)):
+            rows = np.flatnonzero(~np.isfinite(values[:, i]))
+            if len(rows):
+                utilities[np.ix_(rows, np.flatnonzero(coefficients[i] == 0))] = np.nan
 
     return utilities
 
 
+def expression_values_dtype():
+    """
+    dtype for expression values (from the expression_values_dtype setting)
+
+    float32 halves the memory used by expression values, at the cost of precision
+    """
+    return np.dtype(inject.get_injectable('expression_values_dtype', 'float64'))
+
+
 def add_skims(df, skims):
     """
     Add the dataframe to the SkimDictWrapper object so that it can be dereferenced
@@ -252,31 +463,27 @@ def compute_nested_exp_utilities(raw_utilities, nest_spec):
     nested_utilities : pandas.DataFrame
         Will have the index of `raw_utilities` and columns for exponentiated leaf and node utilities
     """
-    nested_utilities = pd.DataFrame(index=raw_utilities.index)
 
-    for nest in logit.each_nest(nest_spec, post_order=True):
+    nests = logit.compile_nest_spec(nest_spec)
 
-        name = nest.name
+    nested_utilities = np.empty((len(raw_utilities.index), len(nests.names)), dtype=np.float64)
 
-        if nest.is_leaf:
-            # leaf_utility = raw_utility / nest.product_of_coefficients
-            nested_utilities[name] = \
-                raw_utilities[name].astype(float) / nest.product_of_coefficients
+    # leaf_utility = raw_utility / nest.product_of_coefficients
+    leaf_utilities = raw_utilities[nests.leaf_names].values.astype(np.float64)
+    nested_utilities[:, nests.leaf_columns] = np.exp(leaf_utilities / nests.leaf_products)
 
-        else:
-            # nest node
-            # the alternative nested_utilities will already have been computed due to post_order
-            # this will RuntimeWarning: divide by zero encountered in log
-            # if all nest alternative utilities are zero
-            # but the resulting inf will become 0 when exp is applied below
-            with np.errstate(divide='ignore'):
-                nested_utilities[name] = \
-                    nest.coefficient * np.log(nested_utilities[nest.alternatives].sum(axis=1))
+    # nest nodes one level at a time, so alternative nested_utilities will already be computed
+    for node_columns, coefficients, alternative_columns, starts in nests.node_levels:
 
-        # exponentiate the utility
-        nested_utilities[name] = np.exp(nested_utilities[name])
+        sums = np.add.reduceat(nested_utilities[:, alternative_columns], starts, axis=1)
 
-    return nested_utilities
+        # this would RuntimeWarning: divide by zero encountered in log
+        # if all nest alternative utilities are zero
+        # but the resulting inf will become 0 when exp is applied
+        with np.errstate(divide='ignore'):
+            nested_utilities[:, node_columns] = np.exp(coefficients * np.log(sums))
+
+    return pd.DataFrame(nested_utilities, index=raw_utilities.index, columns=nests.names)
 
 
 def compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label):
@@ -299,18 +506,37 @@ def compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label):
         Will have the index of `nested_exp_utilities` and columns for leaf and node probabilities
     """
 
-    nested_probabilities = pd.DataFrame(index=nested_exp_utilities.index)
+    nests = logit.compile_nest_spec(nest_spec)
+
+    # exponentiated utilities of the alternatives of every node, node by node
+    columns = nested_exp_utilities.columns.get_indexer(nests.prob_names)
+    assert (columns >= 0).all()
+    utils_arr = nested_exp_utilities.values[:, columns]
+
+    # same as logit.utils_to_probs(exponentiated=True, allow_zero_probs=True) for each node
+    np.clip(utils_arr, logit.EXP_UTIL_MIN, logit.EXP_UTIL_MAX, out=utils_arr)
+    utils_arr[utils_arr == logit.EXP_UTIL_MIN] = 0.0
+
+    arr_sum = np.add.reduceat(utils_arr, nests.prob_starts, axis=1)
 
-    for nest in logit.each_nest(nest_spec, type='node', post_order=False):
+    inf_utils = np.isinf(arr_sum).any(axis=1)
+    if inf_utils.any():
+        utils_trace_label = tracing.extend_trace_label(trace_label, 'utils_to_probs')
+        logit.report_bad_choices(
+            inf_utils,
+            pd.DataFrame(utils_arr, index=nested_exp_utilities.index, columns=nests.prob_names),
+            tracing.extend_trace_label(utils_trace_label, 'inf_exp_utils'),
+            msg="infinite exponentiated utilities")
+
+    # nodes whose alternatives all have zero utility will have all zero probabilities
+    with np.errstate(invalid='ignore'):
+        np.divide(utils_arr, np.repeat(arr_sum, nests.prob_counts, axis=1), out=utils_arr)
 
-        probs = logit.utils_to_probs(nested_exp_utilities[nest.alternatives],
-                                     trace_label=trace_label,
-                                     exponentiated=True,
-                                     allow_zero_probs=True)
+    utils_arr[np.isnan(utils_arr)] = logit.PROB_MIN
 
-        nested_probabilities = pd.concat([nested_probabilities, probs], axis=1)
+    np.clip(utils_arr, logit.PROB_MIN, logit.PROB_MAX, out=utils_arr)
 
-    return nested_probabilities
+    return pd.DataFrame(utils_arr, index=nested_exp_utilities.index, columns=nests.prob_names)
 
 
 def compute_base_probabilities(nested_probabilities, nests):
@@ -332,20 +558,27 @@ def compute_base_probabilities(nested_probabilities, nests):
         Will have the index of `nested_probabilities` and columns for leaf base probabilities
     """
 
-    base_probabilities = pd.DataFrame(index=nested_probabilities.index)
+    compiled_nests = logit.compile_nest_spec(nests)
 
-    for nest in logit.each_nest(nests, type='leaf', post_order=False):
+    # nested probabilities with an extra column of ones for padded ancestor_columns
+    # (root has a prob of 1 but we didn't compute a nested probability column for it)
+    probs = np.ones((len(nested_probabilities.index), len(compiled_nests.prob_names) + 1))
+    columns = nested_probabilities.columns.get_indexer(compiled_nests.prob_names)
+    assert (columns >= 0).all()
+    probs[:, :-1] = nested_probabilities.values[:, columns]
 
-        # skip root: it has a prob of 1 but we didn't compute a nested probability column for it
-        ancestors = nest.ancestors[1:]
+    # product of the nested probabilities of each leaf's ancestors
+    ancestor_columns = compiled_nests.ancestor_columns
+    base_probabilities = probs[:, ancestor_columns[:, 0]]
+    for i in range(1, ancestor_columns.shape[1]):
+        base_probabilities *= probs[:, ancestor_columns[:, i]]
 
-        base_probabilities[nest.name] = nested_probabilities[ancestors].prod(axis=1)
-
-    return base_probabilities
+    return pd.DataFrame(base_probabilities, index=nested_probabilities.index,
+                        columns=compiled_nests.leaf_names)
 
 
 def eval_mnl(choosers, spec, locals_d,
-             trace_label=None, trace_choice_name=None):
+             trace_label=None, trace_choice_name=None, segment_key=None):
     """
     Run a simulation for when the model spec does not involve alternative
     specific data, e.g. there are no interactions with alternative
@@ -374,6 +607,9 @@ def eval_mnl(choosers, spec, locals_d,
         when household tracing enabled. No tracing occurs if label is empty or None.
     trace_choice_name: str
         This is the column label to be used in trace file csv dump of choices
+    segment_key : str or None
+        if not None, spec is a segmented spec (with segment and alternative column levels)
+        and the coefficients used for each chooser are those of its choosers[segment_key] segment
 
     Returns
     -------
@@ -389,7 +625,8 @@ def eval_mnl(choosers, spec, locals_d,
 
     t0 = tracing.print_elapsed_time()
 
-    expression_values = eval_variables(spec.index, choosers, locals_d)
+    expression_values = eval_variables(spec.index, choosers, locals_d,
+                                       target_type=expression_values_dtype())
     t0 = tracing.print_elapsed_time("eval_variables", t0, debug=True)
 
     if check_for_variability:
@@ -400,7 +637,8 @@ def eval_mnl(choosers, spec, locals_d,
     # resulting in a dataframe with one row per chooser and one column per alternative
     # pandas.dot depends on column names of expression_values matching spec index values
 
-    utilities = compute_utilities(expression_values, spec)
+    segments = choosers[segment_key] if segment_key else None
+    utilities = compute_utilities(expression_values, spec, segments)
     t0 = tracing.print_elapsed_time("expression_values.dot", t0, debug=True)
 
     probs = logit.utils_to_probs(utilities, trace_label=trace_label, trace_choosers=choosers)
@@ -433,7 +671,7 @@ def eval_mnl(choosers, spec, locals_d,
 
 
 def eval_nl(choosers, spec, nest_spec, locals_d,
-            trace_label=None, trace_choice_name=None):
+            trace_label=None, trace_choice_name=None, segment_key=None):
     """
     Run a nested-logit simulation for when the model spec does not involve alternative
     specific data, e.g. there are no interactions with alternative
@@ -457,6 +695,9 @@ def eval_nl(choosers, spec, nest_spec, locals_d,
         when household tracing enabled. No tracing occurs if label is empty or None.
     trace_choice_name: str
         This is the column label to be used in trace file csv dump of choices
+    segment_key : str or None
+        if not None, spec is a segmented spec (with segment and alternative column levels)
+        and the coefficients used for each chooser are those of its choosers[segment_key] segment
 
     Returns
     -------
@@ -473,7 +714,8 @@ def eval_nl(choosers, spec, nest_spec, locals_d,
     t0 = tracing.print_elapsed_time()
 
     # column names of expression_values match spec index values
-    expression_values = eval_variables(spec.index, choosers, locals_d)
+    expression_values = eval_variables(spec.index, choosers, locals_d,
+                                       target_type=expression_values_dtype())
     t0 = tracing.print_elapsed_time("eval_variables", t0, debug=True)
 
     if check_for_variability:
@@ -481,7 +723,8 @@ def eval_nl(choosers, spec, nest_spec, locals_d,
     t0 = tracing.print_elapsed_time("_check_for_variability", t0, debug=True)
 
     # raw utilities of all the leaves
-    raw_utilities = compute_utilities(expression_values, spec)
+    segments = choosers[segment_key] if segment_key else None
+    raw_utilities = compute_utilities(expression_values, spec, segments)
     t0 = tracing.print_elapsed_time("expression_values.dot", t0, debug=True)
 
     # exponentiated utilities of leaves and nests
@@ -545,7 +788,7 @@ def eval_nl(choosers, spec, nest_spec, locals_d,
 
 
 def _simple_simulate(choosers, spec, nest_spec, skims=None, locals_d=None,
-                     trace_label=None, trace_choice_name=None):
+                     trace_label=None, trace_choice_name=None, segment_key=None):
     """
     Run an MNL or NL simulation for when the model spec does not involve alternative
     specific data, e.g. there are no interactions with alternative
@@ -577,6 +820,9 @@ def _simple_simulate(choosers, spec, nest_spec, skims=None, locals_d=None,
         when household tracing enabled. No tracing occurs if label is empty or None.
     trace_choice_name: str
         This is the column label to be used in trace file csv dump of choices
+    segment_key : str or None
+        if not None, spec is a segmented spec (with segment and alternative column levels)
+        and the coefficients used for each chooser are those of its choosers[segment_key] segment
 
     Returns
     -------
@@ -590,10 +836,12 @@ def _simple_simulate(choosers, spec, nest_spec, skims=None, locals_d=None,
 
     if nest_spec is None:
         choices = eval_mnl(choosers, spec, locals_d,
-                           trace_label=trace_label, trace_choice_name=trace_choice_name)
+                           trace_label=trace_label, trace_choice_name=trace_choice_name,
+                           segment_key=segment_key)
     else:
         choices = eval_nl(choosers, spec, nest_spec, locals_d,
-                          trace_label=trace_label, trace_choice_name=trace_choice_name)
+                          trace_label=trace_label, trace_choice_name=trace_choice_name,
+                          segment_key=segment_key)
 
     return choices
 
@@ -611,6 +859,10 @@ def simple_simulate_rpc(chunk_size, choosers, spec, nest_spec, trace_label):
 
     chooser_row_size = len(choosers.columns)
 
+    if spec.columns.nlevels > 1:
+        # segmented spec - utilities and probs are only computed for one segment's alternatives
+        spec = spec[spec.columns.get_level_values(0)[0]]
+
     if nest_spec is None:
         # expression_values for each spec row
         # utilities and probs for each alt
@@ -635,41 +887,54 @@ def simple_simulate_rpc(chunk_size, choosers, spec, nest_spec, trace_label):
 
 
 def simple_simulate(choosers, spec, nest_spec, skims=None, locals_d=None, chunk_size=0,
-                    trace_label=None, trace_choice_name=None):
+                    trace_label=None, trace_choice_name=None, segment_key=None):
     """
     Run an MNL or NL simulation for when the model spec does not involve alternative
     specific data, e.g. there are no interactions with alternative
     properties and no need to sample from alternatives.
+
+    If segment_key is not None, spec is a segmented spec and choosers from all segments
+    are simulated together (see compute_segmented_utilities)
     """
 
     trace_label = tracing.extend_trace_label(trace_label, 'simple_simulate')
 
     assert len(choosers) > 0
 
-    rows_per_chunk = simple_simulate_rpc(chunk_size, choosers, spec, nest_spec, trace_label)
+    num_threads = chunk.get_num_threads()
+
+    rows_per_chunk = simple_simulate_rpc(chunk.thread_chunk_size(chunk_size, num_threads),
+                                         choosers, spec, nest_spec, trace_label)
+    rows_per_chunk = chunk.thread_rows_per_chunk(rows_per_chunk, len(choosers.index), num_threads)
 
-    logger.info("simple_simulate rows_per_chunk %s num_choosers %s" %
-                (rows_per_chunk, len(choosers.index)))
+    logger.info("simple_simulate rows_per_chunk %s num_choosers %s num_threads %s" %
+                (rows_per_chunk, len(choosers.index), num_threads))
 
-    result_list = []
-    # segment by person type and pick the right spec for each person type
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    def run_chunk(i, num_chunks, chooser_chunk):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
         chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i) \
             if num_chunks > 1 else trace_label
 
-        choices = _simple_simulate(
+        chunk_skims, chunk_locals_d = \
+            chunk.thread_skims(skims, locals_d) if num_threads > 1 else (skims, locals_d)
+
+        return _simple_simulate(
             chooser_chunk, spec, nest_spec,
-            skims, locals_d,
+            chunk_skims, chunk_locals_d,
             chunk_trace_label,
-            trace_choice_name)
+            trace_choice_name,
+            segment_key)
 
-        result_list.append(choices)
+    result_list = chunk.map_chunks(run_chunk,
+                                   chunk.chunked_choosers(
+                                       choosers, rows_per_chunk,
+                                       chunk.thread_chunk_size(chunk_size, num_threads),
+                                       trace_label),
+                                   num_threads)
 
-    if len(result_list) > 1:
-        choices = pd.concat(result_list)
+    choices = pd.concat(result_list) if len(result_list) > 1 else result_list[0]
 
     assert len(choices.index == len(choosers.index))
 
@@ -694,7 +959,8 @@ def eval_mnl_logsums(choosers, spec, locals_d, trace_label=None):
     logger.debug("running eval_mnl_logsums")
     t0 = tracing.print_elapsed_time()
 
-    expression_values = eval_variables(spec.index, choosers, locals_d)
+    expression_values = eval_variables(spec.index, choosers, locals_d,
+                                       target_type=expression_values_dtype())
     t0 = tracing.print_elapsed_time("eval_variables", t0, debug=True)
 
     if check_for_variability:
@@ -705,9 +971,10 @@ def eval_mnl_logsums(choosers, spec, locals_d, trace_label=None):
     t0 = tracing.print_elapsed_time("compute_utilities", t0, debug=True)
 
     # logsum is log of exponentiated utilities summed across columns of each chooser row
-    utils_arr = utilities.as_matrix().astype('float')
-    logsums = np.log(np.exp(utils_arr).sum(axis=1))
-    logsums = pd.Series(logsums, index=choosers.index)
+    # computed in place in the utilities buffer (unless we need utilities for tracing)
+    utils_arr = utilities.values.astype(np.float64, copy=bool(have_trace_targets))
+    logsums = pd.Series(logit.logsums(utils_arr), index=choosers.index)
+    t0 = tracing.print_elapsed_time("logsums", t0, debug=True)
 
     cum_size = chunk.log_df_size(trace_label, 'choosers', choosers, cum_size=None)
     cum_size = chunk.log_df_size(trace_label, 'expression_values', expression_values, cum_size)
@@ -748,7 +1015,8 @@ def eval_nl_logsums(choosers, spec, nest_spec, locals_d, trace_label=None):
     t0 = tracing.print_elapsed_time()
 
     # column names of expression_values match spec index values
-    expression_values = eval_variables(spec.index, choosers, locals_d)
+    expression_values = eval_variables(spec.index, choosers, locals_d,
+                                       target_type=expression_values_dtype())
     t0 = tracing.print_elapsed_time("eval_variables", t0, debug=True)
 
     if check_for_variability:
@@ -759,22 +1027,22 @@ def eval_nl_logsums(choosers, spec, nest_spec, locals_d, trace_label=None):
     raw_utilities = compute_utilities(expression_values, spec)
     t0 = tracing.print_elapsed_time("expression_values.dot", t0, debug=True)
 
-    # exponentiated utilities of leaves and nests
-    nested_exp_utilities = compute_nested_exp_utilities(raw_utilities, nest_spec)
-    t0 = tracing.print_elapsed_time("compute_nested_exp_utilities", t0, debug=True)
-
-    logsums = np.log(nested_exp_utilities.root)
+    # root logsums computed from nest logsums (rather than exponentiated nest utilities)
+    leaf_names = logit.compile_nest_spec(nest_spec).leaf_names
+    if list(raw_utilities.columns) != leaf_names:
+        raw_utilities = raw_utilities[leaf_names]
+    logsums = logit.nested_logsums(raw_utilities.values, nest_spec)
     logsums = pd.Series(logsums, index=choosers.index)
     t0 = tracing.print_elapsed_time("logsums", t0, debug=True)
 
     cum_size = chunk.log_df_size(trace_label, 'choosers', choosers, cum_size=None)
     cum_size = chunk.log_df_size(trace_label, 'expression_values', expression_values, cum_size)
     cum_size = chunk.log_df_size(trace_label, "raw_utilities", raw_utilities, cum_size)
-    cum_size = chunk.log_df_size(trace_label, "nested_exp_utils", nested_exp_utilities, cum_size)
     chunk.log_chunk_size(trace_label, cum_size)
 
     if have_trace_targets:
-        # add logsum to nested_exp_utilities for tracing
+        # exponentiated utilities of leaves and nests (with logsum added) for tracing
+        nested_exp_utilities = compute_nested_exp_utilities(raw_utilities, nest_spec)
         nested_exp_utilities['logsum'] = logsums
 
         tracing.trace_df(choosers, '%s.choosers' % trace_label)
@@ -829,7 +1097,7 @@ def simple_simulate_logsums_rpc(chunk_size, choosers, spec, nest_spec, trace_lab
     else:
         # expression_values for each spec row
         # raw_utilities for each alt
-        # nested_exp_utilities for each nest
+        # nest logsums for each nest
         extra_columns = spec.shape[0] + spec.shape[1] + logit.count_nests(nest_spec)
 
     row_size = chooser_row_size + extra_columns
@@ -856,28 +1124,39 @@ def simple_simulate_logsums(choosers, spec, nest_spec,
 
     assert len(choosers) > 0
 
-    rows_per_chunk = simple_simulate_logsums_rpc(chunk_size, choosers, spec, nest_spec, trace_label)
-    logger.info("%s chunk_size %s num_choosers %s, rows_per_chunk %s" %
-                (trace_label, chunk_size, len(choosers.index), rows_per_chunk))
+    num_threads = chunk.get_num_threads()
 
-    result_list = []
-    # segment by person type and pick the right spec for each person type
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    rows_per_chunk = \
+        simple_simulate_logsums_rpc(chunk.thread_chunk_size(chunk_size, num_threads),
+                                    choosers, spec, nest_spec, trace_label)
+    rows_per_chunk = chunk.thread_rows_per_chunk(rows_per_chunk, len(choosers.index), num_threads)
+
+    logger.info("%s chunk_size %s num_choosers %s, rows_per_chunk %s num_threads %s" %
+                (trace_label, chunk_size, len(choosers.index), rows_per_chunk, num_threads))
+
+    def run_chunk(i, num_chunks, chooser_chunk):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
         chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i) \
             if num_chunks > 1 else trace_label
 
-        logsums = _simple_simulate_logsums(
+        chunk_skims, chunk_locals_d = \
+            chunk.thread_skims(skims, locals_d) if num_threads > 1 else (skims, locals_d)
+
+        return _simple_simulate_logsums(
             chooser_chunk, spec, nest_spec,
-            skims, locals_d,
+            chunk_skims, chunk_locals_d,
             chunk_trace_label)
 
-        result_list.append(logsums)
+    result_list = chunk.map_chunks(run_chunk,
+                                   chunk.chunked_choosers(
+                                       choosers, rows_per_chunk,
+                                       chunk.thread_chunk_size(chunk_size, num_threads),
+                                       trace_label),
+                                   num_threads)
 
-    if len(result_list) > 1:
-        logsums = pd.concat(result_list)
+    logsums = pd.concat(result_list) if len(result_list) > 1 else result_list[0]
 
     assert len(logsums.index == len(choosers.index))
 
@@ -1,21 +1,35 @@
 # ActivitySim
 # See full license in LICENSE.txt.
 
+import os
+import ctypes
+import fnmatch
 import logging
+import multiprocessing
 
 import numpy as np
 import pandas as pd
+import yaml
+from pandas.api.types import is_categorical_dtype
 
 from activitysim.core.util import quick_loc_series
+from activitysim.core.broadcast import BroadcastFrame, BroadcastArray
 
 
 logger = logging.getLogger(__name__)
 
+# max ratio of max zone id to number of zones for which OffsetMapper uses a dense offset array
+MAX_OFFSET_ARRAY_SPARSITY = 100
+
+# default cap on memory used by each skim wrapper to memoize lookups (None for no cap)
+DEFAULT_SKIM_MEMO_MAX_BYTES = 256 * 1024 * 1024
+
 
 class OffsetMapper(object):
 
     def __init__(self, offset_int=None):
         self.offset_series = None
+        self.offset_array = None
         self.offset_int = offset_int
 
     def set_offset_list(self, offset_list):
@@ -33,6 +47,14 @@ class OffsetMapper(object):
 
         if self.offset_series is None:
             self.offset_series = pd.Series(data=range(len(offset_list)), index=offset_list)
+
+            # dense zone_id -> offset lookup array (with -1 for ids not in offset_list)
+            # unless zone ids are negative or too sparse for an array sized to the max zone id
+            max_zone_id = max(offset_list)
+            if min(offset_list) >= 0 and \
+                    max_zone_id < MAX_OFFSET_ARRAY_SPARSITY * len(offset_list):
+                self.offset_array = np.full(max_zone_id + 1, -1, dtype=np.intp)
+                self.offset_array[offset_list] = np.arange(len(offset_list))
         else:
             # make sure it offsets are the same
             assert (offset_list == self.offset_series.index).all()
@@ -53,7 +75,18 @@ class OffsetMapper(object):
 
         # print "\nmap_offsets zone_ids", zone_ids
 
-        if self.offset_series is not None:
+        if self.offset_array is not None:
+            assert(self.offset_int is None)
+
+            zone_ids = np.asanyarray(zone_ids)
+            assert zone_ids.size == 0 or \
+                (zone_ids.min() >= 0 and zone_ids.max() < len(self.offset_array)), \
+                "OffsetMapper.map zone ids out of range of offset list"
+
+            offsets = self.offset_array[zone_ids]
+            assert (offsets >= 0).all(), "OffsetMapper.map zone ids not in offset list"
+
+        elif self.offset_series is not None:
             assert(self.offset_int is None)
             assert isinstance(self.offset_series, pd.Series)
 
@@ -72,6 +105,52 @@ class OffsetMapper(object):
         return offsets
 
 
+def unpack_skim_values(values, scale=None):
+    """
+    Convert values of a reduced precision skim (see skim_storage) to float64, scaled by scale
+
+    Values of skims without a scale with dtypes of at least 32 bits are returned as is.
+    """
+
+    if scale is None and values.dtype.itemsize >= 4:
+        return values
+
+    values = values.astype(np.float64)
+    if scale is not None:
+        values *= scale
+
+    return values
+
+
+class SkimLookupMemo(object):
+    """
+    Memo of the skim lookups of a skim wrapper for its current df, keyed by skim key
+
+    Lookups are not memoized once the memo holds max_bytes of skim values
+    (or at all if max_bytes is 0), and the memo is cleared when the wrapper df is set.
+    Memoized values are shared by every expression that reads the same skim,
+    so they must not be modified in place.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        self.values = {}
+        self.nbytes = 0
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def add(self, key, values):
+
+        nbytes = values.values.nbytes
+        if self.max_bytes is None or self.nbytes + nbytes <= self.max_bytes:
+            self.values[key] = values
+            self.nbytes += nbytes
+
+
 class SkimWrapper(object):
     """
     Container for skim arrays.
@@ -84,12 +163,14 @@ class SkimWrapper(object):
         values to turn them into array indices.
         For example, if zone IDs are 1-based, an offset of -1
         would turn them into 0-based array indices.
-
+    scale : float, optional
+        scale factor for skims stored as scaled integers (see skim_storage)
     """
-    def __init__(self, data, offset_mapper=None):
+    def __init__(self, data, offset_mapper=None, scale=None):
 
         self.data = data
         self.offset_mapper = offset_mapper if offset_mapper is not None else OffsetMapper()
+        self.scale = scale
 
     def get(self, orig, dest):
         """
@@ -103,11 +184,19 @@ class SkimWrapper(object):
         Returns
         -------
         values : 1D array
+            in the skim dtype if orig and dest are integer arrays (or float64 if the skim is
+            stored in reduced precision), otherwise float64 with NaN for NaN orig or dest
 
         """
         # only working with numpy in here
         orig = np.asanyarray(orig)
         dest = np.asanyarray(dest)
+
+        # integer zone ids can't be NaN, so no need to mask them
+        if orig.dtype.kind in 'iu' and dest.dtype.kind in 'iu':
+            result = self.data[self.offset_mapper.map(orig), self.offset_mapper.map(dest)]
+            return unpack_skim_values(result, self.scale)
+
         out_shape = orig.shape
 
         # filter orig and dest to only the real-number pairs
@@ -125,6 +214,54 @@ class SkimWrapper(object):
         out[notnan] = result
         out[~notnan] = np.nan
 
+        if self.scale is not None:
+            out *= self.scale
+
+        return out
+
+    def get_broadcast(self, orig, dest):
+        """
+        Get impedence values for every combination of origins and destinations.
+
+        orig and dest are (n, 1) and (1, m) arrays (or vice versa), and the skim values are
+        gathered with a single fancy index of the skim by the broadcast origin and destination
+        offsets, without materializing n * m origin and destination zone ids.
+
+        Parameters
+        ----------
+        orig : 2D array
+        dest : 2D array
+
+        Returns
+        -------
+        values : 2D array
+            of the broadcast shape of orig and dest, with the dtype of get
+        """
+
+        orig = np.asanyarray(orig)
+        dest = np.asanyarray(dest)
+
+        if orig.dtype.kind in 'iu' and dest.dtype.kind in 'iu':
+            orig = self.offset_mapper.map(orig.ravel()).reshape(orig.shape)
+            dest = self.offset_mapper.map(dest.ravel()).reshape(dest.shape)
+            return unpack_skim_values(self.data[orig, dest], self.scale)
+
+        # look up NaN zones as offset 0 and put the nans back in the result
+        orig_nan = np.isnan(orig)
+        dest_nan = np.isnan(dest)
+
+        orig_offsets = np.zeros(orig.shape, dtype=np.intp)
+        orig_offsets[~orig_nan] = self.offset_mapper.map(orig[~orig_nan].astype('int'))
+        dest_offsets = np.zeros(dest.shape, dtype=np.intp)
+        dest_offsets[~dest_nan] = self.offset_mapper.map(dest[~dest_nan].astype('int'))
+
+        out = self.data[orig_offsets, dest_offsets].astype(np.float64)
+
+        if self.scale is not None:
+            out *= self.scale
+
+        out[orig_nan | dest_nan] = np.nan
+
         return out
 
 
@@ -140,8 +277,13 @@ class SkimDict(object):
     def __init__(self):
         self.skims = {}
         self.offset_mapper = OffsetMapper()
+        self.memo_max_bytes = DEFAULT_SKIM_MEMO_MAX_BYTES
+        # 3D arrays of already stacked skims for tuple keys, keyed by first item of tuple key
+        self.stacks = {}
+        # scale factors of skims (and stacks) stored as scaled integers
+        self.scales = {}
 
-    def set(self, key, skim_data):
+    def set(self, key, skim_data, scale=None):
         """
         Set skim data for key
 
@@ -151,6 +293,8 @@ class SkimDict(object):
              The key (identifier) for this skim object
         skim_data : Skim
              The skim object
+        scale : float, optional
+             scale factor if skim_data is stored as scaled integers (see skim_storage)
 
         Returns
         -------
@@ -163,10 +307,71 @@ class SkimDict(object):
 
         self.skims[key] = np.asanyarray(skim_data)
 
+        if scale is not None:
+            self.scales[key] = scale
+        else:
+            self.scales.pop(key, None)
+
         # print "\n### %s" % (key,)
         # print "type(skim_data)", type(skim_data)
         # print "skim_data.shape", skim_data.shape
 
+    def set_stack(self, key1, key2_list, stacked_skim_data, scale=None):
+        """
+        Set already stacked skim data for the tuple keys (key1, key2) for key2 in key2_list
+
+        The skims for the individual tuple keys are set to views into stacked_skim_data,
+        which SkimStack will then use as is instead of stacking (copying) them itself.
+
+        Parameters
+        ----------
+        key1 : str
+            first item of the tuple keys
+        key2_list : list of str
+            second items of the tuple keys in the order they are stacked
+        stacked_skim_data : 3D array
+            skim data with the skim for key2_list[i] in stacked_skim_data[i]
+        scale : float, optional
+            scale factor if stacked_skim_data is stored as scaled integers (see skim_storage)
+        """
+
+        assert stacked_skim_data.ndim == 3
+        assert stacked_skim_data.shape[0] == len(key2_list)
+
+        self.stacks[key1] = (stacked_skim_data, list(key2_list))
+
+        if scale is not None:
+            self.scales[key1] = scale
+
+        for i, key2 in enumerate(key2_list):
+            self.set((key1, key2), stacked_skim_data[i], scale)
+
+    def stack(self, key1, key2_list):
+        """
+        Stack the skims for the tuple keys (key1, key2) for key2 in key2_list into a single
+        3D array and replace them with views into it (see set_stack)
+
+        The skims are copied into the stacked array one at a time, and each original array is
+        replaced by its view into the stacked array as soon as it is copied, so (unless the
+        caller holds references to them) memory is only briefly doubled for a single skim.
+        """
+
+        keys = [(key1, key2) for key2 in key2_list]
+
+        scales = set(self.scales.get(key) for key in keys)
+        assert len(scales) == 1, "SkimDict.stack %s skims have different scales" % key1
+
+        shape = self.skims[keys[0]].shape
+        dtype = np.result_type(*[self.skims[key].dtype for key in keys])
+
+        stacked_skim_data = np.empty((len(keys), ) + shape, dtype=dtype)
+        for i, key in enumerate(keys):
+            stacked_skim_data[i] = self.skims[key]
+            # release the original
+            self.skims[key] = stacked_skim_data[i]
+
+        self.set_stack(key1, key2_list, stacked_skim_data, scales.pop())
+
     def get(self, key):
         """
         Get an available skim object (not the lookup)
@@ -181,13 +386,13 @@ class SkimDict(object):
         skim: Skim
              The skim object
         """
-        return SkimWrapper(self.skims[key], self.offset_mapper)
+        return SkimWrapper(self.skims[key], self.offset_mapper, self.scales.get(key))
 
     def wrap(self, left_key, right_key):
         """
         return a SkimDictWrapper for self
         """
-        return SkimDictWrapper(self, left_key, right_key)
+        return SkimDictWrapper(self, left_key, right_key, memo_max_bytes=self.memo_max_bytes)
 
 
 class SkimDictWrapper(object):
@@ -211,13 +416,17 @@ class SkimDictWrapper(object):
     to use in the expressions.
 
     Note that keys are either strings or tuples of two strings (to support stacking of skims.)
+
+    Lookups are memoized until the next set_df (see SkimLookupMemo), so expressions that
+    reference the same skim only do the O-D lookup once.
     """
 
-    def __init__(self, skim_dict, left_key, right_key):
+    def __init__(self, skim_dict, left_key, right_key, memo_max_bytes=None):
         self.skim_dict = skim_dict
         self.left_key = left_key
         self.right_key = right_key
         self.df = None
+        self.memo = SkimLookupMemo(memo_max_bytes)
 
     def set_df(self, df):
         """
@@ -233,6 +442,14 @@ class SkimDictWrapper(object):
         Nothing
         """
         self.df = df
+        self.memo.clear()
+
+    def copy(self):
+        """
+        return a new SkimDictWrapper for the same skims and keys (with no df or memoized lookups)
+        """
+        return SkimDictWrapper(self.skim_dict, self.left_key, self.right_key,
+                               memo_max_bytes=self.memo.max_bytes)
 
     def lookup(self, key):
         """
@@ -248,8 +465,13 @@ class SkimDictWrapper(object):
         impedances: pd.Series
             A Series of impedances which are elements of the Skim object and
             with the same index as df
+            (or an (n, m) BroadcastArray if df is a BroadcastFrame)
         """
 
+        s = self.memo.get(key)
+        if s is not None:
+            return s
+
         # The skim object to perform the lookup
         # using df[left_key] as the origin and df[right_key] as the destination
         skim = self.skim_dict.get(key)
@@ -262,9 +484,19 @@ class SkimDictWrapper(object):
         #     destinations = destinations + self.offset
 
         assert self.df is not None, "Call set_df first"
-        s = skim.get(self.df[self.left_key],
-                     self.df[self.right_key])
-        return pd.Series(s, index=self.df.index)
+        if isinstance(self.df, BroadcastFrame):
+            # (n, m) values for chooser and alternative keys broadcast against each other
+            s = skim.get_broadcast(self.df[self.left_key].values,
+                                   self.df[self.right_key].values)
+            s = s.view(BroadcastArray)
+        else:
+            s = skim.get(self.df[self.left_key],
+                         self.df[self.right_key])
+            s = pd.Series(s, index=self.df.index)
+
+        self.memo.add(key, s)
+
+        return s
 
     def __getitem__(self, key):
         """
@@ -290,31 +522,30 @@ class SkimStack(object):
 
         self.skims_data = {}
         self.skim_keys_to_indexes = {}
+        self.skim_scales = {}
         self.offset_mapper = skim_dict.offset_mapper
+        self.memo_max_bytes = skim_dict.memo_max_bytes
 
-        # pass to make dictionary of dictionaries where highest level is unique
-        # first items of the tuples and the 2nd level is the second items of
-        # the tuples
-        for key, skim_data in skim_dict.skims.iteritems():
+        # stack any tuple key skims that skim_dict doesn't already have stacked
+        unstacked = {}
+        for key in skim_dict.skims:
             if not isinstance(key, tuple) or not len(key) == 2:
                 logger.debug("SkimStack __init__ skipping key: %s" % key)
                 continue
-            logger.debug("SkimStack __init__ loading key: %s" % (key,))
             skim_key1, skim_key2 = key
-            # logger.debug("SkimStack init key: key1='%s' key2='%s'" % (skim_key1, skim_key2))
-            # FIXME - this copys object reference
-            self.skims_data.setdefault(skim_key1, {})[skim_key2] = skim_data
+            if skim_key1 not in skim_dict.stacks:
+                unstacked.setdefault(skim_key1, []).append(skim_key2)
 
-            # print "\n### %s" % (key,)
-            # print "type(skim_data)", type(skim_data)
-            # print "skim_data.shape", skim_data.shape
+        for skim_key1, key2_list in unstacked.iteritems():
+            skim_dict.stack(skim_key1, sorted(key2_list))
 
-        # second pass to turn the each highest level value into a 3D array
-        # with a dictionary to make second level keys to indexes
-        for skim_key1, value in self.skims_data.iteritems():
-            # FIXME - this actually copies/creates new stacked data
-            self.skims_data[skim_key1] = np.dstack(value.values())
-            self.skim_keys_to_indexes[skim_key1] = dict(zip(value.keys(), range(len(value))))
+        # stacked skims are period-major (n_periods, n_zones, n_zones) arrays
+        # with a dictionary to map second level keys to indexes
+        for skim_key1, (stacked_skim_data, key2_list) in skim_dict.stacks.iteritems():
+            logger.debug("SkimStack __init__ loading key: %s" % skim_key1)
+            self.skims_data[skim_key1] = stacked_skim_data
+            self.skim_keys_to_indexes[skim_key1] = dict(zip(key2_list, range(len(key2_list))))
+            self.skim_scales[skim_key1] = skim_dict.scales.get(skim_key1)
 
         logger.info("SkimStack.__init__ loaded %s keys with %s total skims"
                     % (len(self.skim_keys_to_indexes),
@@ -343,20 +574,57 @@ class SkimStack(object):
         assert key in self.skims_data, "SkimStack key %s missing" % key
 
         stacked_skim_data = self.skims_data[key]
+        skim_indexes = self.skim_indexes(key, dim3)
+
+        return unpack_skim_values(stacked_skim_data[skim_indexes, orig, dest],
+                                  self.skim_scales[key])
+
+    def skim_indexes(self, key, dim3):
+        """
+        Get the indexes into the stacked skim data for key of the dim3 skim keys
+
+        Rather than looking up the index of each dim3 value (e.g. time period label) in turn,
+        dim3 is coded as small ints (the category codes if it is already categorical, as
+        produced by skim_time_period_category, otherwise by factorizing it) and the indexes
+        for the distinct values are looked up once.
+
+        Parameters
+        ----------
+        key : str
+            first item of the stacked tuple keys
+        dim3 : pandas Series, Categorical or 1D array
+            second items of the tuple keys (e.g. 'AM', 'PM') for each row
+
+        Returns
+        -------
+        skim_indexes : 1D int array
+        """
+
         skim_keys_to_indexes = self.skim_keys_to_indexes[key]
 
-        # skim_indexes = dim3.map(skim_keys_to_indexes).astype('int')
-        # this should be faster than map
-        skim_indexes = np.vectorize(skim_keys_to_indexes.get)(dim3)
+        if is_categorical_dtype(dim3):
+            if isinstance(dim3, pd.Series):
+                dim3 = dim3.cat
+            codes, categories = np.asanyarray(dim3.codes), dim3.categories
+        else:
+            codes, categories = pd.factorize(np.asanyarray(dim3))
+
+        # unused categories need not be in the stack, so flag missing keys with -1
+        indexes = np.array([skim_keys_to_indexes.get(c, -1) for c in categories], dtype=int)
+        skim_indexes = indexes[codes]
+
+        assert (codes >= 0).all() and (skim_indexes >= 0).all(), \
+            "SkimStack key %s missing dim3 values" % key
 
-        return stacked_skim_data[orig, dest, skim_indexes]
+        return skim_indexes
 
     def wrap(self, left_key, right_key, skim_key):
         """
         return a SkimStackWrapper for self
         """
         return SkimStackWrapper(stack=self,
-                                left_key=left_key, right_key=right_key, skim_key=skim_key)
+                                left_key=left_key, right_key=right_key, skim_key=skim_key,
+                                memo_max_bytes=self.memo_max_bytes)
 
 
 class SkimStackWrapper(object):
@@ -399,9 +667,11 @@ class SkimStackWrapper(object):
         This identifies the column in the dataframe which is used to
         select among Skim object using the SECOND item in each tuple (see
         above for a more complete description)
+    memo_max_bytes : int, optional
+        cap on memory used to memoize lookups until the next set_df (see SkimLookupMemo)
     """
 
-    def __init__(self, stack, left_key, right_key, skim_key):
+    def __init__(self, stack, left_key, right_key, skim_key, memo_max_bytes=None):
 
         self.stack = stack
 
@@ -409,6 +679,7 @@ class SkimStackWrapper(object):
         self.right_key = right_key
         self.skim_key = skim_key
         self.df = None
+        self.memo = SkimLookupMemo(memo_max_bytes)
 
     def set_df(self, df):
         """
@@ -424,6 +695,14 @@ class SkimStackWrapper(object):
         Nothing
         """
         self.df = df
+        self.memo.clear()
+
+    def copy(self):
+        """
+        return a new SkimStackWrapper for the same skims and keys (with no df or memoized lookups)
+        """
+        return SkimStackWrapper(self.stack, self.left_key, self.right_key, self.skim_key,
+                                memo_max_bytes=self.memo.max_bytes)
 
     def __getitem__(self, key):
         """
@@ -440,6 +719,10 @@ class SkimStackWrapper(object):
              The skim object
         """
 
+        s = self.memo.get(key)
+        if s is not None:
+            return s
+
         assert self.df is not None, "Call set_df first"
         orig = self.df[self.left_key].astype('int')
         dest = self.df[self.right_key].astype('int')
@@ -447,4 +730,397 @@ class SkimStackWrapper(object):
 
         skim_values = self.stack.lookup(orig, dest, dim3, key)
 
-        return pd.Series(skim_values, self.df.index)
+        s = pd.Series(skim_values, self.df.index)
+
+        self.memo.add(key, s)
+
+        return s
+
+
+# name of the yaml manifest describing the contents of a skim cache directory
+SKIM_CACHE_MANIFEST = 'skim_cache.yaml'
+
+
+def skim_cache_file_name(key):
+    """
+    name of the raw binary file holding the data for skim key in a skim cache directory
+
+    tuple keys are joined with the same '__' separator used for skim names in omx files
+    (e.g. ('SOV_TIME', 'AM') -> SOV_TIME__AM.mmap)
+    """
+    if isinstance(key, tuple):
+        key = '__'.join(key)
+    return '%s.mmap' % key
+
+
+def write_skim_cache(skim_dict, cache_dir, source):
+    """
+    Write the skims in skim_dict to cache_dir as raw binary files (one per key) plus a manifest
+
+    Stacked skims (see SkimDict.set_stack) are written as a single 3D array, so that they
+    are stacked again when the cache is read.
+
+    The manifest records the shape, dtype and scale of each skim, the skim_dict offset mapping,
+    and the caller-supplied source dict, which read_skim_cache compares to decide whether
+    the cache is still valid. The manifest is written last so that an interrupted write
+    never leaves behind a cache that looks valid.
+
+    Parameters
+    ----------
+    skim_dict : SkimDict
+    cache_dir : str
+        path to directory in which to write the cache (created if it doesn't exist)
+    source : dict
+        yaml-serializable description of the skim source (e.g. omx file name, size and mtime)
+    """
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    manifest_path = os.path.join(cache_dir, SKIM_CACHE_MANIFEST)
+    if os.path.exists(manifest_path):
+        os.unlink(manifest_path)
+
+    skims = []
+
+    def write_skim(key, key2_list, skim_data, file_name):
+
+        data = np.ascontiguousarray(skim_data)
+        data.tofile(os.path.join(cache_dir, file_name))
+
+        skims.append({
+            'key': list(key) if isinstance(key, tuple) else key,
+            'key2': key2_list,
+            'file': file_name,
+            'dtype': data.dtype.str,
+            'shape': list(data.shape),
+            'scale': skim_dict.scales.get(key)
+        })
+
+    # stacked skims are cached as a single 3D array (e.g. SOV_TIME__.mmap)
+    for key1, (stacked_skim_data, key2_list) in skim_dict.stacks.iteritems():
+        write_skim(key1, key2_list, stacked_skim_data, skim_cache_file_name((key1, '')))
+
+    for key, skim_data in skim_dict.skims.iteritems():
+        if isinstance(key, tuple) and key[0] in skim_dict.stacks:
+            continue
+        write_skim(key, None, skim_data, skim_cache_file_name(key))
+
+    offset_mapper = skim_dict.offset_mapper
+    manifest = {
+        'source': source,
+        'offset_int': offset_mapper.offset_int,
+        'offset_list': None if offset_mapper.offset_series is None
+        else offset_mapper.offset_series.index.tolist(),
+        'skims': skims
+    }
+
+    with open(manifest_path, 'w') as f:
+        yaml.dump(manifest, f, default_flow_style=False)
+
+    logger.info("write_skim_cache wrote %s skims to %s" % (len(skims), cache_dir))
+
+
+def read_skim_cache(cache_dir, source):
+    """
+    Open a skim cache written by write_skim_cache as a SkimDict of read-only np.memmap arrays
+
+    Skim data is not read into memory, but is paged in from the cache files by the OS
+    as it is accessed, so the page cache is shared by concurrent runs using the same cache.
+
+    Parameters
+    ----------
+    cache_dir : str
+        path to skim cache directory
+    source : dict
+        description of the skim source, which must match the source the cache was written with
+
+    Returns
+    -------
+    skim_dict : SkimDict or None
+        None if there is no cache or the cache is stale (source doesn't match)
+    """
+
+    manifest_path = os.path.join(cache_dir, SKIM_CACHE_MANIFEST)
+    if not os.path.exists(manifest_path):
+        logger.info("read_skim_cache no skim cache manifest found in %s" % cache_dir)
+        return None
+
+    with open(manifest_path) as f:
+        manifest = yaml.load(f)
+
+    if manifest.get('source') != source:
+        logger.info("read_skim_cache ignoring stale skim cache in %s" % cache_dir)
+        return None
+
+    skim_dict = SkimDict()
+
+    if manifest['offset_list'] is not None:
+        skim_dict.offset_mapper.set_offset_list(manifest['offset_list'])
+    elif manifest['offset_int'] is not None:
+        skim_dict.offset_mapper.set_offset_int(manifest['offset_int'])
+
+    for skim_info in manifest['skims']:
+
+        key = skim_info['key']
+        if isinstance(key, list):
+            key = tuple(key)
+
+        skim_data = np.memmap(os.path.join(cache_dir, skim_info['file']),
+                              dtype=np.dtype(skim_info['dtype']),
+                              mode='r',
+                              shape=tuple(skim_info['shape']))
+
+        if skim_info.get('key2') is None:
+            skim_dict.set(key, skim_data, skim_info.get('scale'))
+        else:
+            skim_dict.set_stack(key, skim_info['key2'], skim_data, skim_info.get('scale'))
+
+    logger.info("read_skim_cache opened %s skims in %s" % (len(manifest['skims']), cache_dir))
+
+    return skim_dict
+
+
+# byte alignment of the individual skims in a skim buffer
+SKIM_BUFFER_ALIGNMENT = 64
+
+
+def skim_storage(key, skim_dtypes):
+    """
+    Storage dtype and scale for skim key according to the skim_dtypes policy
+
+    skim_dtypes is a list of dicts with 'skims' (list of fnmatch patterns matched against the
+    skim name, which is the first item of tuple keys), 'dtype' and optionally 'scale'.
+    The first matching entry is used. Skims stored with a scale hold round(value / scale),
+    which is converted back to a float64 value * scale when looked up.
+
+    e.g. [{'skims': ['*_TIME'], 'dtype': 'float16'},
+          {'skims': ['DIST*'], 'dtype': 'int16', 'scale': 0.01}]
+
+    A scale is only allowed with integer dtypes.
+
+    Returns
+    -------
+    dtype : numpy dtype or None
+        None if no entry matches (skim is stored in the dtype it is read in)
+    scale : float or None
+    """
+
+    name = key[0] if isinstance(key, tuple) else key
+
+    for policy in skim_dtypes or []:
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in policy['skims']):
+            dtype, scale = np.dtype(policy['dtype']), policy.get('scale')
+            if scale is not None and dtype.kind not in 'iu':
+                raise RuntimeError("skim_dtypes scale %s for skims %s needs an integer dtype, "
+                                   "not %s" % (scale, policy['skims'], dtype))
+            return dtype, None if scale is None else float(scale)
+
+    return None, None
+
+
+def pack_skim_values(key, values, out, scale=None):
+    """
+    Store skim values in out (which may be a reduced precision dtype), as values / scale
+
+    Raises an AssertionError if values can't be represented in out.dtype
+    (e.g. NaNs in an integer skim, or values too large for its range).
+    """
+
+    values = np.asanyarray(values)
+
+    if scale is not None:
+        values = values / scale
+
+    if out.dtype.kind in 'iu':
+        assert not np.isnan(values).any(), \
+            "skim %s has NaNs and can't be stored as %s" % (key, out.dtype)
+        values = np.round(values)
+        info = np.iinfo(out.dtype)
+        assert values.size == 0 or (values.min() >= info.min and values.max() <= info.max), \
+            "skim %s values out of range for %s" % (key, out.dtype)
+
+    out[...] = values
+
+    assert np.isfinite(out).sum() == np.isfinite(values).sum(), \
+        "skim %s values out of range for %s" % (key, out.dtype)
+
+
+def skim_buffer_layout(skims, offset_mapper, skim_dtypes=None):
+    """
+    Describe how to pack skims into a single buffer
+
+    Simple skims are laid out as 2D arrays, and the tuple key skims for each key1 are laid out
+    together as a single (len(key2_list), n_zones, n_zones) array that SkimStack can use
+    without stacking them itself.
+
+    Parameters
+    ----------
+    skims : dict
+        skim key -> 2D array-like (anything with shape and dtype, e.g. an omx matrix or memmap)
+    offset_mapper : OffsetMapper
+        offset mapper of the SkimDict the skims belong to
+    skim_dtypes : list of dict, optional
+        skim storage dtype policy (see skim_storage)
+
+    Returns
+    -------
+    layout : dict
+        picklable layout with nbytes (total buffer size), the offset mapping, and the
+        key, key2 list (None for 2D skims), dtype, scale, shape and byte offset of each skim array
+    """
+
+    stacks = {}
+    for key in skims:
+        if isinstance(key, tuple):
+            stacks.setdefault(key[0], []).append(key[1])
+
+    skims_layout = []
+    for key, skim_data in skims.iteritems():
+        if not isinstance(key, tuple):
+            dtype, scale = skim_storage(key, skim_dtypes)
+            skims_layout.append({
+                'key': key,
+                'key2': None,
+                'dtype': (dtype or np.dtype(skim_data.dtype)).str,
+                'scale': scale,
+                'shape': tuple(skim_data.shape)
+            })
+
+    for key1, key2_list in stacks.iteritems():
+        key2_list = sorted(key2_list)
+        skim_data = [skims[(key1, key2)] for key2 in key2_list]
+
+        shape = tuple(skim_data[0].shape)
+        assert all(tuple(d.shape) == shape for d in skim_data), \
+            "skim_buffer_layout inconsistent shapes for stacked skim %s" % key1
+
+        dtype, scale = skim_storage(key1, skim_dtypes)
+        skims_layout.append({
+            'key': key1,
+            'key2': key2_list,
+            'dtype': (dtype or np.result_type(*[d.dtype for d in skim_data])).str,
+            'scale': scale,
+            'shape': (len(key2_list), ) + shape
+        })
+
+    nbytes = 0
+    for skim_info in skims_layout:
+        skim_info['offset'] = nbytes
+        skim_nbytes = int(np.prod(skim_info['shape'])) * np.dtype(skim_info['dtype']).itemsize
+        nbytes += skim_nbytes + (-skim_nbytes % SKIM_BUFFER_ALIGNMENT)
+
+    return {
+        'nbytes': nbytes,
+        'offset_int': offset_mapper.offset_int,
+        'offset_list': None if offset_mapper.offset_series is None
+        else offset_mapper.offset_series.index.tolist(),
+        'skims': skims_layout
+    }
+
+
+def attach_skim_buffer(buffer, layout):
+    """
+    Create a SkimDict whose skims are views into buffer as described by layout
+
+    No skim data is copied, so SkimDicts (and SkimStacks) attached to the same shared buffer
+    in different processes all use the same physical memory.
+
+    Parameters
+    ----------
+    buffer : object exposing the buffer interface (e.g. multiprocessing.RawArray)
+    layout : dict
+        layout returned by skim_buffer_layout
+
+    Returns
+    -------
+    skim_dict : SkimDict
+    """
+
+    assert len(buffer) >= layout['nbytes']
+
+    skim_dict = SkimDict()
+
+    if layout['offset_list'] is not None:
+        skim_dict.offset_mapper.set_offset_list(layout['offset_list'])
+    elif layout['offset_int'] is not None:
+        skim_dict.offset_mapper.set_offset_int(layout['offset_int'])
+
+    for skim_info in layout['skims']:
+
+        shape = skim_info['shape']
+        skim_data = np.frombuffer(buffer,
+                                  dtype=np.dtype(skim_info['dtype']),
+                                  count=int(np.prod(shape)),
+                                  offset=skim_info['offset']).reshape(shape)
+
+        if skim_info['key2'] is None:
+            skim_dict.set(skim_info['key'], skim_data, skim_info['scale'])
+        else:
+            skim_dict.set_stack(skim_info['key'], skim_info['key2'], skim_data, skim_info['scale'])
+
+    return skim_dict
+
+
+def load_skim_buffer(skims, offset_mapper, shared=False, skim_dtypes=None, packed=False):
+    """
+    Load skims into a single newly allocated buffer laid out by skim_buffer_layout
+
+    If shared, the buffer is a multiprocessing.RawArray (an anonymous shared memory mapping)
+    which is inherited by forked child processes and can be passed to spawned ones as an
+    argument to multiprocessing.Process. Each process then calls attach_skim_buffer to get a
+    SkimDict backed by the shared buffer.
+
+    Each skim is read straight into its place in the buffer (omx matrices of the same dtype
+    are read directly into it), so peak memory is only the buffer plus (at most) one skim.
+
+    Skims are stored in the dtype (and scale) given by the skim_dtypes policy (see skim_storage).
+    If packed, the skims were already packed according to the same policy (e.g. they are from a
+    skim cache) and are copied as is (not rescaled).
+
+    Parameters
+    ----------
+    skims : dict
+        skim key -> 2D array-like (e.g. an omx matrix), each skim is read once into the buffer
+    offset_mapper : OffsetMapper
+    shared : bool
+        allocate buffer in shared memory
+    skim_dtypes : list of dict, optional
+        skim storage dtype policy (see skim_storage)
+    packed : bool
+        skims are already stored in their storage dtype and scale
+
+    Returns
+    -------
+    buffer : multiprocessing.RawArray or 1D uint8 numpy array
+    layout : dict
+        layout returned by skim_buffer_layout
+    """
+
+    layout = skim_buffer_layout(skims, offset_mapper, skim_dtypes)
+
+    nbytes = max(layout['nbytes'], 1)
+    if shared:
+        logger.info("load_skim_buffer allocating %s bytes of shared memory for %s skims"
+                    % (nbytes, len(skims)))
+        buffer = multiprocessing.RawArray(ctypes.c_byte, nbytes)
+    else:
+        logger.info("load_skim_buffer allocating %s bytes for %s skims" % (nbytes, len(skims)))
+        buffer = np.empty(nbytes, dtype=np.uint8)
+
+    skim_dict = attach_skim_buffer(buffer, layout)
+    for key, skim_data in skims.iteritems():
+        out = skim_dict.skims[key]
+        scale = skim_dict.scales.get(key)
+        if packed:
+            assert skim_data.dtype == out.dtype, \
+                "packed skim %s dtype %s is not its storage dtype %s" % \
+                (key, skim_data.dtype, out.dtype)
+        if not packed and (scale is not None or skim_data.dtype != out.dtype):
+            pack_skim_values(key, skim_data[:], out, scale)
+        elif hasattr(skim_data, 'read') and out.flags.c_contiguous:
+            skim_data.read(out=out)
+        else:
+            out[...] = skim_data[:]
+
+    return buffer, layout
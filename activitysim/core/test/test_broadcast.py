@@ -0,0 +1,144 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+
+import orca
+
+from .. import logit
+from .. import skim
+from ..broadcast import BroadcastFrame, BroadcastArray
+from ..interaction_simulate import eval_interaction_utilities
+from ..interaction_simulate import eval_broadcast_utilities
+from ..interaction_simulate import can_broadcast
+from ..interaction_simulate import broadcast_utilities
+
+
+@pytest.fixture(autouse=True)
+def no_check_for_variability():
+    # rather than the abm injectable, which reads the settings file
+    orca.add_injectable('check_for_variability', False)
+
+
+@pytest.fixture(scope='module')
+def choosers():
+    return pd.DataFrame({
+        'TAZ': [1, 3, 2, 3],
+        'income_segment': [1, 2, 1, 3],
+    }, index=pd.Index([100, 101, 102, 103], name='person_id'))
+
+
+@pytest.fixture(scope='module')
+def alternatives():
+    alternatives = pd.DataFrame({
+        'work, low': [0.0, 10.0, 25.0],
+        'work, med': [5.0, 0.0, 2.0],
+    }, index=pd.Index([1, 2, 3], name='TAZ'))
+    alternatives['TAZ'] = alternatives.index
+    return alternatives
+
+
+@pytest.fixture(scope='module')
+def skim_dict():
+    skim_dict = skim.SkimDict()
+    skim_dict.set('DIST', np.arange(9, dtype=np.float64).reshape((3, 3)) / 2)
+    skim_dict.offset_mapper.set_offset_int(-1)
+    return skim_dict
+
+
+@pytest.fixture(scope='module')
+def spec():
+    return pd.DataFrame({'Alt': [-0.8, -0.3, 0.2, 1.0, -999, 0.5]}, index=[
+        "@skims['DIST'].clip(1)",
+        "@(skims['DIST']-1).clip(0,1)",
+        "@(df.income_segment>=2)*skims['DIST'].clip(upper=2)",
+        "@(df.income_segment==1)*df['work, low'].apply(np.log1p)",
+        "@(df.income_segment==2)&(df['work, med']==0)",
+        "income_segment * TAZ_r / 2",
+    ])
+
+
+def test_broadcast_frame(choosers, alternatives):
+
+    df = BroadcastFrame(choosers, alternatives)
+
+    assert df.shape == (4, 3)
+    assert sorted(df.columns) == \
+        sorted(['work, low', 'work, med', 'TAZ', 'TAZ_r', 'income_segment'])
+
+    # chooser columns are (n, 1) and alternative columns (1, m)
+    npt.assert_array_equal(df['TAZ_r'], [[1], [3], [2], [3]])
+    npt.assert_array_equal(df.TAZ, [[1, 2, 3]])
+    npt.assert_array_equal(df.income_segment * df['work, med'],
+                           np.outer([1, 2, 1, 3], [5.0, 0.0, 2.0]))
+
+    with pytest.raises(KeyError):
+        df['bogus']
+
+    with pytest.raises(AttributeError):
+        df.bogus
+
+
+def test_broadcast_array():
+
+    a = np.array([[0.5, 1.0, 3.0]]).view(BroadcastArray)
+
+    npt.assert_array_equal(a.clip(1), [[1.0, 1.0, 3.0]])
+    npt.assert_array_equal(a.clip(upper=2), [[0.5, 1.0, 2.0]])
+    npt.assert_array_equal(a.clip(0.75, 2), [[0.75, 1.0, 2.0]])
+    npt.assert_array_equal(a.apply(np.log1p), np.log1p(a))
+    npt.assert_array_equal(a.isin([1.0, 3.0]), [[False, True, True]])
+    assert type(a.values) == np.ndarray
+
+
+def test_broadcast_utilities(choosers, alternatives, skim_dict, spec):
+
+    skims = skim_dict.wrap('TAZ', 'TAZ_r')
+    locals_d = {'skims': skims}
+
+    interaction_df = logit.interaction_dataset(choosers, alternatives)
+    skims.set_df(interaction_df)
+    interaction_utilities, _ = \
+        eval_interaction_utilities(spec, interaction_df, locals_d, 'test', None)
+
+    df = BroadcastFrame(choosers, alternatives)
+    skims.set_df(df)
+    utilities = eval_broadcast_utilities(spec, df, locals_d, 'test')
+
+    assert utilities.shape == (len(choosers), len(alternatives))
+    npt.assert_almost_equal(utilities.ravel(), interaction_utilities.utility.values)
+
+
+def test_can_broadcast(choosers, alternatives, skim_dict, spec):
+
+    skims = skim_dict.wrap('TAZ', 'TAZ_r')
+    assert can_broadcast(spec, choosers, alternatives, skims)
+
+    # simple expressions that would need DataFrame.eval
+    df_eval_spec = pd.DataFrame({'Alt': [1.0]}, index=['TAZ.isin([1, 2])'])
+    assert not can_broadcast(df_eval_spec, choosers, alternatives, skims)
+
+    # time period skims
+    stack_dict = skim.SkimDict()
+    stack_dict.set(('SOV', 'AM'), np.zeros((3, 3)))
+    skims3d = skim.SkimStack(stack_dict).wrap('TAZ', 'TAZ_r', 'period')
+    assert not can_broadcast(spec, choosers, alternatives, [skims, skims3d])
+
+
+def test_broadcast_fallback(choosers, alternatives, skim_dict):
+
+    skims = skim_dict.wrap('TAZ', 'TAZ_r')
+
+    # Series.map isn't implemented by BroadcastArray
+    spec = pd.DataFrame({'Alt': [1.0, 2.0]},
+                        index=["@skims['DIST']", "@df.TAZ.map({1: 1.0, 2: 0.5, 3: 0.0})"])
+
+    assert can_broadcast(spec, choosers, alternatives, skims)
+
+    utilities = broadcast_utilities(spec, choosers, alternatives, skims, {'skims': skims}, 'test')
+
+    assert utilities is None
+    assert not can_broadcast(spec, choosers, alternatives, skims)
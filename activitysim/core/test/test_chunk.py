@@ -0,0 +1,138 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pandas.util.testing as pdt
+import pytest
+
+import orca
+
+from .. import chunk
+from .. import util
+
+
+@pytest.fixture(autouse=True)
+def no_rss_ceiling():
+    # rather than the abm rss_ceiling injectable, which reads the settings file
+    orca.add_injectable('rss_ceiling', 0)
+
+
+@pytest.fixture
+def chunk_history_path():
+
+    path = os.path.join(os.path.dirname(__file__), 'output', 'chunk_history.csv')
+    if os.path.isfile(path):
+        os.unlink(path)
+
+    orca.add_injectable('adaptive_chunking', True)
+    orca.add_injectable('chunk_history_path', path)
+
+    yield path
+
+    orca.add_injectable('adaptive_chunking', False)
+    orca.add_injectable('chunk_history_path', None)
+
+    if os.path.isfile(path):
+        os.unlink(path)
+
+
+def test_chunked_choosers_and_alts():
+
+    choosers = pd.DataFrame({'a': [1, 2, 3]}, index=pd.Index([10, 20, 30], name='id'))
+    alternatives = pd.DataFrame({'alt': [1, 2, 1, 1, 2, 3]},
+                                index=pd.Index([10, 10, 20, 30, 30, 30], name='id'))
+
+    chunks = list(chunk.chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk=2))
+
+    assert [(i, num_chunks) for i, num_chunks, c, a in chunks] == [(1, 2), (2, 2)]
+
+    pdt.assert_frame_equal(chunks[0][2], choosers.iloc[0:2])
+    pdt.assert_frame_equal(chunks[0][3], alternatives.iloc[0:3])
+    pdt.assert_frame_equal(chunks[1][2], choosers.iloc[2:])
+    pdt.assert_frame_equal(chunks[1][3], alternatives.iloc[3:])
+
+
+def test_adaptive_chunk_ranges(chunk_history_path):
+
+    chunk_size = 10**9
+    bytes_per_row = 8 * 10**6
+
+    ranges = []
+    for i, num_chunks, offset, rows \
+            in chunk.chunk_ranges(10000, 100, chunk_size=chunk_size, trace_label='test'):
+        ranges.append((offset, rows))
+        chunk.log_chunk_size('test', (0, rows * bytes_per_row))
+
+    # first chunk as estimated, the rest sized from measured bytes per row
+    assert ranges[0] == (0, 100)
+    assert ranges[1] == (100, 1000)
+    assert sum(rows for offset, rows in ranges) == 10000
+
+    history = chunk.ChunkHistory(chunk_history_path)
+    assert history.row_size('test') == bytes_per_row / chunk.BYTES_PER_ELEMENT
+
+    # later runs use the measured row_size from the start
+    assert chunk.rows_per_chunk(chunk_size, 5, 10000, 'test') == 1000
+
+
+def test_unmeasured_chunk_ranges(chunk_history_path):
+
+    # chunks run without calling log_chunk_size (e.g. concurrently) are not measured
+    ranges = list(chunk.chunk_ranges(100, 10, chunk_size=1000, trace_label='test'))
+
+    assert [rows for i, num_chunks, offset, rows in ranges] == [10] * 10
+    assert not os.path.isfile(chunk_history_path)
+
+
+def test_chunk_governor():
+
+    bytes_per_row = 10**7
+    rows_per_chunk = 100
+    chunk_size = bytes_per_row * rows_per_chunk / chunk.BYTES_PER_ELEMENT
+
+    # room for 60 rows
+    orca.add_injectable('rss_ceiling', util.rss() + 60 * bytes_per_row)
+
+    event_count = len(chunk.governor_events())
+
+    ranges = list(chunk.chunk_ranges(1000, rows_per_chunk, chunk_size=chunk_size,
+                                     trace_label='test'))
+
+    orca.add_injectable('rss_ceiling', 0)
+
+    # each chunk bisected to fit under the ceiling
+    assert [rows for i, num_chunks, offset, rows in ranges] == [50] * 20
+    assert [offset for i, num_chunks, offset, rows in ranges] == range(0, 1000, 50)
+
+    # (the last chunk is only the 50 rows that are left, so it isn't split)
+    events = chunk.governor_events()[event_count:]
+    assert len(events) == 19
+    assert events[0]['rows'] == 100 and events[0]['governed_rows'] == 50
+
+
+def test_map_chunks():
+
+    live = []
+    max_live = [0]
+
+    def chunks():
+        for i in range(10):
+            live.append(i)
+            max_live[0] = max(max_live[0], len(live))
+            yield i, 10
+
+    def func(i, num_chunks):
+        time.sleep(0.01 * (i % 3))
+        live.remove(i)
+        return i * 2
+
+    assert chunk.map_chunks(func, chunks(), num_threads=3) == range(0, 20, 2)
+
+    # chunks are only taken from the generator as threads are free to run them
+    assert max_live[0] <= 3
+
+    assert chunk.map_chunks(func, chunks(), num_threads=1) == range(0, 20, 2)
@@ -0,0 +1,82 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+
+from .. import expression_plan as ep
+
+
+@pytest.fixture(scope='module')
+def df():
+    df = pd.DataFrame({
+        'a': [1, 2, 3, 4],
+        'b': [0, 1, 0, 1],
+        'c': [1.5, 2.0, 3.0, -1.0],
+        's': ['x', 'y', 'x', 'z']
+    }, index=pd.Index([10, 11, 12, 13], name='zone_id'))
+    return df
+
+
+def test_simple_expressions_match_df_eval(df):
+
+    exprs = ['a',
+             'a > 1 & b == 1',
+             'a == 1 | b == 1',
+             '1 < a < 4',
+             'not (a > 2)',
+             '~(a > 2)',
+             '(a > 1) and (c < 3)',
+             'a / 2',
+             '1/2 + a',
+             "s == 'x'",
+             'a * c + 2',
+             'a ** 2 % 3',
+             'b == True',
+             '-a']
+
+    plan = ep.ExpressionPlan(exprs)
+
+    assert plan.kinds == [ep.COLUMNS] * len(exprs)
+
+    for i, expr in enumerate(exprs):
+        npt.assert_array_equal(plan.evaluate(i, df, {}, {}), df.eval(expr))
+
+
+def test_df_eval_fallback(df):
+
+    exprs = ['a in [1, 2]', 'zone_id > 11', '@df.a * 2', '@x + df.b']
+
+    plan = ep.ExpressionPlan(exprs)
+
+    assert plan.kinds == [ep.DF_EVAL, ep.COLUMNS, ep.PYTHON, ep.PYTHON]
+
+    npt.assert_array_equal(plan.evaluate(0, df, {}, {}), [True, True, False, False])
+
+    # index name isn't a column, so is resolved by df.eval
+    npt.assert_array_equal(plan.evaluate(1, df, {}, {}), [False, False, True, True])
+
+    npt.assert_array_equal(plan.evaluate(2, df, {}, {'df': df}), [2, 4, 6, 8])
+    npt.assert_array_equal(plan.evaluate(3, df, {}, {'df': df, 'x': 10}), [10, 11, 10, 11])
+
+
+def test_expression_plan_cache():
+
+    exprs = pd.Index(['a + 1', '@np.log(df.c)'])
+
+    plan = ep.expression_plan(exprs)
+
+    assert ep.expression_plan(list(exprs)) is plan
+    assert ep.expression_plan(['a + 2']) is not plan
+
+
+def test_expression_plan_compile_error():
+
+    with pytest.raises(SyntaxError):
+        ep.expression_plan(['a + 1', '@np.log(df.c'])
+
+    # and the failed plan isn't cached
+    with pytest.raises(SyntaxError):
+        ep.expression_plan(['a + 1', '@np.log(df.c'])
@@ -0,0 +1,94 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+
+from ..interaction_sample import pick_counts
+from ..interaction_sample import sample_positions
+
+
+def test_pick_counts():
+
+    # chooser row * alternative_count + position of 3 choosers sampling 4 of 5 alternatives
+    keys = np.array([2, 0, 2, 2,
+                     9, 6, 6, 5,
+                     13, 14, 10, 11])
+
+    first, counts = pick_counts(keys)
+
+    npt.assert_array_equal(first, [0, 1, 4, 5, 7, 8, 9, 10, 11])
+    npt.assert_array_equal(counts, [3, 1, 1, 2, 1, 1, 1, 1, 1])
+
+    # same as dropping duplicates counted by groupby cumcount
+    df = pd.DataFrame({'key': keys})
+    pick_group = df.groupby('key')
+    df['pick_count'] = pick_group.cumcount(ascending=True)
+    df['pick_dup'] = df['pick_count'] > 0
+    df['pick_count'] += pick_group.cumcount(ascending=False) + 1
+    df = df[~df['pick_dup']]
+
+    npt.assert_array_equal(first, df.index.values)
+    npt.assert_array_equal(counts, df.pick_count.values)
+
+
+def test_sample_positions():
+
+    probs = np.random.RandomState(0).dirichlet(np.ones(7), size=50)
+    rands = np.random.RandomState(1).rand(50, 10)
+
+    cum_probs = probs.cumsum(axis=1)
+
+    positions = sample_positions(cum_probs, rands)
+
+    # first cum_prob greater than each rand
+    expected = np.array([np.argmax(cum_probs > rands[:, [i]], axis=1)
+                         for i in range(rands.shape[1])]).T
+
+    npt.assert_array_equal(positions, expected)
+
+    # rands beyond the last cum_prob pick the last alternative
+    cum_probs = np.array([[0.2, 0.5, 0.99],
+                          [0.1, 0.3, 1.0]])
+    positions = sample_positions(cum_probs, np.array([[0.995, 0.1], [0.05, 0.3]]))
+    npt.assert_array_equal(positions, [[2, 0], [0, 2]])
+
+
+def test_sample_positions_zero_probs():
+
+    # a row summing to slightly more than 1 followed by a row with a zero leading probability,
+    # and rows with trailing zero probabilities summing to slightly less than 1
+    probs = np.array([[0.5, 0.5 + 1e-9, 0.0],
+                      [0.0, 0.4, 0.6],
+                      [0.3, 0.7 - 1e-9, 0.0],
+                      [0.0, 1.0 - 1e-9, 0.0]])
+    rands = np.array([[0.0, 0.5, 1.0 - 1e-12],
+                      [0.0, 0.2, 0.4],
+                      [0.0, 0.3, 1.0 - 1e-12],
+                      [0.0, 0.5, 1.0 - 1e-12]])
+
+    positions = sample_positions(probs.cumsum(axis=1), rands)
+
+    npt.assert_array_equal(positions, [[0, 1, 1],
+                                       [1, 1, 2],
+                                       [0, 1, 1],
+                                       [1, 1, 1]])
+
+    # never a zero probability alternative
+    chooser_rows = np.arange(len(probs))[:, np.newaxis]
+    assert (probs[chooser_rows, positions] > 0).all()
+
+    # with enough choosers that row offsets round cum_probs and rands
+    probs = np.random.RandomState(2).dirichlet(np.ones(5), size=100000)
+    probs[::3, 0] = 0
+    probs[1::3, -1] = 0
+    probs /= probs.sum(axis=1)[:, np.newaxis]
+    rands = np.random.RandomState(3).rand(100000, 3)
+    cum_probs = probs.cumsum(axis=1)
+
+    positions = sample_positions(cum_probs.copy(), rands)
+
+    expected = np.array([np.argmax(cum_probs > rands[:, [i]], axis=1)
+                         for i in range(rands.shape[1])]).T
+    npt.assert_array_equal(positions, expected)
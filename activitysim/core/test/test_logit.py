@@ -4,6 +4,7 @@
 import os.path
 
 import numpy as np
+import numpy.testing as npt
 import pandas as pd
 import orca
 
@@ -148,3 +149,41 @@ def test_interaction_dataset_sampled(
 
     interacted, expected = interacted.align(expected, axis=1)
     pdt.assert_frame_equal(interacted, expected)
+
+
+def test_logsums():
+
+    utils = np.array([[0.0, np.log(2), np.log(3)],
+                      [1000.0, 1000.0, -np.inf],
+                      [-np.inf, -np.inf, -np.inf]])
+
+    logsums = logit.logsums(utils.copy())
+    npt.assert_array_almost_equal(logsums, [np.log(6), 1000 + np.log(2), -np.inf])
+
+    logsums = logit.logsums(utils.copy(), starts=[0, 1])
+    npt.assert_array_almost_equal(logsums, [[0.0, np.log(5)],
+                                            [1000.0, 1000.0],
+                                            [-np.inf, -np.inf]])
+
+
+def test_nested_logsums():
+
+    nest_spec = {
+        'name': 'root',
+        'coefficient': 1.0,
+        'alternatives': [
+            {'name': 'A', 'coefficient': 0.5, 'alternatives': ['a1', 'a2']},
+            'b'
+        ]
+    }
+
+    assert logit.compile_nest_spec(nest_spec).leaf_names == ['a1', 'a2', 'b']
+
+    utils = np.array([[0.0, 0.0, 0.0],
+                      [-1000.0, -1000.0, -1000.0]])
+
+    logsums = logit.nested_logsums(utils, nest_spec)
+
+    # A logsum is 0.5 * log(exp(0 / 0.5) + exp(0 / 0.5))
+    npt.assert_array_almost_equal(logsums, [np.log(np.sqrt(2) + 1),
+                                            -1000 + np.log(np.sqrt(2) + 1)])
@@ -0,0 +1,126 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import pandas as pd
+import pandas.util.testing as pdt
+import pytest
+
+from .. import mp_tasks
+
+
+def test_split_models():
+
+    models = ['initialize', 'compute_accessibility', 'auto_ownership_simulate',
+              'annotate_table.model_name=annotate_tours', 'write_tables']
+    parent_models = mp_tasks.DEFAULT_PARENT_MODELS
+
+    setup_models, shard_models, final_models = mp_tasks.split_models(models, parent_models)
+
+    assert setup_models == ['initialize', 'compute_accessibility']
+    assert shard_models == ['auto_ownership_simulate', 'annotate_table.model_name=annotate_tours']
+    assert final_models == ['write_tables']
+
+    # all parent models
+    setup_models, shard_models, final_models = \
+        mp_tasks.split_models(['initialize', '_compute_accessibility'], parent_models)
+    assert setup_models == ['initialize', '_compute_accessibility']
+    assert shard_models == [] and final_models == []
+
+    with pytest.raises(RuntimeError) as excinfo:
+        mp_tasks.split_models(['initialize', 'cdap_simulate', 'compute_accessibility',
+                               'mandatory_tour_frequency'], parent_models)
+    assert "must precede or follow" in str(excinfo.value)
+
+
+def test_shard_df():
+
+    households = pd.DataFrame({'income': [10, 20, 30]},
+                              index=pd.Index([1, 2, 3], name='HHID'))
+    persons = pd.DataFrame({'household_id': [1, 1, 2, 3]},
+                           index=pd.Index([11, 12, 21, 31], name='PERID'))
+    person_windows = pd.DataFrame({'4': [0, 0, 0, 0]}, index=persons.index)
+    land_use = pd.DataFrame({'area_type': [1, 2]}, index=pd.Index([1, 2], name='TAZ'))
+
+    hh_ids = [1, 3]
+    person_ids = [11, 12, 31]
+
+    def shard(df):
+        return mp_tasks.shard_df(df, hh_ids, person_ids, 'HHID', 'PERID')
+
+    pdt.assert_frame_equal(shard(households), households.loc[hh_ids])
+    pdt.assert_frame_equal(shard(persons), persons.loc[person_ids])
+    pdt.assert_frame_equal(shard(person_windows), person_windows.loc[person_ids])
+    assert shard(land_use) is None
+
+
+def test_restore_shard_order():
+
+    index = pd.Index([3, 1, 4, 2], name='PERID')
+    df = pd.DataFrame({'x': [10, 30, 20, 40]}, index=pd.Index([1, 3, 2, 4], name='PERID'))
+
+    pdt.assert_frame_equal(mp_tasks.restore_shard_order(df, index, 'persons'), df.loc[index])
+
+    # dropped rows are skipped and new rows follow in shard order
+    df = pd.DataFrame({'x': [10, 50, 20, 40]}, index=pd.Index([1, 5, 2, 4], name='PERID'))
+    pdt.assert_frame_equal(mp_tasks.restore_shard_order(df, index, 'persons'),
+                           df.loc[[1, 4, 2, 5]])
+
+
+def test_coalesce_checkpoints(tmpdir):
+
+    checkpoints = pd.DataFrame({
+        'checkpoint_name': ['init', 'tour_frequency', 'tour_scheduling'],
+        'timestamp': ['t0', 't1', 't2'],
+        'prng_channels': ['p0', 'p1', 'p2'],
+        'land_use': ['init', 'init', 'tour_scheduling'],
+        'persons': ['init', 'tour_frequency', 'tour_frequency'],
+        'tours': ['', 'tour_frequency', 'tour_scheduling'],
+    })
+
+    # persons and tours of each shard
+    shards = [([1, 2], [10, 11, 20]), ([3], [30])]
+
+    stores = []
+    for shard, (person_ids, tour_ids) in enumerate(shards):
+        store = pd.HDFStore(str(tmpdir.join('pipeline-%s.h5' % shard)), mode='w')
+        store['checkpoints'] = checkpoints
+        store['land_use/init'] = pd.DataFrame({'area': [1, 2]})
+        # (land_use is the same in every shard, but tell them apart to see which one is used)
+        store['land_use/tour_scheduling'] = pd.DataFrame({'area': [shard, shard]})
+        for checkpoint_name in ['init', 'tour_frequency']:
+            store['persons/%s' % checkpoint_name] = \
+                pd.DataFrame({'age': person_ids}, index=pd.Index(person_ids, name='PERID'))
+        for checkpoint_name in ['tour_frequency', 'tour_scheduling']:
+            store['tours/%s' % checkpoint_name] = \
+                pd.DataFrame({'person_id': [t // 10 for t in tour_ids]},
+                             index=pd.Index(tour_ids, name='tour_id'))
+        stores.append(store)
+
+    sharded_tables = {'persons': pd.Index([1, 2, 3], name='PERID')}
+
+    try:
+        coalesced = list(mp_tasks.coalesce_checkpoints(stores, 'init', sharded_tables))
+    finally:
+        for store in stores:
+            store.close()
+
+    assert [(c, sorted(tables.keys()), p) for c, tables, p in coalesced] == \
+        [('tour_frequency', ['persons', 'tours'], 'p1'),
+         ('tour_scheduling', ['land_use', 'tours'], 'p2')]
+
+    tables = coalesced[0][1]
+    assert list(tables['persons'].index) == [1, 2, 3]
+    assert list(tables['tours'].index) == [10, 11, 20, 30]
+
+    # tables created by the shard models are concatenated whenever they are rewritten
+    tables = coalesced[1][1]
+    assert list(tables['tours'].index) == [10, 11, 20, 30]
+    assert list(tables['tours'].person_id) == [1, 1, 2, 3]
+
+    # and tables that were neither sharded nor created by the shard models come from one shard
+    assert list(tables['land_use'].area) == [0, 0]
+
+
+def test_shard_pipeline_path():
+
+    assert mp_tasks.shard_pipeline_path('output/pipeline.h5', 2) == 'output/pipeline-2.h5'
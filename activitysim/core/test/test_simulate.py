@@ -3,6 +3,7 @@
 
 import os.path
 
+import numpy as np
 import numpy.testing as npt
 import pandas as pd
 import pandas.util.testing as pdt
@@ -13,6 +14,13 @@ import orca
 from .. import simulate
 
 
+@pytest.fixture(autouse=True)
+def chunk_settings():
+    # rather than the abm chunk setting injectables, which read the settings file
+    orca.add_injectable('rss_ceiling', 0)
+    orca.add_injectable('adaptive_chunking', False)
+
+
 @pytest.fixture(scope='module')
 def data_dir():
     return os.path.join(os.path.dirname(__file__), 'data')
@@ -73,9 +81,114 @@ def test_eval_variables(spec, data):
     pdt.assert_frame_equal(result, expected_result, check_names=False)
 
 
+def test_eval_variables_array(spec, data):
+
+    values = simulate.eval_variables_array(spec.index, data)
+
+    assert values.flags.f_contiguous
+    assert values.dtype == np.float64
+    npt.assert_array_equal(values, simulate.eval_variables(spec.index, data).values)
+
+    values = simulate.eval_variables_array(spec.index, data, dtype=np.float32)
+    assert values.dtype == np.float32
+    npt.assert_array_equal(values, [[1, 0, 4, 1], [0, 1, 4, 1], [0, 1, 5, 1]])
+
+
+def test_compute_utilities(spec, data):
+
+    expression_values = simulate.eval_variables(spec.index, data)
+
+    utilities = simulate.compute_utilities(expression_values, spec)
+    pdt.assert_frame_equal(utilities, expression_values.dot(spec))
+
+    # float32 expression values
+    expression_values = simulate.eval_variables(spec.index, data, target_type=np.float32)
+    utilities32 = simulate.compute_utilities(expression_values, spec)
+    assert utilities32.dtypes.tolist() == [np.float64, np.float64]
+    pdt.assert_frame_equal(utilities32, utilities, check_less_precise=True)
+
+
+def test_compute_segmented_utilities(spec, data):
+
+    segmented_spec = pd.concat([spec, spec * 2], axis=1, keys=['a', 'b'])
+    segments = pd.Series(['b', 'a', 'b'], index=data.index)
+
+    expression_values = simulate.eval_variables(spec.index, data, target_type=np.float64)
+
+    utilities = simulate.compute_utilities(expression_values, segmented_spec, segments)
+
+    expected = expression_values.dot(spec)
+    expected[segments == 'b'] *= 2
+
+    pdt.assert_frame_equal(utilities, expected)
+
+
+def test_sparse_dot(monkeypatch):
+
+    values = np.asfortranarray(np.arange(12, dtype=np.float64).reshape(4, 3))
+    coefficients = np.array([[0.0, 2.0, 0.0],
+                             [1.0, 0.0, 0.0],
+                             [0.0, 0.5, 0.0]])
+
+    utilities = simulate.sparse_dot(values, coefficients)
+
+    npt.assert_array_equal(utilities, np.dot(values, coefficients))
+
+    # nan and inf values of expressions with zero coefficients propagate as in np.dot
+    values[0, 1] = np.nan
+    values[2, 2] = np.inf
+    values[3, 0] = -np.inf
+    utilities = simulate.sparse_dot(values, coefficients)
+    npt.assert_array_equal(utilities, np.dot(values, coefficients))
+    assert np.isnan(utilities[0]).all()
+
+    # so the sparse (column-major) and dense (row-major) paths of dot_coefficients agree
+    monkeypatch.setattr(simulate, 'SPARSE_SPEC_MAX_DENSITY', 0.5)
+    sparse_utilities = simulate.dot_coefficients(values, coefficients)
+    dense_utilities = simulate.dot_coefficients(np.ascontiguousarray(values), coefficients)
+    npt.assert_array_equal(sparse_utilities, dense_utilities)
+
+
+def test_nested_probabilities():
+
+    nest_spec = {
+        'name': 'root',
+        'coefficient': 1.0,
+        'alternatives': [
+            {'name': 'A', 'coefficient': 0.5, 'alternatives': ['a1', 'a2']},
+            'b'
+        ]
+    }
+
+    raw_utilities = pd.DataFrame([[0.0, 0.0, 0.0], [-999.0, 0.0, -999.0]],
+                                 columns=['a2', 'b', 'a1'])
+
+    nested_exp_utilities = simulate.compute_nested_exp_utilities(raw_utilities, nest_spec)
+    assert list(nested_exp_utilities.columns) == ['a1', 'a2', 'A', 'b', 'root']
+    npt.assert_array_almost_equal(nested_exp_utilities.values,
+                                  [[1, 1, np.sqrt(2), 1, np.sqrt(2) + 1],
+                                   [0, 0, 0, 1, 1]])
+
+    nested_probabilities = \
+        simulate.compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label=None)
+    p_A = np.sqrt(2) / (np.sqrt(2) + 1)
+    assert list(nested_probabilities.columns) == ['A', 'b', 'a1', 'a2']
+    npt.assert_array_almost_equal(nested_probabilities.values,
+                                  [[p_A, 1 - p_A, 0.5, 0.5],
+                                   [0, 1, 0, 0]])
+
+    base_probabilities = simulate.compute_base_probabilities(nested_probabilities, nest_spec)
+    assert list(base_probabilities.columns) == ['a1', 'a2', 'b']
+    npt.assert_array_almost_equal(base_probabilities.values,
+                                  [[p_A / 2, p_A / 2, 1 - p_A],
+                                   [0, 0, 1]])
+
+
 def test_simple_simulate(data, spec):
 
     orca.add_injectable("check_for_variability", False)
+    orca.add_injectable("expression_values_dtype", 'float64')
+    orca.add_injectable("num_threads", 1)
 
     choices = simulate.simple_simulate(data, spec, nest_spec=None)
     expected = pd.Series([1, 1, 1], index=data.index)
@@ -85,7 +198,32 @@ def test_simple_simulate(data, spec):
 def test_simple_simulate_chunked(data, spec):
 
     orca.add_injectable("check_for_variability", False)
+    orca.add_injectable("expression_values_dtype", 'float64')
+    orca.add_injectable("num_threads", 1)
 
     choices = simulate.simple_simulate(data, spec, nest_spec=None, chunk_size=2)
     expected = pd.Series([1, 1, 1], index=data.index)
     pdt.assert_series_equal(choices, expected)
+
+
+@pytest.fixture
+def reset_num_threads():
+    yield
+    orca.add_injectable("num_threads", 1)
+
+
+def test_simple_simulate_threaded(data, spec, reset_num_threads):
+
+    orca.add_injectable("check_for_variability", False)
+    orca.add_injectable("expression_values_dtype", 'float64')
+
+    choosers = pd.concat([data] * 10, ignore_index=True)
+
+    orca.add_injectable("num_threads", 1)
+    expected = simulate.simple_simulate(choosers, spec, nest_spec=None, chunk_size=2)
+
+    # several chunks of choosers run concurrently
+    orca.add_injectable("num_threads", 3)
+    choices = simulate.simple_simulate(choosers, spec, nest_spec=None, chunk_size=2)
+
+    pdt.assert_series_equal(choices, expected)
@@ -1,6 +1,8 @@
 # ActivitySim
 # See full license in LICENSE.txt.
 
+import multiprocessing
+
 import numpy as np
 import pandas as pd
 import numpy.testing as npt
@@ -57,6 +59,30 @@ def test_offset_list(data):
         sk.get(orig, dest),
         [52, 99, 16])
 
+    # non-contiguous zone ids use a dense offset array
+    assert offset_mapper.offset_array is not None
+
+    with pytest.raises(AssertionError):
+        offset_mapper.map(np.array([60, 55]))
+
+    with pytest.raises(AssertionError):
+        offset_mapper.map(np.array([60, 1000]))
+
+
+def test_offset_list_sparse(data):
+
+    # zone ids too sparse for a dense offset array
+    offset_mapper = skim.OffsetMapper()
+    offset_mapper.set_offset_list([1, 2, 3, 4, 5, 6, 7, 8, 9, 100000])
+
+    assert offset_mapper.offset_array is None
+
+    sk = skim.SkimWrapper(data, offset_mapper)
+
+    npt.assert_array_equal(
+        sk.get([6, 100000, 2], [3, 100000, 7]),
+        [52, 99, 16])
+
 
 def test_skim_nans(data):
     sk = skim.SkimWrapper(data)
@@ -85,12 +111,13 @@ def test_skims(data):
 
     skims.set_df(df)
 
+    # integer zone ids return values in skim dtype
     pdt.assert_series_equal(
         skims["AM"],
         pd.Series(
             [12, 93, 47],
             index=[0, 1, 2]
-        ).astype('float64')
+        ).astype(data.dtype)
     )
 
     pdt.assert_series_equal(
@@ -98,6 +125,17 @@ def test_skims(data):
         pd.Series(
             [120, 930, 470],
             index=[0, 1, 2]
+        ).astype(data.dtype)
+    )
+
+    # float zone ids (which might be NaN) return float64
+    skims.set_df(df.astype('float64'))
+
+    pdt.assert_series_equal(
+        skims["AM"],
+        pd.Series(
+            [12, 93, 47],
+            index=[0, 1, 2]
         ).astype('float64')
     )
 
@@ -111,6 +149,12 @@ def test_3dskims(data):
 
     stack = skim.SkimStack(skim_dict)
 
+    # tuple key skims are replaced by views into period-major stacked data
+    stacked_data, key2_list = skim_dict.stacks["SOV"]
+    assert stacked_data.shape == (2, 10, 10)
+    assert key2_list == ["AM", "PM"]
+    assert skim_dict.skims[("SOV", "PM")].base is stacked_data
+
     skims3d = stack.wrap(left_key="taz_l", right_key="taz_r", skim_key="period")
 
     df = pd.DataFrame({
@@ -129,3 +173,286 @@ def test_3dskims(data):
         ),
         check_dtype=False
     )
+
+
+def test_skim_cache(data, tmpdir):
+
+    skim_dict = skim.SkimDict()
+    skim_dict.offset_mapper.set_offset_int(-1)
+
+    skim_dict.set('DIST', data)
+    skim_dict.set(('SOV', 'AM'), data.astype(np.float32))
+    skim_dict.set_stack('HOV', ['AM', 'PM'], np.stack([data, data * 10]))
+
+    cache_dir = str(tmpdir.join('cache'))
+    source = {'omx_file': 'skims.omx', 'size': 1}
+
+    assert skim.read_skim_cache(cache_dir, source) is None
+
+    skim.write_skim_cache(skim_dict, cache_dir, source)
+
+    # stale if source doesn't match
+    assert skim.read_skim_cache(cache_dir, {'omx_file': 'skims.omx', 'size': 2}) is None
+
+    cached_skim_dict = skim.read_skim_cache(cache_dir, source)
+
+    assert cached_skim_dict.offset_mapper.offset_int == -1
+    assert sorted(cached_skim_dict.skims.keys()) == sorted(skim_dict.skims.keys())
+
+    for key in skim_dict.skims:
+        cached_data = cached_skim_dict.skims[key]
+        assert isinstance(cached_data, np.memmap)
+        assert cached_data.dtype == skim_dict.skims[key].dtype
+        npt.assert_array_equal(cached_data, skim_dict.skims[key])
+
+    npt.assert_array_equal(
+        cached_skim_dict.get(('SOV', 'AM')).get([6, 10, 2], [3, 10, 7]),
+        [52, 99, 16])
+
+    # stacks are cached as a single 3D array
+    stacked_data, key2_list = cached_skim_dict.stacks['HOV']
+    assert isinstance(stacked_data, np.memmap)
+    assert key2_list == ['AM', 'PM']
+    npt.assert_array_equal(stacked_data, skim_dict.stacks['HOV'][0])
+
+
+def test_3dskims_stacked(data):
+
+    skim_dict = skim.SkimDict()
+
+    stacked_data = np.stack([data, data*10])
+    skim_dict.set_stack("SOV", ["AM", "PM"], stacked_data)
+
+    npt.assert_array_equal(skim_dict.skims[("SOV", "PM")], data*10)
+
+    stack = skim.SkimStack(skim_dict)
+
+    # stack uses stacked data as is
+    assert stack.get("SOV")[0] is stacked_data
+
+    npt.assert_array_equal(
+        stack.lookup(np.array([1, 9, 4]), np.array([2, 3, 7]), np.array(["AM", "PM", "AM"]), "SOV"),
+        [12, 930, 47])
+
+
+def sum_shared_skims(buffer, layout, queue):
+
+    skim_dict = skim.attach_skim_buffer(buffer, layout)
+    stack = skim.SkimStack(skim_dict)
+
+    queue.put((skim_dict.skims['DIST'].sum(), stack.get('SOV')[0].sum()))
+
+
+def test_shared_skims(data):
+
+    skims = {
+        'DIST': data,
+        ('SOV', 'AM'): data.astype(np.float32),
+        ('SOV', 'PM'): data * 10,
+    }
+    offset_mapper = skim.OffsetMapper(offset_int=-1)
+
+    buffer, layout = skim.load_skim_buffer(skims, offset_mapper, shared=True)
+
+    assert layout['nbytes'] <= len(buffer)
+
+    skim_dict = skim.attach_skim_buffer(buffer, layout)
+
+    assert skim_dict.offset_mapper.offset_int == -1
+    assert sorted(skim_dict.skims.keys()) == sorted(skims.keys())
+    for key in skims:
+        npt.assert_array_equal(skim_dict.skims[key], skims[key])
+
+    # stacked skims are upcast to a common dtype
+    stacked_data, key2_list = skim_dict.stacks['SOV']
+    assert key2_list == ['AM', 'PM']
+    assert stacked_data.dtype == np.result_type(np.float32, data.dtype)
+
+    # attached skims are views into buffer, not copies
+    other_skim_dict = skim.attach_skim_buffer(buffer, layout)
+    other_skim_dict.skims['DIST'][0, 0] = 1000
+    assert skim_dict.skims['DIST'][0, 0] == 1000
+    other_skim_dict.skims['DIST'][0, 0] = 0
+
+    npt.assert_array_equal(
+        skim_dict.get(('SOV', 'PM')).get([6, 10, 2], [3, 10, 7]),
+        [520, 990, 160])
+
+    # child process attaches to the same buffer
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=sum_shared_skims, args=(buffer, layout, queue))
+    p.start()
+    dist_sum, sov_sum = queue.get()
+    p.join()
+
+    assert dist_sum == data.sum()
+    assert sov_sum == data.sum() * 11
+
+
+def test_3dskims_categorical(data):
+
+    skim_dict = skim.SkimDict()
+
+    skim_dict.set(("SOV", "AM"), data)
+    skim_dict.set(("SOV", "PM"), data*10)
+
+    stack = skim.SkimStack(skim_dict)
+
+    orig = np.array([1, 9, 4, 0])
+    dest = np.array([2, 3, 7, 0])
+    period = pd.Series(["PM", "PM", "AM", "PM"])
+
+    # category order need not match stack order
+    period_cat = pd.Series(pd.Categorical(period, categories=["PM", "MD", "AM"]))
+
+    npt.assert_array_equal(stack.skim_indexes("SOV", period_cat), [1, 1, 0, 1])
+
+    npt.assert_array_equal(stack.lookup(orig, dest, period_cat, "SOV"), [120, 930, 47, 0])
+    npt.assert_array_equal(stack.lookup(orig, dest, period, "SOV"), [120, 930, 47, 0])
+
+    with pytest.raises(AssertionError):
+        stack.lookup(orig, dest, pd.Series(["PM", "EV", "AM", "PM"]), "SOV")
+
+
+def test_skim_dtypes(data):
+
+    skim_dtypes = [
+        {'skims': ['*_TIME'], 'dtype': 'float16'},
+        {'skims': ['DIST*'], 'dtype': 'int16', 'scale': 0.01},
+    ]
+
+    assert skim.skim_storage(('SOV_TIME', 'AM'), skim_dtypes) == (np.float16, None)
+    assert skim.skim_storage('DISTWALK', skim_dtypes) == (np.int16, 0.01)
+    assert skim.skim_storage('FARE', skim_dtypes) == (None, None)
+
+    dist = data / 10.0
+    skims = {
+        'DIST': dist,
+        'FARE': data.astype(np.float32),
+        ('SOV_TIME', 'AM'): dist,
+        ('SOV_TIME', 'PM'): dist * 2,
+    }
+
+    buffer, layout = skim.load_skim_buffer(skims, skim.OffsetMapper(), skim_dtypes=skim_dtypes)
+    skim_dict = skim.attach_skim_buffer(buffer, layout)
+
+    assert skim_dict.skims['DIST'].dtype == np.int16
+    assert skim_dict.skims['FARE'].dtype == np.float32
+    assert skim_dict.stacks['SOV_TIME'][0].dtype == np.float16
+    assert skim_dict.scales == {'DIST': 0.01}
+
+    orig = [5, 9, 1]
+    dest = [2, 9, 6]
+
+    values = skim_dict.get('DIST').get(orig, dest)
+    assert values.dtype == np.float64
+    npt.assert_array_almost_equal(values, [5.2, 9.9, 1.6])
+
+    values = skim.SkimStack(skim_dict).lookup(np.array(orig), np.array(dest),
+                                              np.array(['AM', 'PM', 'PM']), 'SOV_TIME')
+    assert values.dtype == np.float64
+    npt.assert_allclose(values, [5.2, 19.8, 3.2], rtol=1e-3)
+
+    # packed skims are copied as is, not rescaled
+    buffer, layout = skim.load_skim_buffer(skim_dict.skims, skim_dict.offset_mapper,
+                                           skim_dtypes=skim_dtypes, packed=True)
+    npt.assert_array_equal(skim.attach_skim_buffer(buffer, layout).skims['DIST'],
+                           skim_dict.skims['DIST'])
+
+    with pytest.raises(AssertionError):
+        skim.load_skim_buffer({'DIST': dist * 1000}, skim.OffsetMapper(), skim_dtypes=skim_dtypes)
+
+    nan_dist = dist.copy()
+    nan_dist[0, 0] = np.nan
+    with pytest.raises(AssertionError):
+        skim.load_skim_buffer({'DIST': nan_dist}, skim.OffsetMapper(), skim_dtypes=skim_dtypes)
+
+
+def test_skim_dtypes_scaled_source_dtype(data):
+
+    # omx skims already in the storage dtype are still packed by the scale
+    skim_dtypes = [{'skims': ['DIST*'], 'dtype': 'int16', 'scale': 0.01}]
+
+    dist = data.astype(np.int16)
+
+    buffer, layout = skim.load_skim_buffer({'DIST': dist}, skim.OffsetMapper(),
+                                           skim_dtypes=skim_dtypes)
+    skim_dict = skim.attach_skim_buffer(buffer, layout)
+
+    assert skim_dict.skims['DIST'].dtype == np.int16
+    npt.assert_array_equal(skim_dict.skims['DIST'], data * 100)
+    npt.assert_array_almost_equal(skim_dict.get('DIST').get([5, 9, 1], [2, 9, 6]), [52, 99, 16])
+
+    # scale needs an integer dtype
+    with pytest.raises(RuntimeError):
+        skim.skim_storage('DIST', [{'skims': ['DIST'], 'dtype': 'float32', 'scale': 0.01}])
+
+
+def test_skim_int_fast_path(data):
+
+    sk = skim.SkimWrapper(data.astype(np.float32), skim.OffsetMapper(-1))
+
+    orig = pd.Series([6, 10, 2])
+    dest = pd.Series([3, 10, 7])
+
+    values = sk.get(orig, dest)
+    assert values.dtype == np.float32
+    npt.assert_array_equal(values, [52, 99, 16])
+
+    values = sk.get(orig.astype(np.float64), dest)
+    assert values.dtype == np.float64
+    npt.assert_array_equal(values, [52, 99, 16])
+
+
+def test_skim_lookup_memo(data):
+
+    skim_dict = skim.SkimDict()
+    skim_dict.set('AM', data)
+    skim_dict.set(('SOV', 'AM'), data)
+    skim_dict.set(('SOV', 'PM'), data * 10)
+
+    df = pd.DataFrame({
+        "taz_l": [1, 9, 4],
+        "taz_r": [2, 3, 7],
+        "period": ["AM", "PM", "AM"]
+    })
+
+    skims = skim_dict.wrap("taz_l", "taz_r")
+    skims3d = skim.SkimStack(skim_dict).wrap("taz_l", "taz_r", "period")
+
+    for wrapper, key in [(skims, 'AM'), (skims3d, 'SOV')]:
+
+        wrapper.set_df(df)
+        values = wrapper[key]
+        assert wrapper[key] is values
+
+        # set_df clears memo
+        wrapper.set_df(df.iloc[:2])
+        assert wrapper[key] is not values
+        assert len(wrapper[key]) == 2
+
+    # no memoization beyond max_bytes
+    skim_dict.memo_max_bytes = 0
+    skims = skim_dict.wrap("taz_l", "taz_r")
+    skims.set_df(df)
+    assert skims['AM'] is not skims['AM']
+    pdt.assert_series_equal(skims['AM'], skims['AM'])
+
+
+def test_skim_get_broadcast(data):
+
+    sk = skim.SkimWrapper(data, skim.OffsetMapper(-1))
+
+    orig = np.array([[6], [10]])
+    dest = np.array([[3, 10, 7]])
+
+    expected = sk.get(np.repeat(orig.ravel(), 3), np.tile(dest.ravel(), 2)).reshape(2, 3)
+    npt.assert_array_equal(sk.get_broadcast(orig, dest), expected)
+
+    # alternative (1, m) zones may be the origins
+    expected = sk.get(np.tile(dest.ravel(), 2), np.repeat(orig.ravel(), 3)).reshape(2, 3)
+    npt.assert_array_equal(sk.get_broadcast(dest, orig), expected)
+
+    values = sk.get_broadcast(np.array([[6.0], [np.nan]]), dest)
+    assert values.dtype == np.float64
+    npt.assert_array_equal(values, [[52, 59, 56], [np.nan, np.nan, np.nan]])
@@ -29,6 +29,13 @@ def memory_info():
     return "memory_info: vms: %s rss: %s uss: %s" % (GB(mi.vms), GB(mi.rss), GB(mi.uss))
 
 
+def rss():
+    """
+    resident set size of this process in bytes
+    """
+    return psutil.Process().memory_info().rss
+
+
 def force_garbage_collect():
 
     gc.collect()
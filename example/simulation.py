@@ -10,6 +10,7 @@ from activitysim.core.config import handle_standard_args
 from activitysim.core.config import setting
 
 from activitysim.core import pipeline
+from activitysim.core import mp_tasks
 import extensions
 
 handle_standard_args()
@@ -33,7 +34,8 @@ resume_after = setting('resume_after', None)
 if resume_after:
     print "resume_after", resume_after
 
-pipeline.run(models=MODELS, resume_after=resume_after)
+# with num_processes > 1, household models are run on household shards in worker processes
+mp_tasks.run_multiprocess(models=MODELS, resume_after=resume_after)
 
 # tables will no longer be available after pipeline is closed
 pipeline.close_pipeline()
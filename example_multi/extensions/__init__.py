@@ -1,3 +1,4 @@
 import skims
 import los
+import transit_path
 import models
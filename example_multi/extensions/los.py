@@ -15,6 +15,91 @@ from activitysim.core.tracing import print_elapsed_time
 logger = logging.getLogger('activitysim')
 
 
+class CSRConnectivity(object):
+    """
+    Compressed sparse row (CSR) representation of a maz2maz or maz2tap table
+
+    Rows of df are sorted by origin and then destination, so that the rows for origin o are
+    rows row_ptr[o]:row_ptr[o+1], and attribute values are held as numpy arrays in that order.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        with integer origin and destination columns (at most one row per pair)
+    orig_col : str
+        name of origin column (e.g. 'OMAZ' or 'MAZ')
+    dest_col : str
+        name of destination column (e.g. 'DMAZ' or 'TAP')
+    """
+
+    def __init__(self, df, orig_col, dest_col):
+
+        orig = df[orig_col].values.astype(np.int64)
+        dest = df[dest_col].values.astype(np.int64)
+
+        order = np.lexsort((dest, orig))
+
+        self.orig = orig[order]
+        self.dest = dest[order]
+        self.columns = {c: df[c].values[order] for c in df.columns}
+
+        self.n_orig = self.orig.max() + 1 if len(order) else 0
+        self.row_ptr = np.zeros(self.n_orig + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.orig, minlength=self.n_orig), out=self.row_ptr[1:])
+
+        # since rows are sorted by (orig, dest), a binary search of this key within each
+        # origin's rows is a binary search of the whole (monotonic) key array
+        self.cardinality = self.dest.max() + 1 if len(order) else 0
+        self.pair_key = self.orig * self.cardinality + self.dest
+
+        assert (np.diff(self.pair_key) > 0).all(), \
+            "CSRConnectivity duplicate %s %s pairs" % (orig_col, dest_col)
+
+    def pair_offsets(self, orig, dest):
+        """
+        row offsets of the orig, dest pairs, or -1 for pairs that aren't in the table
+        """
+
+        orig = np.asanyarray(orig).astype(np.int64)
+        dest = np.asanyarray(dest).astype(np.int64)
+
+        key = orig * self.cardinality + dest
+        offsets = np.searchsorted(self.pair_key, key)
+
+        found = (dest >= 0) & (dest < self.cardinality) & (offsets < len(self.pair_key))
+        found[found] = self.pair_key[offsets[found]] == key[found]
+
+        return np.where(found, offsets, -1)
+
+    def get_pairs(self, orig, dest, attribute):
+        """
+        attribute values for orig, dest pairs (NaN for pairs that aren't in the table)
+        """
+
+        offsets = self.pair_offsets(orig, dest)
+
+        values = self.columns[attribute].take(offsets).astype(np.float64)
+        values[offsets < 0] = np.nan
+
+        return values
+
+    def row_offsets(self, orig):
+        """
+        offsets of the rows for each origin in orig, and the position in orig each belongs to
+        """
+
+        orig = np.asanyarray(orig).astype(np.int64)
+
+        in_range = (orig >= 0) & (orig < self.n_orig)
+        starts = np.where(in_range, self.row_ptr[np.where(in_range, orig, 0)], 0)
+        counts = np.where(in_range, self.row_ptr[np.where(in_range, orig + 1, 0)] - starts, 0)
+
+        positions = np.repeat(np.arange(len(orig)), counts)
+        offsets = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+
+        return offsets, positions
+
+
 class NetworkLOS(object):
 
     def __init__(self, taz, maz, tap, maz2maz, maz2tap,
@@ -28,19 +113,13 @@ class NetworkLOS(object):
 
         # maz2maz_df
         self.maz2maz_df = maz2maz
-        # create single index for fast lookup
-        m = maz2maz.DMAZ.max() + 1
-        maz2maz['i'] = maz2maz.OMAZ * m + maz2maz.DMAZ
-        maz2maz.set_index('i', drop=True, inplace=True, verify_integrity=True)
-        self.maz2maz_cardinality = m
+        # CSR by OMAZ for fast lookup
+        self.maz2maz = CSRConnectivity(maz2maz, 'OMAZ', 'DMAZ')
 
         # maz2tap_df
         self.maz2tap_df = maz2tap
-        # create single index for fast lookup
-        m = maz2tap.TAP.max() + 1
-        maz2tap['i'] = maz2tap.MAZ * m + maz2tap.TAP
-        maz2tap.set_index('i', drop=True, inplace=True, verify_integrity=True)
-        self.maz2tap_cardinality = m
+        # CSR by MAZ for fast lookup
+        self.maz2tap = CSRConnectivity(maz2tap, 'MAZ', 'TAP')
 
         self.taz_skim_dict = taz_skim_dict
         self.taz_skim_stack = askim.SkimStack(taz_skim_dict)
@@ -88,21 +167,11 @@ class NetworkLOS(object):
         #              self.maz2maz_df,
         #              how="left")[attribute]
 
-        # synthetic index method i : omaz_dmaz
-        i = np.asanyarray(omaz) * self.maz2maz_cardinality + np.asanyarray(dmaz)
-        s = quick_loc_df(i, self.maz2maz_df, attribute)
-
-        # FIXME - no point in returning series? unless maz and tap have same index?
-        return np.asanyarray(s)
+        return self.maz2maz.get_pairs(omaz, dmaz, attribute)
 
     def get_maztappairs(self, maz, tap, attribute):
 
-        # synthetic i method : maz_tap
-        i = np.asanyarray(maz) * self.maz2tap_cardinality + np.asanyarray(tap)
-        s = quick_loc_df(i, self.maz2tap_df, attribute)
-
-        # FIXME - no point in returning series? unless maz and tap have sme index?
-        return np.asanyarray(s)
+        return self.maz2tap.get_pairs(maz, tap, attribute)
 
     def get_taps_mazs(self, maz, attribute=None, filter=None):
 
@@ -113,27 +182,32 @@ class NetworkLOS(object):
         # if maz is a series, then idx has the original maz series index values
         # otherwise it has the 0-based integer offset of the original maz
 
-        if filter:
-            maz2tap_df = self.maz2tap_df[pd.notnull(self.maz2tap_df[filter])]
-        else:
-            maz2tap_df = self.maz2tap_df
+        # maz2tap rows for each maz are contiguous slices of the CSR arrays
+        offsets, positions = self.maz2tap.row_offsets(maz)
 
-        if attribute:
-            # FIXME - not sure anyone needs this feature
-            maz2tap_df = maz2tap_df[['MAZ', 'TAP', attribute]]
-            # filter out null attribute rows
-            maz2tap_df = maz2tap_df[pd.notnull(self.maz2tap_df[attribute])]
-        else:
-            maz2tap_df = maz2tap_df[['MAZ', 'TAP']]
+        columns = self.maz2tap.columns
+
+        # filter out rows with null filter or attribute
+        for c in [filter, attribute]:
+            if c:
+                notnull = pd.notnull(columns[c][offsets])
+                offsets, positions = offsets[notnull], positions[notnull]
 
         if isinstance(maz, pd.Series):
             # idx based on index of original maz series
-            maz_df = pd.DataFrame({'MAZ': maz, 'idx': maz.index})
+            idx = maz.index.values[positions]
         else:
             # 0-based index of original maz
-            maz_df = pd.DataFrame({'MAZ': maz, 'idx': range(len(maz))})
+            idx = positions
+
+        df = pd.DataFrame({'MAZ': columns['MAZ'][offsets],
+                           'idx': idx,
+                           'TAP': columns['TAP'][offsets]},
+                          columns=['MAZ', 'idx', 'TAP'])
 
-        df = pd.merge(maz_df, maz2tap_df, how="inner", sort=False)
+        if attribute:
+            # FIXME - not sure anyone needs this feature
+            df[attribute] = columns[attribute][offsets]
 
         return df
 
@@ -14,6 +14,8 @@ from activitysim.core import inject
 from activitysim.core import tracing
 from activitysim.core import config
 
+from transit_path import BestTransitPathBuilder
+
 
 logger = logging.getLogger('activitysim')
 
@@ -29,6 +31,19 @@ def best_transit_path_settings(configs_dir):
     return config.read_model_settings(configs_dir, 'best_transit_path.yaml')
 
 
+@inject.injectable(cache=True)
+def transit_path_builder(network_los, best_transit_path_settings, settings):
+    # cached so that best paths cached by the builder are kept for the whole run
+    return BestTransitPathBuilder(
+        network_los,
+        constants=config.get_model_constants(best_transit_path_settings),
+        tods=settings['skim_time_periods']['labels'],
+        max_access_taps=best_transit_path_settings.get('max_access_taps', 10),
+        max_egress_taps=best_transit_path_settings.get('max_egress_taps', 10),
+        cache_best_paths=best_transit_path_settings.get('cache_best_paths', True),
+        od_chunk_size=best_transit_path_settings.get('od_chunk_size', 100000))
+
+
 VECTOR_TEST_SIZE = 100000
 VECTOR_TEST_SIZE = 1014699
 
@@ -49,6 +64,10 @@ def best_transit_path(set_random_seed,
     trace_od = (od_df.omaz[0], od_df.dmaz[0])
     logger.info("trace_od omaz %s dmaz %s" % trace_od)
 
+    if best_transit_path_settings.get('path_builder', False):
+        best_transit_path_builder(od_df, trace_od)
+        return
+
     # build exploded atap_btap_df
 
     # FIXME - pathological knowledge about mode - should be parameterized
@@ -118,3 +137,28 @@ def best_transit_path(set_random_seed,
 
             if trace_assigned_locals:
                 tracing.write_csv(trace_assigned_locals, file_name="trace_best_transit_path_locals")
+
+
+def best_transit_path_builder(od_df, trace_od):
+    """
+    best_transit_path using the pruned, vectorized BestTransitPathBuilder
+    rather than evaluating best_transit_path_spec over every btap-atap pair
+    """
+
+    path_builder = inject.get_injectable('transit_path_builder')
+
+    paths = path_builder.best_paths(od_df.omaz, od_df.dmaz, od_df.tod)
+    paths.index = od_df.index
+    paths = pd.concat([od_df, paths], axis=1)
+
+    logger.info("len od_df %s" % len(od_df.index))
+    logger.info("%s ods with no transit path" % paths.utility.isnull().sum())
+
+    if trace_od:
+        trace_orig, trace_dest = trace_od
+        trace_rows = (paths.omaz == trace_orig) & (paths.dmaz == trace_dest)
+
+        tracing.trace_df(paths[trace_rows],
+                         label='best_transit_path',
+                         slicer='NONE',
+                         transpose=False)
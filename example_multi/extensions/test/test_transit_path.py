@@ -0,0 +1,133 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import os
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+
+from activitysim.core import assign
+from activitysim.core import config
+from activitysim.core import skim
+
+from ..los import NetworkLOS
+from ..transit_path import BestTransitPathBuilder
+
+TODS = ['AM', 'PM']
+
+
+@pytest.fixture(scope='module')
+def configs_dir():
+    return os.path.join(os.path.dirname(__file__), '..', '..', 'configs')
+
+
+@pytest.fixture(scope='module')
+def network_los():
+
+    rs = np.random.RandomState(0)
+
+    n_taps = 5
+
+    taz = pd.DataFrame({'area': [1.0, 2.0]}, index=pd.Index([0, 1], name='TAZ'))
+
+    # maz 7 has no taps and the largest maz id
+    maz = pd.DataFrame({'TAZ': [0, 0, 0, 1, 1, 1, 1, 1]},
+                       index=pd.Index(np.arange(8), name='MAZ'))
+
+    tap = pd.DataFrame({'distance': rs.uniform(0, 500, n_taps)},
+                       index=pd.Index(np.arange(n_taps), name='TAP'))
+
+    maz2maz = pd.DataFrame({'OMAZ': [0, 0, 1, 2, 5, 6, 7],
+                            'DMAZ': [1, 2, 0, 3, 6, 5, 1],
+                            'DISTWALK': [0.5, 1.2, 0.5, 0.8, 0.3, 0.3, 1.1]})
+
+    # three taps for each of mazs 0 to 6, some without drive or walk times
+    maz2tap = pd.DataFrame({'MAZ': np.repeat(np.arange(7), 3),
+                            'TAP': np.concatenate([rs.choice(n_taps, 3, replace=False)
+                                                   for m in range(7)])})
+    maz2tap['drive_time'] = rs.uniform(1, 10, len(maz2tap.index))
+    maz2tap['walk_alightingActual'] = rs.uniform(1, 20, len(maz2tap.index))
+    maz2tap.loc[[1, 8], 'drive_time'] = np.nan
+    maz2tap.loc[[4, 12], 'walk_alightingActual'] = np.nan
+
+    tap_skim_dict = skim.SkimDict()
+    for key in ['LOCAL_BUS_INITIAL_WAIT', 'LOCAL_BUS_IVT', 'LOCAL_BUS_FARE',
+                'PREM_BUS_INITIAL_WAIT', 'PREM_BUS_IVT_SUM', 'PREM_BUS_FARE']:
+        for tod in TODS:
+            data = rs.uniform(1, 30, (n_taps, n_taps))
+            if key.startswith('PREM'):
+                data[rs.rand(n_taps, n_taps) < 0.3] = np.nan
+            tap_skim_dict.set((key, tod), data)
+
+    return NetworkLOS(taz, maz, tap, maz2maz, maz2tap, skim.SkimDict(), tap_skim_dict)
+
+
+def test_get_pairs(network_los):
+
+    omaz = np.array([0, 0, 1, 2, 6, 7, 7, 3, 0])
+    dmaz = np.array([1, 2, 0, 3, 5, 1, 0, 3, 7])
+
+    expected = pd.merge(pd.DataFrame({'OMAZ': omaz, 'DMAZ': dmaz}),
+                        network_los.maz2maz_df,
+                        how="left")['DISTWALK']
+
+    npt.assert_array_equal(network_los.get_mazpairs(omaz, dmaz, 'DISTWALK'), expected.values)
+
+    maz2tap_df = network_los.maz2tap_df
+    expected = pd.merge(pd.DataFrame({'MAZ': maz2tap_df.MAZ, 'TAP': maz2tap_df.TAP}),
+                        maz2tap_df,
+                        how="left")['drive_time']
+
+    npt.assert_array_equal(
+        network_los.get_maztappairs(maz2tap_df.MAZ, maz2tap_df.TAP, 'drive_time'),
+        expected.values)
+
+
+def test_best_paths(network_los, configs_dir):
+
+    constants = config.get_model_constants(
+        config.read_model_settings(configs_dir, 'best_transit_path.yaml'))
+
+    builder = BestTransitPathBuilder(network_los, constants, TODS)
+
+    omaz, dmaz = [m.ravel() for m in np.meshgrid(np.arange(8), np.arange(8))]
+    od_df = pd.DataFrame({'omaz': omaz, 'dmaz': dmaz,
+                          'tod': np.resize(TODS, len(omaz))})
+
+    paths = builder.best_paths(od_df.omaz.values, od_df.dmaz.values, od_df.tod.values)
+
+    # best_transit_path.csv evaluated over every btap, atap pair
+    atap_btap_df = network_los.get_tappairs_mazpairs(od_df.omaz, od_df.dmaz,
+                                                     ofilter='drive_time',
+                                                     dfilter='walk_alightingActual')
+    atap_btap_df = atap_btap_df.merge(right=od_df[['tod']], left_on='idx', right_index=True,
+                                      how='left')
+
+    locals_d = {'np': np, 'network_los': network_los}
+    locals_d.update(constants)
+
+    spec = assign.read_assignment_spec(os.path.join(configs_dir, 'best_transit_path.csv'))
+    results, _, _ = assign.assign_variables(spec, atap_btap_df, locals_d)
+    for column in results.columns:
+        atap_btap_df[column] = results[column]
+
+    expected = atap_btap_df.dropna(subset=['utility']).sort_values(by='utility')
+    expected = expected.groupby('idx').tail(1).set_index('idx').reindex(od_df.index)
+
+    npt.assert_almost_equal(paths.utility.values, expected.utility.values)
+
+    found = expected.utility.notnull().values
+    npt.assert_array_equal(paths.btap.values[found], expected.btap.values[found])
+    npt.assert_array_equal(paths.atap.values[found], expected.atap.values[found])
+    npt.assert_array_equal(paths.transit_type.values[found],
+                           expected.transit_type.values[found])
+
+    # no path to or from maz 7, which has no taps
+    no_taps = (od_df.omaz == 7) | (od_df.dmaz == 7)
+    assert paths.utility[no_taps.values].isnull().all()
+    assert (paths.btap[no_taps.values] == -1).all()
+
+    with pytest.raises(AssertionError):
+        builder.best_paths(np.array([0]), np.array([8]), np.array(['AM']))
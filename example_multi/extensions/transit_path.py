@@ -0,0 +1,327 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+"""
+Pruned, vectorized best transit path builder for the three zone (taz, maz, tap) system
+
+A path is omaz -> btap (access), btap -> atap by transit (transit), atap -> dmaz (egress).
+Rather than exploding every od into the full btap x atap cross product and evaluating the
+best_transit_path.csv spec over it, each utility component is computed with array gathers:
+
+ - access and egress utilities are computed once per maz2tap row, and only the best
+   max_access_taps (max_egress_taps) taps of each maz are kept
+ - btap, atap candidate pairs whose access + egress utility plus an upper bound on transit
+   utility can't beat the utility of the path through each od's best access and egress taps
+   are dropped before the transit skims are looked up
+ - the best pair for each od is chosen with a segmented argmax rather than a sort
+
+FIXME - the utility expressions below mirror best_transit_path.csv and use its CONSTANTS
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from activitysim.core import skim as askim
+
+
+logger = logging.getLogger('activitysim')
+
+
+# transit services as (name, initial wait, in vehicle time, fare) tap skim keys
+TRANSIT_SERVICES = [
+    ('local_bus', 'LOCAL_BUS_INITIAL_WAIT', 'LOCAL_BUS_IVT', 'LOCAL_BUS_FARE'),
+    ('premium_bus', 'PREM_BUS_INITIAL_WAIT', 'PREM_BUS_IVT_SUM', 'PREM_BUS_FARE'),
+]
+
+TRANSIT_SERVICE_NAMES = np.array([s[0] for s in TRANSIT_SERVICES], dtype=object)
+
+RESULT_COLUMNS = ['btap', 'atap', 'utility', 'transit_type']
+
+
+class TopTaps(object):
+    """
+    The best (highest utility) k taps of each maz, held in CSR form
+
+    taps for maz m (in descending order of utility) are tap[row_ptr[m]:row_ptr[m+1]]
+    """
+
+    def __init__(self, maz, tap, utility, k):
+
+        # drop rows with no utility (e.g. no drive time from maz to tap)
+        valid = ~np.isnan(utility)
+        maz, tap, utility = maz[valid], tap[valid], utility[valid]
+
+        order = np.lexsort((-utility, maz))
+        maz, tap, utility = maz[order], tap[order], utility[order]
+
+        n_maz = maz.max() + 1 if len(maz) else 0
+        counts = np.bincount(maz, minlength=n_maz)
+        starts = np.cumsum(counts) - counts
+
+        # rank of each row within its maz
+        rank = np.arange(len(maz)) - np.repeat(starts, counts)
+        keep = rank < k
+
+        self.tap = tap[keep]
+        self.utility = utility[keep]
+
+        self.n_maz = n_maz
+        self.row_ptr = np.zeros(n_maz + 1, dtype=np.int64)
+        np.cumsum(np.minimum(counts, k), out=self.row_ptr[1:])
+
+    def slices(self, maz):
+        """
+        start offset and count of the rows for each maz in maz
+        """
+
+        in_range = (maz >= 0) & (maz < self.n_maz)
+        m = np.where(in_range, maz, 0)
+
+        starts = self.row_ptr[m]
+        counts = np.where(in_range, self.row_ptr[m + 1] - starts, 0)
+
+        return starts, counts
+
+
+class BestTransitPathBuilder(object):
+    """
+    Find the best btap, atap pair (and transit service) for omaz, dmaz, tod triples
+
+    Parameters
+    ----------
+    network_los : NetworkLOS
+    constants : dict
+        best_transit_path CONSTANTS (ivt_vot, wait_vot, walk_vot, drive_vot, walk_fpm)
+    tods : list of str
+        time period labels (e.g. skim_time_periods labels)
+    max_access_taps : int
+        number of best boarding taps to consider for each omaz
+    max_egress_taps : int
+        number of best alighting taps to consider for each dmaz
+    cache_best_paths : boolean
+        remember best paths by (omaz, dmaz, tod) so they are only built once
+    od_chunk_size : int
+        number of distinct ods for which to build candidate tap pairs at a time
+    """
+
+    def __init__(self, network_los, constants, tods,
+                 max_access_taps=10, max_egress_taps=10,
+                 cache_best_paths=True, od_chunk_size=100000):
+
+        self.network_los = network_los
+        self.constants = constants
+        self.tods = list(tods)
+        self.od_chunk_size = od_chunk_size
+
+        self.access_taps = self.top_taps('drive_time', self.access_utility, max_access_taps)
+        self.egress_taps = \
+            self.top_taps('walk_alightingActual', self.egress_utility, max_egress_taps)
+
+        self.transit_upper_bounds = np.array([self.transit_upper_bound(tod) for tod in self.tods])
+
+        # od keys pack omaz and dmaz ids, which may be mazs with no taps, so size them by all mazs
+        self.maz_cardinality = max(network_los.maz_df.index.max() + 1,
+                                   self.access_taps.n_maz, self.egress_taps.n_maz, 1)
+
+        self.cache_best_paths = cache_best_paths
+        self.cache = None
+
+    def top_taps(self, attribute, utility_func, k):
+
+        columns = self.network_los.maz2tap.columns
+
+        maz = columns['MAZ'].astype(np.int64)
+        tap = columns['TAP'].astype(np.int64)
+        utility = utility_func(tap, columns[attribute].astype(np.float64))
+
+        top_taps = TopTaps(maz, tap, utility, k)
+
+        logger.info("best_transit_path kept %s of %s %s maz2tap rows" %
+                    (len(top_taps.tap), len(maz), attribute))
+
+        return top_taps
+
+    def access_utility(self, btap, drive_time):
+
+        c = self.constants
+
+        btap_distance = np.asanyarray(self.network_los.get_tap(btap, 'distance'))
+        btap_time = np.where(btap_distance, btap_distance, 0) / c['walk_fpm']
+
+        return (drive_time * c['drive_vot']) + (btap_time * c['walk_vot'])
+
+    def egress_utility(self, atap, walk_time):
+
+        return walk_time * self.constants['drive_vot']
+
+    def transit_utilities(self, wait, ivt, fare):
+
+        c = self.constants
+
+        return (wait * c['wait_vot']) + (ivt * c['ivt_vot']) - fare
+
+    def transit_upper_bound(self, tod):
+        """
+        max over all tap pairs of the transit utility for tod (ignoring nan)
+        """
+
+        tap_skim_stack = self.network_los.tap_skim_stack
+
+        def skim(key):
+            i = tap_skim_stack.skim_keys_to_indexes[key][tod]
+            return askim.unpack_skim_values(tap_skim_stack.skims_data[key][i],
+                                            tap_skim_stack.skim_scales[key])
+
+        bound = -np.inf
+        for service, wait, ivt, fare in TRANSIT_SERVICES:
+            utility = self.transit_utilities(skim(wait), skim(ivt), skim(fare))
+            finite = utility[np.isfinite(utility)]
+            if len(finite):
+                bound = max(bound, finite.max())
+
+        return bound
+
+    def transit(self, btap, atap, tod_codes):
+        """
+        best transit utility and service index (into TRANSIT_SERVICES) for btap, atap, tod
+        """
+
+        tod = pd.Series(pd.Categorical.from_codes(tod_codes, self.tods))
+
+        utility = service = None
+        for i, (name, wait, ivt, fare) in enumerate(TRANSIT_SERVICES):
+
+            u = self.transit_utilities(
+                self.network_los.get_tappairs3d(btap, atap, tod, wait),
+                self.network_los.get_tappairs3d(btap, atap, tod, ivt),
+                self.network_los.get_tappairs3d(btap, atap, tod, fare))
+
+            if utility is None:
+                utility, service = u, np.zeros(len(u), dtype=int)
+            else:
+                better = u > utility
+                utility = np.where(better, u, utility)
+                service[better] = i
+
+        return utility, service
+
+    def best_paths(self, omaz, dmaz, tod):
+        """
+        Best transit path for each omaz, dmaz, tod
+
+        Parameters
+        ----------
+        omaz, dmaz : 1D int arrays
+        tod : 1D array of tod labels
+
+        Returns
+        -------
+        paths : pandas.DataFrame
+            with columns btap, atap, utility, transit_type for each od
+            (utility is nan and taps are -1 if there is no transit path)
+        """
+
+        omaz = np.asanyarray(omaz).astype(np.int64)
+        dmaz = np.asanyarray(dmaz).astype(np.int64)
+
+        tod_codes = pd.Categorical(np.asanyarray(tod), categories=self.tods).codes
+        assert (tod_codes >= 0).all(), "best_paths unknown tod %s" % \
+            np.unique(np.asanyarray(tod)[tod_codes < 0])
+
+        for maz in [omaz, dmaz]:
+            assert ((maz >= 0) & (maz < self.maz_cardinality)).all(), \
+                "best_paths maz ids %s out of range" % \
+                np.unique(maz[(maz < 0) | (maz >= self.maz_cardinality)])
+
+        keys = (omaz * self.maz_cardinality + dmaz) * len(self.tods) + tod_codes
+
+        if self.cache is not None:
+            new_keys = np.unique(keys[~pd.Series(keys).isin(self.cache.index).values])
+        else:
+            new_keys = np.unique(keys)
+
+        paths = pd.concat([self.build_paths(new_keys[i: i + self.od_chunk_size])
+                           for i in range(0, max(len(new_keys), 1), self.od_chunk_size)])
+
+        logger.info("best_transit_path built %s paths for %s ods" % (len(new_keys), len(keys)))
+
+        if self.cache_best_paths:
+            if self.cache is not None:
+                paths = pd.concat([self.cache, paths])
+            self.cache = paths
+
+        return paths.reindex(keys).reset_index(drop=True)
+
+    def build_paths(self, keys):
+        """
+        Build best paths for (unique) od keys
+        """
+
+        n_tods = len(self.tods)
+        tod_codes = keys % n_tods
+        omaz = (keys // n_tods) // self.maz_cardinality
+        dmaz = (keys // n_tods) % self.maz_cardinality
+
+        a_starts, a_counts = self.access_taps.slices(omaz)
+        e_starts, e_counts = self.egress_taps.slices(dmaz)
+
+        # explode into btap x atap candidates, contiguous by od
+        counts = a_counts * e_counts
+        od = np.repeat(np.arange(len(keys)), counts)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        access_rows = a_starts[od] + within // e_counts[od]
+        egress_rows = e_starts[od] + within % e_counts[od]
+
+        access_egress = \
+            self.access_taps.utility[access_rows] + self.egress_taps.utility[egress_rows]
+
+        # taps are in descending order of utility, so the first candidate of each od pairs its
+        # best access and egress taps - its utility is a lower bound on the od's best utility
+        first = np.flatnonzero(within == 0)
+        first_utility, _ = self.transit(self.access_taps.tap[access_rows[first]],
+                                        self.egress_taps.tap[egress_rows[first]],
+                                        tod_codes[od[first]])
+        lower_bound = np.full(len(keys), -np.inf)
+        lower_bound[od[first]] = np.where(np.isnan(first_utility), -np.inf,
+                                          access_egress[first] + first_utility)
+
+        upper_bound = access_egress + self.transit_upper_bounds[tod_codes[od]]
+        keep = upper_bound >= lower_bound[od]
+
+        logger.debug("best_transit_path kept %s of %s candidate tap pairs for %s ods" %
+                     (keep.sum(), len(keep), len(keys)))
+
+        od, access_rows, egress_rows, access_egress = \
+            od[keep], access_rows[keep], egress_rows[keep], access_egress[keep]
+
+        btap = self.access_taps.tap[access_rows]
+        atap = self.egress_taps.tap[egress_rows]
+        transit_utility, service = self.transit(btap, atap, tod_codes[od])
+
+        utility = access_egress + transit_utility
+        utility[np.isnan(utility)] = -np.inf
+
+        # segmented argmax - first candidate with the max utility of its od
+        od_counts = np.bincount(od, minlength=len(keys))
+        nonempty = od_counts > 0
+        starts = (np.cumsum(od_counts) - od_counts)[nonempty]
+        od_max = np.maximum.reduceat(utility, starts) if len(starts) else utility[:0]
+
+        is_max = np.flatnonzero(utility == np.repeat(od_max, od_counts[nonempty]))
+        best = is_max[np.r_[True, od[is_max][1:] != od[is_max][:-1]]] if len(is_max) else is_max
+        best = best[utility[best] > -np.inf]
+
+        paths = pd.DataFrame(index=keys)
+
+        for c, values, missing in [('btap', btap, -1),
+                                   ('atap', atap, -1),
+                                   ('utility', utility, np.nan),
+                                   ('transit_type', TRANSIT_SERVICE_NAMES[service], None)]:
+            column = np.full(len(keys), missing, dtype=values.dtype)
+            column[od[best]] = values[best]
+            paths[c] = column
+
+        return paths